@@ -0,0 +1,127 @@
+"""calibration of call_mods (--autotune): the rate of the feature extraction processes and the
+inference rate of a calling process per batch size and thread count are measured on the first
+batches, then --batch_size, --nproc, --nproc_call/--nproc_gpu and --threads_call are chosen
+so that the extraction and the calling stages are balanced.
+"""
+
+from __future__ import absolute_import
+
+import time
+import numpy as np
+import torch
+
+autotune_batch_sizes = (256, 512, 1024)
+# the predictions of each measurement, after a warm-up one
+autotune_repeats = 2
+
+
+def _tile_batch(features, batch_size):
+    # batch_size samples of features (kmers, base_means, base_stds, base_signal_lens, signals),
+    # repeated if there are fewer
+    idxs = np.arange(batch_size) % len(features[0])
+    return [x[idxs] for x in features]
+
+
+def measure_inference_rate(engine, features, batch_size, threads=0):
+    """
+    :param features: (kmers, base_means, base_stds, base_signal_lens, signals) of some samples
+    :param threads: torch threads, 0 to keep the current setting
+    :return: samples/s of engine.predict() on batches of batch_size
+    """
+    threads_ori = torch.get_num_threads()
+    if threads > 0:
+        torch.set_num_threads(threads)
+    try:
+        batch = _tile_batch(features, batch_size)
+        engine.predict(*batch)
+        start = time.time()
+        for _ in range(autotune_repeats):
+            engine.predict(*batch)
+        return batch_size * autotune_repeats / max(time.time() - start, 1e-6)
+    finally:
+        torch.set_num_threads(threads_ori)
+
+
+def get_threads_candidates(max_threads):
+    threads_candidates = [1]
+    while threads_candidates[-1] * 2 <= max_threads:
+        threads_candidates.append(threads_candidates[-1] * 2)
+    return threads_candidates
+
+
+def measure_inference_rates(engine, features, threads_candidates=(0, )):
+    """
+    the batch sizes are measured with the first thread count, then the thread counts with the
+    fastest batch size
+    :return: dict of (batch_size, threads) -> samples/s of a calling process
+    """
+    infer_rates = dict()
+    for batch_size in autotune_batch_sizes:
+        infer_rates[(batch_size, threads_candidates[0])] = measure_inference_rate(engine, features, batch_size,
+                                                                                  threads_candidates[0])
+    batch_size = max(autotune_batch_sizes, key=lambda x: infer_rates[(x, threads_candidates[0])])
+    for threads in threads_candidates[1:]:
+        infer_rates[(batch_size, threads)] = measure_inference_rate(engine, features, batch_size, threads)
+    return infer_rates
+
+
+def choose_cpu_config(infer_rates, ncpu, extract_rate=None, reader_rate=None):
+    """
+    :param infer_rates: dict of (batch_size, threads) -> samples/s of a calling process
+    :param ncpu: cpus to be used, by extraction processes, calling threads and the writing process
+    :param extract_rate: samples/s of a feature extraction process (fast5s as input), or
+    :param reader_rate: samples/s of the reading process (a features file as input)
+    :return: expected samples/s, nproc_extract, nproc_call, threads_call, batch_size
+    """
+    best, best_key = None, None
+    for (batch_size, threads), infer_rate in infer_rates.items():
+        nproc_call = 1
+        while True:
+            # 1 cpu for the writing process
+            cpus_left = ncpu - 1 - nproc_call * threads
+            if cpus_left < 1:
+                break
+            if extract_rate is not None:
+                nproc_extract = cpus_left
+                rate = min(nproc_extract * extract_rate, nproc_call * infer_rate)
+            else:
+                nproc_extract = 1
+                rate = min(reader_rate, nproc_call * infer_rate)
+            # the faster, then the fewer cpus for calling
+            key = (rate, -nproc_call * threads, -nproc_call)
+            if best_key is None or key > best_key:
+                best, best_key = (rate, nproc_extract, nproc_call, threads, batch_size), key
+            nproc_call += 1
+    return best
+
+
+def choose_gpu_config(infer_rates, nproc, extract_rate=None, reader_rate=None):
+    """
+    :param infer_rates: dict of (batch_size, threads) -> samples/s of a calling process on gpu
+    :param nproc: number of processes, of extraction, calling (on gpu) and writing
+    :param extract_rate: samples/s of a feature extraction process (fast5s as input), or
+    :param reader_rate: samples/s of the reading process (a features file as input)
+    :return: expected samples/s, nproc_extract, nproc_gpu, batch_size
+    """
+    best, best_key = None, None
+    for (batch_size, _), infer_rate in infer_rates.items():
+        # no more than nproc/4 processes on gpu, as suggested by --nproc_gpu
+        for nproc_gpu in range(1, max(1, nproc // 4) + 1):
+            if extract_rate is not None:
+                nproc_extract = nproc - 1 - nproc_gpu
+                if nproc_extract < 1:
+                    break
+                rate = min(nproc_extract * extract_rate, nproc_gpu * infer_rate)
+            else:
+                nproc_extract = 1
+                rate = min(reader_rate, nproc_gpu * infer_rate)
+            key = (rate, -nproc_gpu)
+            if best_key is None or key > best_key:
+                best, best_key = (rate, nproc_extract, nproc_gpu, batch_size), key
+    return best
+
+
+def print_infer_rates(infer_rates, device="cpu"):
+    for (batch_size, threads), infer_rate in sorted(infer_rates.items()):
+        print("autotune: calling on {}, batch_size {}, {} threads: {:.1f} samples/s".format(
+            device, batch_size, threads if threads > 0 else torch.get_num_threads(), infer_rate))
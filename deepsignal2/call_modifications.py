@@ -12,11 +12,12 @@ import argparse
 import os
 import sys
 import numpy as np
-from sklearn import metrics
+import h5py
 
 # import multiprocessing as mp
 import torch.multiprocessing as mp
 try:
+    # the default, call_mods() sets the start method of --mp_start_method
     mp.set_start_method('spawn')
 except RuntimeError:
     pass
@@ -24,80 +25,214 @@ except RuntimeError:
 # from utils.process_utils import Queue
 from torch.multiprocessing import Queue
 import time
-
-from .models import ModelBiLSTM
-from .utils.process_utils import base2code_dna
-from .utils.process_utils import code2base_dna
+import functools
+
+from .inference import get_inference_engine
+from .inference import read_export_info
+from .inference import load_model
+from .inference import check_quantize_supported
+from .inference import InferenceEngine
+from .autotune import measure_inference_rates
+from .autotune import get_threads_candidates
+from .autotune import choose_cpu_config
+from .autotune import choose_gpu_config
+from .autotune import print_infer_rates
 from .utils.process_utils import str2bool
 from .utils.process_utils import display_args
-from .utils.process_utils import nproc_to_call_mods_in_cpu_mode
+from .utils.process_utils import is_kill_signal
+from .utils.process_utils import wait_for_processes
 
 from .extract_features import _extract_features
 from .extract_features import _extract_preprocess
+from .extract_features import _iter_fast5s_batches
+from .utils.features_h5 import is_features_h5
+from .utils.features_h5 import read_features_h5
+from .utils.features_h5 import sampleinfo_cols
+from .utils.features_h5 import kmers_to_codes
+from .utils.features_h5 import codes_to_kmers
+from .utils.features_h5 import get_features_batch
+from .utils.manifest import ManifestWriter
+from .utils.manifest import get_manifest_path
+from .utils.manifest import prepare_resume
+from .utils.compress_utils import TextResultWriter
+from .utils.compress_utils import open_text
+from .utils.compress_utils import is_compressed
 
-from .utils.constants_torch import FloatTensor
 from .utils.constants_torch import use_cuda
 
 import uuid
 
 queen_size_border = 2000
 queen_size_border_f5batch = 100
-time_wait = 3
+# batches to be taken for --autotune
+autotune_f5_batches = 2
+autotune_features_batches = 4
+
+
+def _parse_number_column(column, dtype, sample_num):
+    # the comma-separated numbers of all the samples are parsed in one pass by numpy
+    return np.fromstring(",".join(column), dtype=dtype, sep=",").reshape((sample_num, -1))
+
+
+def _features_lines_to_batch(lines):
+    """
+    :param lines: list of the lines of a features file (tsv format)
+    :return: a features batch, see utils.features_h5.get_features_batch()
+    """
+    columns = list(zip(*[line.strip().split("\t") for line in lines]))
+    sample_num = len(lines)
+    features_arrays = dict()
+    # sampleinfo contains: chromosome, pos, strand, pos_in_strand, read_name, read_strand
+    for col_idx, col in enumerate(sampleinfo_cols):
+        features_arrays[col] = list(columns[col_idx])
+    features_arrays['pos'] = np.array(features_arrays['pos'], dtype=np.int64)
+    features_arrays['pos_in_strand'] = np.array(features_arrays['pos_in_strand'], dtype=np.int64)
+    features_arrays['kmer'] = kmers_to_codes(list(columns[6]))
+    features_arrays['base_means'] = _parse_number_column(columns[7], np.float32, sample_num)
+    features_arrays['base_stds'] = _parse_number_column(columns[8], np.float32, sample_num)
+    features_arrays['base_signal_lens'] = _parse_number_column(columns[9], np.int32, sample_num)
+    features_arrays['signals'] = np.fromstring(",".join(columns[10]).replace(";", ","), dtype=np.float32,
+                                               sep=",").reshape((sample_num, len(columns[6][0]), -1))
+    features_arrays['label'] = np.array(columns[11], dtype=np.int8)
+    return get_features_batch(features_arrays)
+
+
+def _iter_features_file(features_file, batch_num=512):
+    with open_text(features_file) as rf:
+        lines = []
+        for line in rf:
+            lines.append(line)
+            if len(lines) == batch_num:
+                yield _features_lines_to_batch(lines)
+                lines = []
+        if len(lines) > 0:
+            yield _features_lines_to_batch(lines)
+
+
+def get_features_file_ranges(features_file, range_num):
+    """
+    split a plain (uncompressed) features file (tsv) into byte ranges at line breaks
+    :param range_num: max number of ranges
+    :return: list of (start, end) byte offsets, each range is made of whole lines
+    """
+    file_size = os.path.getsize(features_file)
+    offsets = [0]
+    with open(features_file, "rb") as rf:
+        for i in range(1, range_num):
+            pos = file_size * i // range_num
+            if pos <= offsets[-1]:
+                continue
+            # move to the start of the next line (or stay, if pos is already a line start)
+            rf.seek(pos - 1)
+            rf.readline()
+            pos = rf.tell()
+            if pos >= file_size:
+                break
+            if pos > offsets[-1]:
+                offsets.append(pos)
+    offsets.append(file_size)
+    return [(start, end) for start, end in zip(offsets[:-1], offsets[1:]) if end > start]
+
+
+def _iter_features_file_range(features_file, start, end, batch_num=512):
+    # lines in byte range [start, end) of a plain features file, see get_features_file_ranges()
+    with open(features_file, "rb") as rf:
+        rf.seek(start)
+        pos = start
+        lines = []
+        while pos < end:
+            line = rf.readline()
+            if not line:
+                break
+            pos += len(line)
+            lines.append(line.decode("UTF-8"))
+            if len(lines) == batch_num:
+                yield _features_lines_to_batch(lines)
+                lines = []
+        if len(lines) > 0:
+            yield _features_lines_to_batch(lines)
+
+
+def _iter_features_h5(features_file, batch_num=512):
+    # features in the binary columnar format (extract --w_format h5), read in row slices, no parsing
+    with h5py.File(features_file, "r") as h5file:
+        sample_num = len(h5file['label'])
+        for i in np.arange(0, sample_num, batch_num):
+            yield get_features_batch(read_features_h5(h5file, i, i + batch_num))
+
+
+def iter_features_batches(features_file, batch_num=512):
+    """
+    :param features_file: a features file from extract_features.py, tsv (plain or compressed) or h5
+    :return: iterator of features batches, see utils.features_h5.get_features_batch()
+    """
+    if is_features_h5(features_file):
+        return _iter_features_h5(features_file, batch_num)
+    return _iter_features_file(features_file, batch_num)
 
 
 def _read_features_file(features_file, features_batch_q, batch_num=512):
     print("read_features process-{} starts".format(os.getpid()))
     b_num = 0
-    with open(features_file, "r") as rf:
-        sampleinfo = []  # contains: chromosome, pos, strand, pos_in_strand, read_name, read_strand
-        kmers = []
-        base_means = []
-        base_stds = []
-        base_signal_lens = []
-        k_signals = []
-        labels = []
+    for features_batch in _iter_features_file(features_file, batch_num):
+        features_batch_q.put((None, features_batch))
+        b_num += 1
+    print("read_features process-{} ending, read {} batches".format(os.getpid(), b_num))
 
-        for line in rf:
-            words = line.strip().split("\t")
-
-            sampleinfo.append("\t".join(words[0:6]))
-
-            kmers.append([base2code_dna[x] for x in words[6]])
-            base_means.append([float(x) for x in words[7].split(",")])
-            base_stds.append([float(x) for x in words[8].split(",")])
-            base_signal_lens.append([int(x) for x in words[9].split(",")])
-            k_signals.append(np.array([[float(y) for y in x.split(",")] for x in words[10].split(";")]))
-            labels.append(int(words[11]))
-
-            if len(sampleinfo) == batch_num:
-                features_batch_q.put((sampleinfo, kmers, base_means, base_stds,
-                                      base_signal_lens, k_signals, labels))
-                while features_batch_q.qsize() > queen_size_border:
-                    time.sleep(time_wait)
-                sampleinfo = []
-                kmers = []
-                base_means = []
-                base_stds = []
-                base_signal_lens = []
-                k_signals = []
-                labels = []
-                b_num += 1
-        if len(sampleinfo) > 0:
-            features_batch_q.put((sampleinfo, kmers, base_means, base_stds,
-                                  base_signal_lens, k_signals, labels))
-    features_batch_q.put("kill")
+
+def _read_features_file_range(features_file, start, end, features_batch_q, batch_num=512):
+    print("read_features process-{} starts, bytes {}-{}".format(os.getpid(), start, end))
+    b_num = 0
+    for features_batch in _iter_features_file_range(features_file, start, end, batch_num):
+        features_batch_q.put((None, features_batch))
+        b_num += 1
     print("read_features process-{} ending, read {} batches".format(os.getpid(), b_num))
 
 
-def _call_mods(features_batch, model, batch_size):
+def _read_features_h5(features_file, features_batch_q, batch_num=512):
+    print("read_features process-{} starts".format(os.getpid()))
+    b_num = 0
+    for features_batch in _iter_features_h5(features_file, batch_num):
+        features_batch_q.put((None, features_batch))
+        b_num += 1
+    print("read_features process-{} ending, read {} batches".format(os.getpid(), b_num))
+
+
+def _start_features_readers(features_file, features_batch_q, batch_num, nproc_reader):
+    """
+    a plain features file (tsv) is split into byte ranges, read by up to nproc_reader processes;
+    h5 and compressed files are read by 1 process
+    """
+    if is_features_h5(features_file):
+        reader_args = [(_read_features_h5, (features_file, features_batch_q, batch_num))]
+    elif is_compressed(features_file):
+        reader_args = [(_read_features_file, (features_file, features_batch_q, batch_num))]
+    else:
+        reader_args = [(_read_features_file_range, (features_file, start, end, features_batch_q, batch_num))
+                       for start, end in get_features_file_ranges(features_file, nproc_reader)]
+    read_procs = []
+    for target, p_args in reader_args:
+        p_rf = mp.Process(target=target, args=p_args)
+        p_rf.daemon = True
+        p_rf.start()
+        read_procs.append(p_rf)
+    return read_procs
+
+
+def _get_siteinfo_strs(siteinfo):
+    siteinfo_cols = [siteinfo[col].tolist() for col in sampleinfo_cols]
+    return ["\t".join([chrom, str(pos), strand, str(pos_in_strand), readname, read_strand])
+            for chrom, pos, strand, pos_in_strand, readname, read_strand in zip(*siteinfo_cols)]
+
+
+def _call_mods(features_batch, engine, batch_size):
     # features_batch: 1. if from _read_features_file(), has 1 * args.batch_size samples
     # --------------: 2. if from _read_features_from_fast5s(), has uncertain number of samples
+    # see utils.features_h5.get_features_batch(), sampleinfo is a structured array
     sampleinfo, kmers, base_means, base_stds, base_signal_lens, \
-        k_signals, labels = features_batch
-    labels = np.reshape(labels, (len(labels)))
+        k_signals, _ = features_batch
 
     pred_str = []
-    accuracys = []
     batch_num = 0
     for i in np.arange(0, len(sampleinfo), batch_size):
         batch_s, batch_e = i, i + batch_size
@@ -107,162 +242,228 @@ def _call_mods(features_batch, model, batch_size):
         b_base_stds = base_stds[batch_s:batch_e]
         b_base_signal_lens = base_signal_lens[batch_s:batch_e]
         b_k_signals = k_signals[batch_s:batch_e]
-        b_labels = labels[batch_s:batch_e]
         if len(b_sampleinfo) > 0:
-            voutputs, vlogits = model(FloatTensor(b_kmers), FloatTensor(b_base_means), FloatTensor(b_base_stds),
-                                      FloatTensor(b_base_signal_lens), FloatTensor(b_k_signals))
-            _, vpredicted = torch.max(vlogits.data, 1)
-            if use_cuda:
-                vlogits = vlogits.cpu()
-                vpredicted = vpredicted.cpu()
-
-            predicted = vpredicted.numpy()
-            logits = vlogits.data.numpy()
-
-            acc_batch = metrics.accuracy_score(
-                y_true=b_labels, y_pred=predicted)
-            accuracys.append(acc_batch)
-
-            for idx in range(len(b_sampleinfo)):
-                # chromosome, pos, strand, pos_in_strand, read_name, read_strand, prob_0, prob_1, called_label, seq
-                prob_0, prob_1 = logits[idx][0], logits[idx][1]
-                prob_0_norm = round(prob_0 / (prob_0 + prob_1), 6)
-                prob_1_norm = round(prob_1 / (prob_0 + prob_1), 6)
-                pred_str.append("\t".join([b_sampleinfo[idx], str(prob_0_norm),
-                                           str(prob_1_norm), str(predicted[idx]),
-                                           ''.join([code2base_dna[x] for x in b_kmers[idx]])]))
+            logits = engine.predict(b_kmers, b_base_means, b_base_stds, b_base_signal_lens, b_k_signals)
+            predicted = np.argmax(logits, axis=1)
+
+            # chromosome, pos, strand, pos_in_strand, read_name, read_strand, prob_0, prob_1, called_label, seq
+            probs = np.round(logits[:, :2] / (logits[:, 0:1] + logits[:, 1:2]), 6)
+            for b_siteinfo_str, prob_0_norm, prob_1_norm, pred_label, kmer in zip(_get_siteinfo_strs(b_sampleinfo),
+                                                                                probs[:, 0], probs[:, 1],
+                                                                                predicted.tolist(),
+                                                                                codes_to_kmers(b_kmers)):
+                pred_str.append("\t".join([b_siteinfo_str, str(prob_0_norm),
+                                           str(prob_1_norm), str(pred_label), kmer]))
             batch_num += 1
-    accuracy = np.mean(accuracys)
-
-    return pred_str, accuracy, batch_num
 
-
-def _call_mods_q(model_path, features_batch_q, pred_str_q, success_file, args):
-    print('call_mods process-{} starts'.format(os.getpid()))
-    model = ModelBiLSTM(args.seq_len, args.signal_len, args.layernum1, args.layernum2, args.class_num,
-                        args.dropout_rate, args.hid_rnn,
-                        args.n_vocab, args.n_embed, str2bool(args.is_base), str2bool(args.is_signallen),
-                        args.model_type)
+    return pred_str, batch_num
+
+
+def _get_shared_model(model_path, args):
+    # in cpu mode, the eager model is loaded once in the main process, its parameters are
+    # moved to shared memory and used by all calling processes (without a copy per process).
+    # the packed int8 weights of a quantized model are not parameters/buffers, and can not be
+    # shared by share_memory(), so with --quantize each calling process loads and quantizes its own
+    if use_cuda or args.engine != "eager" or args.quantize is not None:
+        return None
+    model = load_model(model_path, args)
+    model.share_memory()
+    return model
+
+
+def _get_threads_call(args, nproc_call, nproc_extract):
+    """torch threads of each calling process"""
+    if args.threads_call > 0 or use_cuda:
+        return args.threads_call
+    return max(1, (mp.cpu_count() - nproc_extract) // nproc_call)
+
+
+def _set_start_method(args):
+    start_method = args.mp_start_method
+    if start_method is None:
+        start_method = "spawn"
+        if not use_cuda and "forkserver" in mp.get_all_start_methods():
+            start_method = "forkserver"
+    if start_method != "spawn" and use_cuda:
+        raise ValueError("--mp_start_method must be spawn in gpu mode")
+    mp.set_start_method(start_method, force=True)
+    if start_method == "forkserver":
+        # the forkserver imports torch and deepsignal2 once, instead of each process
+        mp.set_forkserver_preload([__name__])
+    print("start method of processes: {}".format(start_method))
+
+
+def _autotune_call_mods(features_batches, model_path, args, extract_rate=None, reader_rate=None):
+    # measure the calling rates on the features_batches, and set args by the balanced config
+    features = [np.concatenate([x[i] for x in features_batches]) for i in range(1, 6)]
+    engine = get_inference_engine(args.engine, model_path, args, args.quantize)
     if use_cuda:
-        model = model.cuda()
-        para_dict = torch.load(model_path)
+        infer_rates = measure_inference_rates(engine, features)
+        print_infer_rates(infer_rates, "gpu")
+        config = choose_gpu_config(infer_rates, args.nproc, extract_rate, reader_rate)
+        if config is None:
+            print("autotune: --nproc is too small to be tuned, keep the args")
+            return
+        rate, nproc_extract, args.nproc_gpu, args.batch_size = config
+        print("autotune: --batch_size {} --nproc {} --nproc_gpu {}, {} extraction/reading processes, "
+              "expected {:.1f} samples/s".format(args.batch_size, args.nproc, args.nproc_gpu,
+                                                 nproc_extract, rate))
+    else:
+        infer_rates = measure_inference_rates(engine, features, get_threads_candidates(max(1, args.nproc - 2)))
+        print_infer_rates(infer_rates, "cpu")
+        config = choose_cpu_config(infer_rates, args.nproc, extract_rate, reader_rate)
+        if config is None:
+            print("autotune: --nproc is too small to be tuned, keep the args")
+            return
+        rate, nproc_extract, args.nproc_call, args.threads_call, args.batch_size = config
+        # nproc_extract extraction (or reading) processes, nproc_call calling processes, 1 writing process
+        args.nproc = nproc_extract + args.nproc_call + 1
+        print("autotune: --batch_size {} --nproc {} --nproc_call {} --threads_call {}, {} extraction/reading "
+              "processes, expected {:.1f} samples/s".format(args.batch_size, args.nproc, args.nproc_call,
+                                                            args.threads_call, nproc_extract, rate))
+
+
+def _autotune_fast5s(motif_scanner, chrom2len, positions, fast5s_batches, model_path, args):
+    """
+    --autotune with fast5s as input, the first of the scheduled fast5s_batches are extracted to
+    measure the extraction rate, before the batches are queued (see extract_features._extract_preprocess()),
+    see autotune.py
+    """
+    print("autotune: calibrating..")
+    start = time.time()
+    features_batches = []
+    sample_num, extract_cost = 0, 0
+    for fast5s in fast5s_batches[:autotune_f5_batches]:
+        extract_start = time.time()
+        b_features_batches, _ = _read_features_from_fast5s(fast5s, motif_scanner, chrom2len, positions, args)
+        extract_cost += time.time() - extract_start
+        features_batches += b_features_batches
+        sample_num += sum([len(x[0]) for x in b_features_batches])
+    if sample_num == 0:
+        print("autotune: no features in the first batches, keep the args")
+        return
+    extract_rate = sample_num / max(extract_cost, 1e-6)
+    print("autotune: feature extraction, {:.1f} samples/s per process".format(extract_rate))
+    _autotune_call_mods(features_batches, model_path, args, extract_rate=extract_rate)
+    print("autotune: costs {:.2f} seconds".format(time.time() - start))
+
+
+def _autotune_features_file(input_path, model_path, args):
+    """--autotune with a features file as input, the reading rate is measured by the first batches"""
+    print("autotune: calibrating..")
+    start = time.time()
+    features_batches = []
+    sample_num = 0
+    for features_batch in iter_features_batches(input_path, args.batch_size):
+        features_batches.append(features_batch)
+        sample_num += len(features_batch[0])
+        if len(features_batches) >= autotune_features_batches:
+            break
+    if sample_num == 0:
+        print("autotune: no features in the file, keep the args")
+        return
+    reader_rate = sample_num / max(time.time() - start, 1e-6)
+    print("autotune: reading features, {:.1f} samples/s per process".format(reader_rate))
+    if is_features_h5(input_path) or is_compressed(input_path):
+        _autotune_call_mods(features_batches, model_path, args, reader_rate=reader_rate)
     else:
-        para_dict = torch.load(model_path, map_location=torch.device('cpu'))
+        # a plain features file is read by multiple processes, as the feature extraction of fast5s
+        _autotune_call_mods(features_batches, model_path, args, extract_rate=reader_rate)
+    print("autotune: costs {:.2f} seconds".format(time.time() - start))
 
-    model_dict = model.state_dict()
-    model_dict.update(para_dict)
-    model.load_state_dict(model_dict)
 
-    model.eval()
+def _call_mods_q(model_path, features_batch_q, pred_str_q, success_file, args, shared_model=None,
+                 threads_call=0):
+    print('call_mods process-{} starts'.format(os.getpid()))
+    if threads_call > 0:
+        torch.set_num_threads(threads_call)
+    if shared_model is not None:
+        engine = InferenceEngine(shared_model)
+    else:
+        engine = get_inference_engine(args.engine, model_path, args, args.quantize)
 
-    accuracy_list = []
     batch_num_total = 0
     while True:
         # if os.path.exists(success_file):
         #     break
 
-        if features_batch_q.empty():
-            time.sleep(time_wait)
-            continue
-
-        features_batch = features_batch_q.get()
-        if features_batch == "kill":
+        features_item = features_batch_q.get()
+        if is_kill_signal(features_item):
             # deprecate successfile, use "kill" signal multi times to kill each process
             features_batch_q.put("kill")
             # open(success_file, 'w').close()
             break
+        # fast5s: the batch of fast5 reads the features are from (None if from a features file),
+        # passed on to the writer for the manifest
+        fast5s, features_batch = features_item
 
-        pred_str, accuracy, batch_num = _call_mods(features_batch, model, args.batch_size)
+        pred_str, batch_num = _call_mods(features_batch, engine, args.batch_size)
 
-        pred_str_q.put(pred_str)
+        pred_str_q.put((fast5s, pred_str))
         # for debug
         # print("call_mods process-{} reads 1 batch, features_batch_q:{}, "
         #       "pred_str_q: {}".format(os.getpid(), features_batch_q.qsize(), pred_str_q.qsize()))
-        accuracy_list.append(accuracy)
         batch_num_total += batch_num
-    # print('total accuracy in process {}: {}'.format(os.getpid(), np.mean(accuracy_list)))
     print('call_mods process-{} ending, proceed {} batches'.format(os.getpid(), batch_num_total))
 
 
-def _write_predstr_to_file(write_fp, predstr_q):
+def _write_predstr_to_file(write_fp, predstr_q, resume_size=None):
     print('write_process-{} starts'.format(os.getpid()))
-    with open(write_fp, 'w') as wf:
+    manifest = ManifestWriter(get_manifest_path(write_fp), resume_size is not None)
+    # compressed by the suffix of write_fp, see utils.compress_utils
+    with TextResultWriter(write_fp, manifest, resume_size) as wf:
         while True:
-            # during test, it's ok without the sleep()
-            if predstr_q.empty():
-                time.sleep(time_wait)
-                continue
-            pred_str = predstr_q.get()
-            if pred_str == "kill":
+            pred_item = predstr_q.get()
+            if is_kill_signal(pred_item):
                 print('write_process-{} finished'.format(os.getpid()))
                 break
-            for one_pred_str in pred_str:
-                wf.write(one_pred_str + "\n")
-            wf.flush()
+            fast5s, pred_str = pred_item
+            wf.write(pred_str, fast5s)
+    manifest.close()
 
 
-def _read_features_from_fast5s(fast5s, motif_seqs, chrom2len, positions, args):
-    features_list, error = _extract_features(fast5s, args.corrected_group, args.basecall_subgroup,
-                                             args.normalize_method, motif_seqs, args.mod_loc, chrom2len,
-                                             args.seq_len, args.signal_len,
-                                             1, positions)
+def _read_features_from_fast5s(fast5s, motif_scanner, chrom2len, positions, args, fast5_bytes=None):
+    features_arrays, error = _extract_features(fast5s, args.corrected_group, args.basecall_subgroup,
+                                               args.normalize_method, motif_scanner, chrom2len,
+                                               args.seq_len, args.signal_len,
+                                               1, positions, fast5_bytes)
     features_batches = []
 
-    sampleinfo = []  # contains: chromosome, pos, strand, pos_in_strand, read_name, read_strand
-    kmers = []
-    base_means = []
-    base_stds = []
-    base_signal_lens = []
-    k_signals = []
-    labels = []
-    for features in features_list:
-        chrom, pos, alignstrand, loc_in_ref, readname, strand, k_mer, signal_means, signal_stds, \
-                    signal_lens, kmer_base_signals, f_methy_label = features
-
-        sampleinfo.append("\t".join([chrom, str(pos), alignstrand, str(loc_in_ref), readname, strand]))
-        kmers.append([base2code_dna[x] for x in k_mer])
-        base_means.append(signal_means)
-        base_stds.append(signal_stds)
-        base_signal_lens.append(signal_lens)
-        k_signals.append(kmer_base_signals)
-        labels.append(f_methy_label)
-    features_batches.append((sampleinfo, kmers, base_means, base_stds,
-                             base_signal_lens, k_signals, labels))
+    # sampleinfo contains: chromosome, pos, strand, pos_in_strand, read_name, read_strand
+    features_batches.append(get_features_batch(features_arrays))
     return features_batches, error
 
 
 def _read_features_fast5s_q(fast5s_q, features_batch_q, errornum_q,
-                            motif_seqs, chrom2len, positions, args):
+                            motif_scanner, chrom2len, positions, args):
     print("read_fast5 process-{} starts".format(os.getpid()))
     f5_num = 0
-    while True:
-        if fast5s_q.empty():
-            time.sleep(time_wait)
-        fast5s = fast5s_q.get()
-        if fast5s == "kill":
-            fast5s_q.put("kill")
-            break
+    error_total = 0
+    # the fast5 data of the next batches are prefetched by I/O threads while this batch is processed
+    for fast5s, fast5_bytes in _iter_fast5s_batches(fast5s_q, args.corrected_group, args.basecall_subgroup,
+                                                    args.prefetch_depth, args.io_threads):
         f5_num += len(fast5s)
-        features_batches, error = _read_features_from_fast5s(fast5s, motif_seqs, chrom2len, positions,
-                                                             args)
-        errornum_q.put(error)
-        for features_batch in features_batches:
-            features_batch_q.put(features_batch)
-        while features_batch_q.qsize() > queen_size_border_f5batch:
-            time.sleep(time_wait)
+        features_batches, error = _read_features_from_fast5s(fast5s, motif_scanner, chrom2len, positions,
+                                                             args, fast5_bytes)
+        error_total += error
+        # blocks when the calling processes fall behind (features_batch_q is bounded)
+        for b_idx, features_batch in enumerate(features_batches):
+            # fast5s goes with the last features batch, so that it is recorded as done after all batches
+            features_batch_q.put((fast5s if b_idx == len(features_batches) - 1 else None, features_batch))
+    errornum_q.put(error_total)
     print("read_fast5 process-{} ending, proceed {} fast5s".format(os.getpid(), f5_num))
 
 
-def _call_mods_from_fast5s_gpu(motif_seqs, chrom2len, fast5s_q, len_fast5s, positions,
+def _call_mods_from_fast5s_gpu(motif_scanner, chrom2len, fast5s_q, len_fast5s, positions,
                                model_path, success_file,
-                               args):
+                               args, resume_size=None):
     # features_batch_q = mp.Queue()
     # errornum_q = mp.Queue()
-    features_batch_q = Queue()
+    features_batch_q = Queue(maxsize=queen_size_border_f5batch)
     errornum_q = Queue()
 
     # pred_str_q = mp.Queue()
-    pred_str_q = Queue()
+    pred_str_q = Queue(maxsize=queen_size_border)
 
     nproc = args.nproc
     nproc_gpu = args.nproc_gpu
@@ -276,7 +477,7 @@ def _call_mods_from_fast5s_gpu(motif_seqs, chrom2len, fast5s_q, len_fast5s, posi
     features_batch_procs = []
     for _ in range(nproc - nproc_gpu - 1):
         p = mp.Process(target=_read_features_fast5s_q, args=(fast5s_q, features_batch_q, errornum_q,
-                                                             motif_seqs, chrom2len, positions,
+                                                             motif_scanner, chrom2len, positions,
                                                              args))
         p.daemon = True
         p.start()
@@ -285,59 +486,59 @@ def _call_mods_from_fast5s_gpu(motif_seqs, chrom2len, fast5s_q, len_fast5s, posi
     call_mods_gpu_procs = []
     for _ in range(nproc_gpu):
         p_call_mods_gpu = mp.Process(target=_call_mods_q, args=(model_path, features_batch_q, pred_str_q,
-                                                                success_file, args))
+                                                                success_file, args, None,
+                                                                args.threads_call))
         p_call_mods_gpu.daemon = True
         p_call_mods_gpu.start()
         call_mods_gpu_procs.append(p_call_mods_gpu)
 
     # print("write_process started..")
-    p_w = mp.Process(target=_write_predstr_to_file, args=(args.result_file, pred_str_q))
+    p_w = mp.Process(target=_write_predstr_to_file, args=(args.result_file, pred_str_q, resume_size))
     p_w.daemon = True
     p_w.start()
 
+    wait_for_processes(features_batch_procs, call_mods_gpu_procs + [p_w])
     errornum_sum = 0
-    while True:
-        running = any(p.is_alive() for p in features_batch_procs)
-        while not errornum_q.empty():
-            errornum_sum += errornum_q.get()
-        if not running:
-            break
-
-    for p in features_batch_procs:
-        p.join()
+    for _ in features_batch_procs:
+        errornum_sum += errornum_q.get()
     features_batch_q.put("kill")
 
-    for p_call_mods_gpu in call_mods_gpu_procs:
-        p_call_mods_gpu.join()
+    wait_for_processes(call_mods_gpu_procs, [p_w])
 
     # print("finishing the write_process..")
     pred_str_q.put("kill")
 
-    p_w.join()
+    wait_for_processes([p_w])
 
-    print("%d of %d fast5 files failed.." % (errornum_sum, len_fast5s))
+    print("%d of %d fast5 reads failed.." % (errornum_sum, len_fast5s))
 
 
-def _call_mods_from_fast5s_cpu2(motif_seqs, chrom2len, fast5s_q, len_fast5s, positions, model_path,
-                                success_file, args):
+def _call_mods_from_fast5s_cpu2(motif_scanner, chrom2len, fast5s_q, len_fast5s, positions, model_path,
+                                success_file, args, resume_size=None):
     # features_batch_q = mp.Queue()
     # errornum_q = mp.Queue()
-    features_batch_q = Queue()
+    features_batch_q = Queue(maxsize=queen_size_border_f5batch)
     errornum_q = Queue()
 
     # pred_str_q = mp.Queue()
-    pred_str_q = Queue()
+    pred_str_q = Queue(maxsize=queen_size_border)
 
     nproc = args.nproc
-    nproc_call_mods = nproc_to_call_mods_in_cpu_mode
+    nproc_call_mods = args.nproc_call
+    if nproc_call_mods < 1:
+        nproc_call_mods = 1
     if nproc <= nproc_call_mods + 1:
+        print("--nproc must be >= --nproc_call + 2!!")
         nproc = nproc_call_mods + 1 + 1
+    threads_call = _get_threads_call(args, nproc_call_mods, nproc - nproc_call_mods - 1)
+    print("{} calling processes, {} threads each".format(nproc_call_mods, threads_call))
+    shared_model = _get_shared_model(model_path, args)
 
     fast5s_q.put("kill")
     features_batch_procs = []
     for _ in range(nproc - nproc_call_mods - 1):
         p = mp.Process(target=_read_features_fast5s_q, args=(fast5s_q, features_batch_q, errornum_q,
-                                                             motif_seqs, chrom2len, positions,
+                                                             motif_scanner, chrom2len, positions,
                                                              args))
         p.daemon = True
         p.start()
@@ -346,37 +547,31 @@ def _call_mods_from_fast5s_cpu2(motif_seqs, chrom2len, fast5s_q, len_fast5s, pos
     call_mods_gpu_procs = []
     for _ in range(nproc_call_mods):
         p_call_mods_gpu = mp.Process(target=_call_mods_q, args=(model_path, features_batch_q, pred_str_q,
-                                                                success_file, args))
+                                                                success_file, args, shared_model,
+                                                                threads_call))
         p_call_mods_gpu.daemon = True
         p_call_mods_gpu.start()
         call_mods_gpu_procs.append(p_call_mods_gpu)
 
     # print("write_process started..")
-    p_w = mp.Process(target=_write_predstr_to_file, args=(args.result_file, pred_str_q))
+    p_w = mp.Process(target=_write_predstr_to_file, args=(args.result_file, pred_str_q, resume_size))
     p_w.daemon = True
     p_w.start()
 
+    wait_for_processes(features_batch_procs, call_mods_gpu_procs + [p_w])
     errornum_sum = 0
-    while True:
-        running = any(p.is_alive() for p in features_batch_procs)
-        while not errornum_q.empty():
-            errornum_sum += errornum_q.get()
-        if not running:
-            break
-
-    for p in features_batch_procs:
-        p.join()
+    for _ in features_batch_procs:
+        errornum_sum += errornum_q.get()
     features_batch_q.put("kill")
 
-    for p_call_mods_gpu in call_mods_gpu_procs:
-        p_call_mods_gpu.join()
+    wait_for_processes(call_mods_gpu_procs, [p_w])
 
     # print("finishing the write_process..")
     pred_str_q.put("kill")
 
-    p_w.join()
+    wait_for_processes([p_w])
 
-    print("%d of %d fast5 files failed.." % (errornum_sum, len_fast5s))
+    print("%d of %d fast5 reads failed.." % (errornum_sum, len_fast5s))
 
 
 # def _fast5s_q_to_pred_str_q(fast5s_q, errornum_q, pred_str_q,
@@ -477,37 +672,63 @@ def call_mods(args):
     model_path = os.path.abspath(args.model_path)
     if not os.path.exists(model_path):
         raise ValueError("--model_path is not set right!")
+    if args.quantize is not None and (args.engine != "eager" or use_cuda):
+        raise ValueError("--quantize is only for --engine eager in cpu mode")
+    if args.quantize is not None:
+        check_quantize_supported()
+    if args.engine != "eager":
+        # the exported model is of fixed kmer/signal len
+        export_info = read_export_info(model_path, args.engine)
+        for arg_name in ("seq_len", "signal_len"):
+            if export_info[arg_name] != getattr(args, arg_name):
+                raise ValueError("--{} ({}) is not the same as the exported model ({})".format(
+                    arg_name, getattr(args, arg_name), export_info[arg_name]))
     input_path = os.path.abspath(args.input_path)
     if not os.path.exists(input_path):
         raise ValueError("--input_path does not exist!")
+    _set_start_method(args)
     success_file = input_path.rstrip("/") + "." + str(uuid.uuid1()) + ".success"
     if os.path.exists(success_file):
         os.remove(success_file)
 
     if os.path.isdir(input_path):
-        motif_seqs, chrom2len, fast5s_q, len_fast5s, positions = _extract_preprocess(input_path,
-                                                                                     str2bool(args.recursively),
-                                                                                     args.motifs,
-                                                                                     str2bool(args.is_dna),
-                                                                                     args.reference_path,
-                                                                                     args.f5_batch_size,
-                                                                                     args.positions)
+        done_reads, resume_size = None, None
+        if args.resume:
+            done_reads, resume_size = prepare_resume(args.result_file)
+        calibrate_func = None
+        if args.autotune:
+            calibrate_func = functools.partial(_autotune_fast5s, model_path=model_path, args=args)
+        motif_scanner, chrom2len, fast5s_q, len_fast5s, positions = _extract_preprocess(input_path,
+                                                                                        str2bool(args.recursively),
+                                                                                        args.motifs,
+                                                                                        args.mod_loc,
+                                                                                        str2bool(args.is_dna),
+                                                                                        args.reference_path,
+                                                                                        args.f5_batch_size,
+                                                                                        args.positions,
+                                                                                        done_reads,
+                                                                                        args.region,
+                                                                                        args.fast5_index,
+                                                                                        args.corrected_group,
+                                                                                        args.basecall_subgroup,
+                                                                                        args.nproc,
+                                                                                        calibrate_func)
         if use_cuda:
-            _call_mods_from_fast5s_gpu(motif_seqs, chrom2len, fast5s_q, len_fast5s, positions, model_path,
-                                       success_file, args)
+            _call_mods_from_fast5s_gpu(motif_scanner, chrom2len, fast5s_q, len_fast5s, positions, model_path,
+                                       success_file, args, resume_size)
         else:
-            _call_mods_from_fast5s_cpu2(motif_seqs, chrom2len, fast5s_q, len_fast5s, positions, model_path,
-                                        success_file, args)
+            _call_mods_from_fast5s_cpu2(motif_scanner, chrom2len, fast5s_q, len_fast5s, positions, model_path,
+                                        success_file, args, resume_size)
     else:
+        if args.resume:
+            raise ValueError("--resume is only supported when --input_path is a directory of fast5 files")
+        if args.autotune:
+            _autotune_features_file(input_path, model_path, args)
         # features_batch_q = mp.Queue()
-        features_batch_q = Queue()
-        p_rf = mp.Process(target=_read_features_file, args=(input_path, features_batch_q,
-                                                            args.batch_size))
-        p_rf.daemon = True
-        p_rf.start()
+        features_batch_q = Queue(maxsize=queen_size_border)
 
         # pred_str_q = mp.Queue()
-        pred_str_q = Queue()
+        pred_str_q = Queue(maxsize=queen_size_border)
 
         predstr_procs = []
 
@@ -515,18 +736,28 @@ def call_mods(args):
             nproc_dp = args.nproc_gpu
             if nproc_dp < 1:
                 nproc_dp = 1
+            # the processes left (but the writing process) read the features file
+            nproc_reader = max(args.nproc - nproc_dp - 1, 1)
+            threads_call = args.threads_call
         else:
             nproc = args.nproc
             if nproc < 3:
                 print("--nproc must be >= 3!!")
                 nproc = 3
             nproc_dp = nproc - 2
-            if nproc_dp > nproc_to_call_mods_in_cpu_mode:
-                nproc_dp = nproc_to_call_mods_in_cpu_mode
+            if nproc_dp > args.nproc_call:
+                nproc_dp = max(args.nproc_call, 1)
+            nproc_reader = nproc - nproc_dp - 1
+        read_procs = _start_features_readers(input_path, features_batch_q, args.batch_size, nproc_reader)
+        if not use_cuda:
+            threads_call = _get_threads_call(args, nproc_dp, len(read_procs))
+            print("{} calling processes, {} threads each".format(nproc_dp, threads_call))
+        print("{} reading processes of the features file".format(len(read_procs)))
+        shared_model = _get_shared_model(model_path, args)
 
         for _ in range(nproc_dp):
             p = mp.Process(target=_call_mods_q, args=(model_path, features_batch_q, pred_str_q,
-                                                      success_file, args))
+                                                      success_file, args, shared_model, threads_call))
             p.daemon = True
             p.start()
             predstr_procs.append(p)
@@ -536,15 +767,15 @@ def call_mods(args):
         p_w.daemon = True
         p_w.start()
 
-        for p in predstr_procs:
-            p.join()
+        wait_for_processes(read_procs, predstr_procs + [p_w])
+        features_batch_q.put("kill")
+
+        wait_for_processes(predstr_procs, [p_w])
 
         # print("finishing the write_process..")
         pred_str_q.put("kill")
 
-        p_rf.join()
-
-        p_w.join()
+        wait_for_processes([p_w])
 
     if os.path.exists(success_file):
         os.remove(success_file)
@@ -563,7 +794,8 @@ def main():
 
     p_call = parser.add_argument_group("CALL")
     p_call.add_argument("--model_path", "-m", action="store", type=str, required=True,
-                        help="file path of the trained model (.ckpt)")
+                        help="file path of the trained model (.ckpt), or of the exported model "
+                             "for --engine torchscript/onnx")
 
     # model input
     p_call.add_argument('--model_type', type=str, default="both_bilstm",
@@ -598,10 +830,26 @@ def main():
     # BiLSTM model param
     p_call.add_argument('--hid_rnn', type=int, default=256, required=False,
                         help="BiLSTM hidden_size for combined feature")
+    p_call.add_argument("--engine", action="store", type=str, default="eager",
+                        choices=["eager", "torchscript", "onnx"], required=False,
+                        help="the runtime to run the model, default eager (pytorch, with the .ckpt). "
+                             "torchscript/onnx run the model exported by 'deepsignal2 export', "
+                             "--model_path should be the exported model then. onnx needs the "
+                             "onnxruntime (or onnxruntime-gpu) module")
+    p_call.add_argument("--quantize", action="store", type=str, default=None,
+                        choices=["int8"], required=False,
+                        help="quantize the LSTM and Linear layers of the model (dynamic quantization) "
+                             "when the model is loaded, for --engine eager in cpu mode. faster, "
+                             "with a (small) accuracy loss, see scripts/evaluate_quantization.py. "
+                             "default None, no quantization")
 
     p_output = parser.add_argument_group("OUTPUT")
     p_output.add_argument("--result_file", "-o", action="store", type=str, required=True,
-                          help="the file path to save the predicted result")
+                          help="the file path to save the predicted result, the result is compressed "
+                               "if the file name ends with .gz (gzip), .bgz (bgzip) or .zst (zstd)")
+    p_output.add_argument("--resume", action="store_true", default=False, required=False,
+                          help="resume an interrupted run from fast5 files: reads recorded in the manifest "
+                               "(result_file.manifest) are skipped, and results are appended to result_file")
 
     p_f5 = parser.add_argument_group("FAST5_EXTRACTION")
     p_f5.add_argument("--recursively", "-r", action="store", type=str, required=False,
@@ -614,6 +862,10 @@ def main():
     p_f5.add_argument("--basecall_subgroup", action="store", type=str, required=False,
                       default='BaseCalled_template',
                       help='the corrected subgroup of fast5 files. default BaseCalled_template')
+    p_f5.add_argument("--fast5_index", action="store", type=str, required=False, default=None,
+                      help="the fast5 index of the fast5 dir built by 'deepsignal2 index', to list and "
+                           "prefilter reads from it instead of walking the fast5 dir and opening "
+                           "every fast5 file. default None")
     p_f5.add_argument("--reference_path", action="store",
                       type=str, required=False,
                       help="the reference file to be used, usually is a .fa file")
@@ -637,19 +889,34 @@ def main():
                            'can be multi motifs splited by comma '
                            '(no space allowed in the input str), '
                            'or use IUPAC alphabet, '
-                           'the mod_loc of all motifs must be '
-                           'the same')
-    p_f5.add_argument("--mod_loc", action="store", type=int, required=False, default=0,
-                      help='0-based location of the targeted base in the motif, default 0')
+                           'motifs can be of different lengths')
+    p_f5.add_argument("--mod_loc", action="store", type=str, required=False, default='0',
+                      help='0-based location of the targeted base in the motif, default 0. '
+                           'can be multi locs splited by comma, one for each motif in --motifs')
     p_f5.add_argument("--f5_batch_size", action="store", type=int, default=20,
                       required=False,
-                      help="number of files to be processed by each process one time, default 20")
+                      help="average number of reads to be processed by each process one time, "
+                           "batches are balanced by estimated cost of the reads, default 20")
+    p_f5.add_argument("--prefetch_depth", action="store", type=int, default=1,
+                      required=False,
+                      help="number of read batches each process prefetches (reads the fast5 "
+                           "data into memory) while the current batch is being processed, "
+                           "0 for no prefetching. default 1")
+    p_f5.add_argument("--io_threads", action="store", type=int, default=4,
+                      required=False,
+                      help="number of I/O threads of each process for prefetching, default 4")
     p_f5.add_argument("--positions", action="store", type=str,
                       required=False, default=None,
                       help="file with a list of positions interested (must be formatted as tab-separated file"
                            " with chromosome, position (in fwd strand), and strand. motifs/mod_loc are still "
                            "need to be set. --positions is used to narrow down the range of the trageted "
                            "motif locs. default None")
+    p_f5.add_argument("--region", action="append", type=str,
+                      required=False, default=None,
+                      help="region of interest, e.g.: chr1:0-10000 (0-based, end exclusive) or chr1, "
+                           "can be multi regions splited by comma, or a BED file. can be used "
+                           "multiple times. reads/sites outside the regions are skipped. default None, "
+                           "for the whole region")
 
     parser.add_argument("--nproc", "-p", action="store", type=int, default=10,
                         required=False, help="number of processes to be used, default 10.")
@@ -657,6 +924,24 @@ def main():
                         required=False, help="number of processes to use gpu (if gpu is available), "
                                              "1 or a number less than nproc-1, no more than "
                                              "nproc/4 is suggested. default 2.")
+    parser.add_argument("--nproc_call", action="store", type=int, default=2,
+                        required=False, help="number of processes to call modifications in cpu mode (if gpu is not "
+                                             "available), the other processes extract features. default 2")
+    parser.add_argument("--threads_call", action="store", type=int, default=0,
+                        required=False, help="number of torch threads of each calling process. default 0, in cpu "
+                                             "mode, the cpus not used by the feature extraction processes are split "
+                                             "among the calling processes; in gpu mode, the torch default")
+    parser.add_argument("--mp_start_method", action="store", type=str, default=None,
+                        choices=["spawn", "fork", "forkserver"], required=False,
+                        help="start method of the processes. default forkserver in cpu mode (spawn if not "
+                             "available), spawn in gpu mode. in cpu mode (--engine eager), the model is "
+                             "loaded once in the main process and its parameters are shared by the calling "
+                             "processes (shared memory, or copy-on-write with fork)")
+    parser.add_argument("--autotune", action="store_true", default=False, required=False,
+                        help="calibrate on the first batches before calling: measure the rate of feature "
+                             "extraction (or reading) and of calling per batch size and thread count, then "
+                             "set --batch_size, --nproc, --nproc_call/--nproc_gpu and --threads_call so that "
+                             "extraction and calling are balanced, within --nproc cpus")
     # parser.add_argument("--is_gpu", action="store", type=str, default="no", required=False,
     #                     choices=["yes", "no"], help="use gpu for tensorflow or not, default no. "
     #                                                 "If you're using a gpu machine, please set to yes. "
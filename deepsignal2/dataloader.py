@@ -1,17 +1,21 @@
 from torch.utils.data import Dataset
-import linecache
+import mmap
 import os
+import hashlib
+import tempfile
 import numpy as np
+import h5py
+
+from .utils.features_h5 import is_features_h5
+from .utils.features_h5 import sampleinfo_cols
+from .utils.compress_utils import is_compressed
+from .utils.compress_utils import decompress_file
+from .utils.compress_utils import compress_suffixes
 
 base2code_dna = {'A': 0, 'C': 1, 'G': 2, 'T': 3, 'N': 4}
 code2base_dna = {0: 'A', 1: 'C', 2: 'G', 3: 'T', 4: 'N'}
 
 
-def clear_linecache():
-    # linecache should be treated carefully
-    linecache.clearcache()
-
-
 def parse_a_line2(line):
     words = line.strip().split("\t")
 
@@ -27,20 +31,106 @@ def parse_a_line2(line):
     return sampleinfo, kmer, base_means, base_stds, base_signal_lens, k_signals, label
 
 
+def _get_line_offsets_path(filename):
+    return filename + ".idx"
+
+
+def build_line_offsets(filename, chunk_size=64 * 1024 * 1024):
+    """
+    byte offsets of the lines in filename, in one streaming pass
+    :param filename:
+    :param chunk_size: bytes read a time
+    :return: uint64 array, line i is [offsets[i], offsets[i+1]) (offsets[-1] is the end of the last line)
+    """
+    offsets = [np.zeros(1, dtype=np.uint64)]
+    pos = 0
+    last_byte = b"\n"
+    with open(filename, "rb") as rf:
+        while True:
+            chunk = rf.read(chunk_size)
+            if not chunk:
+                break
+            newlines = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord("\n"))
+            offsets.append((newlines + (pos + 1)).astype(np.uint64))
+            pos += len(chunk)
+            last_byte = chunk[-1:]
+    if last_byte != b"\n":
+        # the last line has no line break
+        offsets.append(np.array([pos], dtype=np.uint64))
+    return np.concatenate(offsets)
+
+
+def load_line_offsets(filename):
+    """
+    load the line offsets index persisted next to filename (filename.idx),
+    build and save it if it does not exist or is older than filename
+    :param filename:
+    :return:
+    """
+    idx_path = _get_line_offsets_path(filename)
+    if os.path.exists(idx_path) and os.path.getmtime(idx_path) >= os.path.getmtime(filename):
+        offsets = np.fromfile(idx_path, dtype=np.uint64)
+        if len(offsets) > 0 and offsets[-1] == os.path.getsize(filename):
+            return offsets
+    print("building line offsets index of '{}'..".format(filename))
+    offsets = build_line_offsets(filename)
+    idx_tmp = idx_path + "." + str(os.getpid()) + ".tmp"
+    try:
+        offsets.tofile(idx_tmp)
+        os.replace(idx_tmp, idx_path)
+    except (IOError, OSError):
+        # not writable dir, use the index in memory only
+        print("cannot save line offsets index to '{}'".format(idx_path))
+        if os.path.exists(idx_tmp):
+            os.remove(idx_tmp)
+    return offsets
+
+
+def load_decompressed_file(filename, tmpdir=None):
+    """
+    decompress a compressed features file into tmpdir once (reused while it is newer than
+    filename), as lines of a compressed file can not be accessed randomly
+    :return: path of the decompressed file
+    """
+    if tmpdir is None:
+        tmpdir = tempfile.gettempdir()
+    fname, fext = os.path.splitext(os.path.basename(filename))
+    if fext not in compress_suffixes:
+        fname += fext
+    decompressed_path = os.path.join(tmpdir, "{}.{}.decompressed".format(
+        fname, hashlib.md5(filename.encode("UTF-8")).hexdigest()[:8]))
+    if os.path.exists(decompressed_path) and \
+            os.path.getmtime(decompressed_path) >= os.path.getmtime(filename):
+        return decompressed_path
+    print("decompressing '{}' to '{}'..".format(filename, decompressed_path))
+    decompressed_tmp = decompressed_path + "." + str(os.getpid()) + ".tmp"
+    decompress_file(filename, decompressed_tmp)
+    os.replace(decompressed_tmp, decompressed_path)
+    return decompressed_path
+
+
 class SignalFeaData2(Dataset):
-    def __init__(self, filename, transform=None):
-        print(">>>using linecache to access '{}'<<<\n"
-              ">>>after done using the file, "
-              "remember to use linecache.clearcache() to clear cache for safety<<<".format(filename))
+    def __init__(self, filename, transform=None, tmpdir=None):
+        print(">>>using mmap and a line offsets index to access '{}'<<<".format(filename))
         self._filename = os.path.abspath(filename)
-        self._total_data = 0
+        if is_compressed(self._filename):
+            self._filename = load_decompressed_file(self._filename, tmpdir)
         self._transform = transform
-        with open(filename, "r") as f:
-            self._total_data = len(f.readlines())
+        self._offsets = load_line_offsets(self._filename)
+        self._total_data = len(self._offsets) - 1
+        self._file = None
+        self._mmap = None
+
+    def _get_mmap(self):
+        # mmap lazily, so that each DataLoader worker maps the file itself (sharing the page cache)
+        if self._mmap is None:
+            self._file = open(self._filename, "rb")
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
 
     def __getitem__(self, idx):
-        line = linecache.getline(self._filename, idx + 1)
-        if line == "":
+        line = self._get_mmap()[int(self._offsets[idx]):int(self._offsets[idx + 1])].decode("UTF-8")
+        if line.strip() == "":
             return None
         else:
             output = parse_a_line2(line)
@@ -50,3 +140,59 @@ class SignalFeaData2(Dataset):
 
     def __len__(self):
         return self._total_data
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_file'] = None
+        state['_mmap'] = None
+        return state
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+            self._mmap = None
+            self._file = None
+
+
+class SignalFeaDataH5(Dataset):
+    # features in the binary columnar format (extract --w_format h5)
+    def __init__(self, filename, transform=None):
+        self._filename = os.path.abspath(filename)
+        self._transform = transform
+        self._h5file = None
+        with h5py.File(self._filename, "r") as h5file:
+            self._total_data = len(h5file['label'])
+
+    def _get_h5file(self):
+        # open the file lazily, so that each DataLoader worker has its own handle
+        if self._h5file is None:
+            self._h5file = h5py.File(self._filename, "r")
+        return self._h5file
+
+    def __getitem__(self, idx):
+        h5file = self._get_h5file()
+        sampleinfo = []
+        for col in sampleinfo_cols:
+            col_val = h5file[col][idx]
+            sampleinfo.append(col_val.decode("UTF-8") if isinstance(col_val, bytes) else str(col_val))
+        output = ("\t".join(sampleinfo), h5file['kmer'][idx].astype(np.int64), h5file['base_means'][idx],
+                  h5file['base_stds'][idx], h5file['base_signal_lens'][idx], h5file['signals'][idx],
+                  int(h5file['label'][idx]))
+        if self._transform is not None:
+            output = self._transform(output)
+        return output
+
+    def __len__(self):
+        return self._total_data
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_h5file'] = None
+        return state
+
+
+def get_signalfea_dataset(filename, transform=None, tmpdir=None):
+    if is_features_h5(filename):
+        return SignalFeaDataH5(filename, transform)
+    return SignalFeaData2(filename, transform, tmpdir)
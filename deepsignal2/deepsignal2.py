@@ -25,6 +25,7 @@ def main_extraction(args):
     write_path = args.write_path
     w_is_dir = str2bool(args.w_is_dir)
     w_batch_num = args.w_batch_num
+    w_format = args.w_format
 
     kmer_len = args.seq_len
     signals_len = args.signal_len
@@ -35,11 +36,25 @@ def main_extraction(args):
 
     nproc = args.nproc
     f5_batch_size = args.f5_batch_size
+    resume = args.resume
+    regions = args.region
+    fast5_index = args.fast5_index
+    prefetch_depth = args.prefetch_depth
+    io_threads = args.io_threads
 
     extract_features(fast5_dir, is_recursive, reference_path, is_dna,
                      f5_batch_size, write_path, nproc, corrected_group, basecall_subgroup,
                      normalize_method, motifs, mod_loc, kmer_len, signals_len, methy_label,
-                     position_file, w_is_dir, w_batch_num)
+                     position_file, w_is_dir, w_batch_num, w_format, resume, regions, fast5_index,
+                     prefetch_depth, io_threads)
+
+
+def main_index(args):
+    from .index_fast5s import index_fast5s
+
+    display_args(args)
+    index_fast5s(args.fast5_dir, str2bool(args.recursively), args.corrected_group,
+                 args.basecall_subgroup, args.index_path, args.nproc)
 
 
 def main_call_mods(args):
@@ -49,6 +64,13 @@ def main_call_mods(args):
     call_mods(args)
 
 
+def main_export(args):
+    from .export_model import export_model
+
+    display_args(args)
+    export_model(args)
+
+
 def main_train(args):
     from .train import train
     import time
@@ -66,12 +88,16 @@ def main_train(args):
 def main():
     parser = argparse.ArgumentParser(prog='deepsignal2',
                                      description="detecting base modifications from Nanopore sequencing reads, "
-                                                 "deepsignal2 contains four modules:\n"
+                                                 "deepsignal2 contains six modules:\n"
                                                  "\t%(prog)s call_mods: call modifications\n"
+                                                 "\t%(prog)s index: build a catalog of the reads in a "
+                                                 "fast5 directory for extract/call_mods\n"
                                                  "\t%(prog)s extract: extract features from corrected (tombo) "
                                                  "fast5s for training or testing\n"
                                                  "\t%(prog)s train: train a model, need two independent "
-                                                 "datasets for training and validating",
+                                                 "datasets for training and validating\n"
+                                                 "\t%(prog)s export: export a trained model to "
+                                                 "TorchScript/ONNX for call_mods --engine",
                                      formatter_class=argparse.RawTextHelpFormatter)
 
     subparsers = parser.add_subparsers(title="modules", help='deepsignal2 modules, use -h/--help for help')
@@ -81,8 +107,12 @@ def main():
                                                                "\nIt is suggested that running this module 1 flowcell "
                                                                "a time, or a group of flowcells a time, "
                                                                "if the whole data is extremely large.")
+    sub_index = subparsers.add_parser("index", description="build a catalog (SQLite) of the reads in a fast5 "
+                                                           "directory, for extract/call_mods --fast5_index")
     sub_train = subparsers.add_parser("train", description="train a model, need two independent datasets for training "
                                                            "and validating")
+    sub_export = subparsers.add_parser("export", description="export a trained model (.ckpt) to TorchScript/ONNX, "
+                                                             "for call_mods --engine torchscript/onnx")
 
     # sub_extract ============================================================================
     se_input = sub_extract.add_argument_group("INPUT")
@@ -100,6 +130,10 @@ def main():
     se_input.add_argument("--basecall_subgroup", action="store", type=str, required=False,
                           default='BaseCalled_template',
                           help='the corrected subgroup of fast5 files. default BaseCalled_template')
+    se_input.add_argument("--fast5_index", action="store", type=str, required=False, default=None,
+                          help="the fast5 index of fast5_dir built by 'deepsignal2 index', to list and "
+                               "prefilter reads from it instead of walking fast5_dir and opening "
+                               "every fast5 file. default None")
     se_input.add_argument("--reference_path", action="store",
                           type=str, required=True,
                           help="the reference file to be used, usually is a .fa file")
@@ -131,14 +165,16 @@ def main():
                                     'can be multi motifs splited by comma '
                                     '(no space allowed in the input str), '
                                     'or use IUPAC alphabet, '
-                                    'the mod_loc of all motifs must be '
-                                    'the same')
-    se_extraction.add_argument("--mod_loc", action="store", type=int, required=False, default=0,
-                               help='0-based location of the targeted base in the motif, default 0')
-    # se_extraction.add_argument("--region", action="store", type=str,
-    #                            required=False, default=None,
-    #                            help="region of interest, e.g.: chr1:0-10000, default None, "
-    #                                 "for the whole region")
+                                    'motifs can be of different lengths')
+    se_extraction.add_argument("--mod_loc", action="store", type=str, required=False, default='0',
+                               help='0-based location of the targeted base in the motif, default 0. '
+                                    'can be multi locs splited by comma, one for each motif in --motifs')
+    se_extraction.add_argument("--region", action="append", type=str,
+                               required=False, default=None,
+                               help="region of interest, e.g.: chr1:0-10000 (0-based, end exclusive) or chr1, "
+                                    "can be multi regions splited by comma, or a BED file. can be used "
+                                    "multiple times. reads/sites outside the regions are skipped. default None, "
+                                    "for the whole region")
     se_extraction.add_argument("--positions", action="store", type=str,
                                required=False, default=None,
                                help="file with a list of positions interested (must be formatted as tab-separated file"
@@ -149,20 +185,38 @@ def main():
     se_output = sub_extract.add_argument_group("OUTPUT")
     se_output.add_argument("--write_path", "-o", action="store",
                            type=str, required=True,
-                           help='file path to save the features')
+                           help='file path to save the features, the tsv features are compressed '
+                                'if the file name ends with .gz (gzip), .bgz (bgzip) or .zst (zstd)')
     se_output.add_argument("--w_is_dir", action="store",
                            type=str, required=False, default="no",
                            help='if using a dir to save features into multiple files')
     se_output.add_argument("--w_batch_num", action="store",
                            type=int, required=False, default=200,
                            help='features batch num to save in a single writed file when --is_dir is true')
+    se_output.add_argument("--w_format", action="store", type=str, choices=["tsv", "h5"],
+                           required=False, default="tsv",
+                           help='format of the features file, tsv or h5 (binary columnar HDF5, '
+                                'faster to write and to read in call_mods/train). default tsv')
 
     sub_extract.add_argument("--nproc", "-p", action="store", type=int, default=1,
                              required=False,
                              help="number of processes to be used, default 1")
+    sub_extract.add_argument("--resume", action="store_true", default=False, required=False,
+                             help="resume an interrupted run: reads recorded in the manifest "
+                                  "(write_path.manifest) are skipped, and features are appended to "
+                                  "write_path. not supported with --w_is_dir")
     sub_extract.add_argument("--f5_batch_size", action="store", type=int, default=100,
                              required=False,
-                             help="number of files to be processed by each process one time, default 100")
+                             help="average number of reads to be processed by each process one time, "
+                                  "batches are balanced by estimated cost of the reads, default 100")
+    sub_extract.add_argument("--prefetch_depth", action="store", type=int, default=1,
+                             required=False,
+                             help="number of read batches each process prefetches (reads the fast5 "
+                                  "data into memory) while the current batch is being processed, "
+                                  "0 for no prefetching. default 1")
+    sub_extract.add_argument("--io_threads", action="store", type=int, default=4,
+                             required=False,
+                             help="number of I/O threads of each process for prefetching, default 4")
 
     sub_extract.set_defaults(func=main_extraction)
 
@@ -176,7 +230,8 @@ def main():
 
     sc_call = sub_call_mods.add_argument_group("CALL")
     sc_call.add_argument("--model_path", "-m", action="store", type=str, required=True,
-                         help="file path of the trained model (.ckpt)")
+                         help="file path of the trained model (.ckpt), or of the exported model "
+                              "for --engine torchscript/onnx")
 
     # model input
     sc_call.add_argument('--model_type', type=str, default="both_bilstm",
@@ -211,10 +266,26 @@ def main():
     # BiLSTM model param
     sc_call.add_argument('--hid_rnn', type=int, default=256, required=False,
                          help="BiLSTM hidden_size for combined feature")
+    sc_call.add_argument("--engine", action="store", type=str, default="eager",
+                         choices=["eager", "torchscript", "onnx"], required=False,
+                         help="the runtime to run the model, default eager (pytorch, with the .ckpt). "
+                              "torchscript/onnx run the model exported by 'deepsignal2 export', "
+                              "--model_path should be the exported model then. onnx needs the "
+                              "onnxruntime (or onnxruntime-gpu) module")
+    sc_call.add_argument("--quantize", action="store", type=str, default=None,
+                         choices=["int8"], required=False,
+                         help="quantize the LSTM and Linear layers of the model (dynamic quantization) "
+                              "when the model is loaded, for --engine eager in cpu mode. faster, "
+                              "with a (small) accuracy loss, see scripts/evaluate_quantization.py. "
+                              "default None, no quantization")
 
     sc_output = sub_call_mods.add_argument_group("OUTPUT")
     sc_output.add_argument("--result_file", "-o", action="store", type=str, required=True,
-                           help="the file path to save the predicted result")
+                           help="the file path to save the predicted result, the result is compressed "
+                                "if the file name ends with .gz (gzip), .bgz (bgzip) or .zst (zstd)")
+    sc_output.add_argument("--resume", action="store_true", default=False, required=False,
+                           help="resume an interrupted run from fast5 files: reads recorded in the manifest "
+                                "(result_file.manifest) are skipped, and results are appended to result_file")
 
     sc_f5 = sub_call_mods.add_argument_group("FAST5_EXTRACTION")
     sc_f5.add_argument("--recursively", "-r", action="store", type=str, required=False,
@@ -227,6 +298,10 @@ def main():
     sc_f5.add_argument("--basecall_subgroup", action="store", type=str, required=False,
                        default='BaseCalled_template',
                        help='the corrected subgroup of fast5 files. default BaseCalled_template')
+    sc_f5.add_argument("--fast5_index", action="store", type=str, required=False, default=None,
+                       help="the fast5 index of the fast5 dir built by 'deepsignal2 index', to list and "
+                            "prefilter reads from it instead of walking the fast5 dir and opening "
+                            "every fast5 file. default None")
     sc_f5.add_argument("--reference_path", action="store",
                        type=str, required=False,
                        help="the reference file to be used, usually is a .fa file")
@@ -250,19 +325,34 @@ def main():
                             'can be multi motifs splited by comma '
                             '(no space allowed in the input str), '
                             'or use IUPAC alphabet, '
-                            'the mod_loc of all motifs must be '
-                            'the same')
-    sc_f5.add_argument("--mod_loc", action="store", type=int, required=False, default=0,
-                       help='0-based location of the targeted base in the motif, default 0')
+                            'motifs can be of different lengths')
+    sc_f5.add_argument("--mod_loc", action="store", type=str, required=False, default='0',
+                       help='0-based location of the targeted base in the motif, default 0. '
+                            'can be multi locs splited by comma, one for each motif in --motifs')
     sc_f5.add_argument("--f5_batch_size", action="store", type=int, default=20,
                        required=False,
-                       help="number of files to be processed by each process one time, default 20")
+                       help="average number of reads to be processed by each process one time, "
+                            "batches are balanced by estimated cost of the reads, default 20")
+    sc_f5.add_argument("--prefetch_depth", action="store", type=int, default=1,
+                       required=False,
+                       help="number of read batches each process prefetches (reads the fast5 "
+                            "data into memory) while the current batch is being processed, "
+                            "0 for no prefetching. default 1")
+    sc_f5.add_argument("--io_threads", action="store", type=int, default=4,
+                       required=False,
+                       help="number of I/O threads of each process for prefetching, default 4")
     sc_f5.add_argument("--positions", action="store", type=str,
                        required=False, default=None,
                        help="file with a list of positions interested (must be formatted as tab-separated file"
                             " with chromosome, position (in fwd strand), and strand. motifs/mod_loc are still "
                             "need to be set. --positions is used to narrow down the range of the trageted "
                             "motif locs. default None")
+    sc_f5.add_argument("--region", action="append", type=str,
+                       required=False, default=None,
+                       help="region of interest, e.g.: chr1:0-10000 (0-based, end exclusive) or chr1, "
+                            "can be multi regions splited by comma, or a BED file. can be used "
+                            "multiple times. reads/sites outside the regions are skipped. default None, "
+                            "for the whole region")
 
     sub_call_mods.add_argument("--nproc", "-p", action="store", type=int, default=10,
                                required=False, help="number of processes to be used, default 10.")
@@ -270,9 +360,56 @@ def main():
                                required=False, help="number of processes to use gpu (if gpu is available), "
                                                     "1 or a number less than nproc-1, no more than "
                                                     "nproc/4 is suggested. default 2.")
+    sub_call_mods.add_argument("--nproc_call", action="store", type=int, default=2,
+                               required=False, help="number of processes to call modifications in cpu mode (if gpu is not "
+                                                    "available), the other processes extract features. default 2")
+    sub_call_mods.add_argument("--threads_call", action="store", type=int, default=0,
+                               required=False, help="number of torch threads of each calling process. default 0, in cpu "
+                                                    "mode, the cpus not used by the feature extraction processes are split "
+                                                    "among the calling processes; in gpu mode, the torch default")
+    sub_call_mods.add_argument("--mp_start_method", action="store", type=str, default=None,
+                               choices=["spawn", "fork", "forkserver"], required=False,
+                               help="start method of the processes. default forkserver in cpu mode (spawn if not "
+                                    "available), spawn in gpu mode. in cpu mode (--engine eager), the model is "
+                                    "loaded once in the main process and its parameters are shared by the calling "
+                                    "processes (shared memory, or copy-on-write with fork)")
+    sub_call_mods.add_argument("--autotune", action="store_true", default=False, required=False,
+                               help="calibrate on the first batches before calling: measure the rate of feature "
+                                    "extraction (or reading) and of calling per batch size and thread count, then "
+                                    "set --batch_size, --nproc, --nproc_call/--nproc_gpu and --threads_call so that "
+                                    "extraction and calling are balanced, within --nproc cpus")
 
     sub_call_mods.set_defaults(func=main_call_mods)
 
+    # sub_index =============================================================================================
+    si_input = sub_index.add_argument_group("INPUT")
+    si_input.add_argument("--fast5_dir", "-i", action="store", type=str,
+                          required=True,
+                          help="the directory of fast5 files")
+    si_input.add_argument("--recursively", "-r", action="store", type=str, required=False,
+                          default='yes',
+                          help='is to find fast5 files from fast5_dir recursively. '
+                               'default true, t, yes, 1')
+    si_input.add_argument("--corrected_group", action="store", type=str, required=False,
+                          default='RawGenomeCorrected_000',
+                          help='the corrected_group of fast5 files after '
+                               'tombo re-squiggle. default RawGenomeCorrected_000')
+    si_input.add_argument("--basecall_subgroup", action="store", type=str, required=False,
+                          default='BaseCalled_template',
+                          help='the corrected subgroup of fast5 files. default BaseCalled_template')
+
+    si_output = sub_index.add_argument_group("OUTPUT")
+    si_output.add_argument("--index_path", "-o", action="store", type=str, required=False,
+                           default=None,
+                           help="file path to save the index, default fast5_dir.index.sqlite "
+                                "(next to fast5_dir)")
+
+    sub_index.add_argument("--nproc", "-p", action="store", type=int, default=1,
+                           required=False,
+                           help="number of processes to be used, default 1")
+
+    sub_index.set_defaults(func=main_index)
+
     # sub_train =====================================================================================
     st_input = sub_train.add_argument_group("INPUT")
     st_input.add_argument('--train_file', type=str, required=True)
@@ -327,10 +464,66 @@ def main():
     # st_train.add_argument('--seed', type=int, default=1234,
     #                        help='random seed')
     # else
-    st_train.add_argument('--tmpdir', type=str, default="/tmp", required=False)
+    st_train.add_argument('--tmpdir', type=str, default="/tmp", required=False,
+                          help="dir to keep the decompressed copies of compressed (.gz/.bgz/.zst) "
+                               "train/valid files, default /tmp")
 
     sub_train.set_defaults(func=main_train)
 
+    # sub_export =====================================================================================
+    sx_input = sub_export.add_argument_group("INPUT")
+    sx_input.add_argument("--model_path", "-m", action="store", type=str, required=True,
+                          help="file path of the trained model (.ckpt)")
+
+    # model input
+    sx_input.add_argument('--model_type', type=str, default="both_bilstm",
+                          choices=["both_bilstm", "seq_bilstm", "signal_bilstm"],
+                          required=False,
+                          help="type of model to use, 'both_bilstm', 'seq_bilstm' or 'signal_bilstm', "
+                               "'both_bilstm' means to use both seq and signal bilstm, default: both_bilstm")
+    sx_input.add_argument('--seq_len', type=int, default=17, required=False,
+                          help="len of kmer. default 17")
+    sx_input.add_argument('--signal_len', type=int, default=16, required=False,
+                          help="signal num of one base, default 16")
+
+    # model param
+    sx_input.add_argument('--layernum1', type=int, default=3,
+                          required=False, help="lstm layer num for combined feature, default 3")
+    sx_input.add_argument('--layernum2', type=int, default=1,
+                          required=False, help="lstm layer num for seq feature (and for signal feature too), "
+                                               "default 1")
+    sx_input.add_argument('--class_num', type=int, default=2, required=False)
+    sx_input.add_argument('--dropout_rate', type=float, default=0, required=False)
+    sx_input.add_argument('--n_vocab', type=int, default=16, required=False,
+                          help="base_seq vocab_size (15 base kinds from iupac)")
+    sx_input.add_argument('--n_embed', type=int, default=4, required=False,
+                          help="base_seq embedding_size")
+    sx_input.add_argument('--is_base', type=str, default="yes", required=False,
+                          help="is using base features in seq model, default yes")
+    sx_input.add_argument('--is_signallen', type=str, default="yes", required=False,
+                          help="is using signal length feature of each base in seq model, default yes")
+
+    # BiLSTM model param
+    sx_input.add_argument('--hid_rnn', type=int, default=256, required=False,
+                          help="BiLSTM hidden_size for combined feature")
+
+    sx_output = sub_export.add_argument_group("OUTPUT")
+    sx_output.add_argument("--output_prefix", "-o", action="store", type=str, required=True,
+                           help="prefix of the exported model files, the TorchScript model is saved in "
+                                "[output_prefix].torchscript.pt, the ONNX model in [output_prefix].onnx")
+    sx_output.add_argument("--format", action="store", type=str, default="torchscript",
+                           choices=["torchscript", "onnx", "all"], required=False,
+                           help="format(s) to export, default torchscript. onnx needs the onnx and "
+                                "onnxruntime modules")
+    sx_output.add_argument("--batch_size", "-b", default=512, type=int, required=False,
+                           action="store", help="batch size of the example batch to trace the model, "
+                                                "default 512. the exported models take any batch size")
+    sx_output.add_argument("--parity_tol", action="store", type=float, default=1e-4, required=False,
+                           help="max absolute difference allowed between the probs of an exported model "
+                                "and the eager model, default 1e-4")
+
+    sub_export.set_defaults(func=main_export)
+
     args = parser.parse_args()
     if hasattr(args, 'func'):
         args.func(args)
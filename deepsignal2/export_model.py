@@ -0,0 +1,117 @@
+"""
+export a trained model (.ckpt) with its hyperparameters to TorchScript and/or ONNX, for
+call_mods --engine torchscript/onnx. the outputs of each exported model are checked against
+the outputs of the eager model.
+"""
+
+from __future__ import absolute_import
+
+import sys
+import argparse
+import time
+import numpy as np
+
+from .inference import load_model
+from .inference import export_torchscript
+from .inference import export_onnx
+from .inference import get_example_batch
+from .inference import get_inference_engine
+from .inference import InferenceEngine
+from .utils.process_utils import display_args
+
+export_suffixes = {"torchscript": ".torchscript.pt", "onnx": ".onnx"}
+_export_funcs = {"torchscript": export_torchscript, "onnx": export_onnx}
+
+
+def check_parity(engine, export_path, eager_engine, args, batch_size=100):
+    """
+    max absolute difference of the probabilities predicted by the exported model and the eager model,
+    on a random batch (of a different batch size from the example batch of export)
+    """
+    batch = get_example_batch(batch_size, args.seq_len, args.signal_len, seed=1)
+    probs_exported = get_inference_engine(engine, export_path, args).predict(*batch)
+    probs_eager = eager_engine.predict(*batch)
+    return float(np.max(np.abs(probs_exported - probs_eager)))
+
+
+def export_model(args):
+    print("[main]export_model starts..")
+    start = time.time()
+
+    model = load_model(args.model_path, args).cpu()
+    eager_engine = InferenceEngine(model)
+    formats = ["torchscript", "onnx"] if args.format == "all" else [args.format]
+    for export_format in formats:
+        export_path = args.output_prefix + export_suffixes[export_format]
+        _export_funcs[export_format](model, args, export_path, args.batch_size)
+        max_diff = check_parity(export_format, export_path, eager_engine, args)
+        print("{} model saved in {}, max diff of probs to the eager model: {:.3g}".format(export_format,
+                                                                                       export_path, max_diff))
+        if max_diff > args.parity_tol:
+            raise ValueError("the outputs of the {} model differ from the eager model by {:.3g} "
+                             "(> --parity_tol {})".format(export_format, max_diff, args.parity_tol))
+
+    print("[main]export_model costs %.2f seconds.." % (time.time() - start))
+
+
+def main():
+    parser = argparse.ArgumentParser("export a trained model to TorchScript/ONNX, for call_mods --engine")
+    p_input = parser.add_argument_group("INPUT")
+    p_input.add_argument("--model_path", "-m", action="store", type=str, required=True,
+                         help="file path of the trained model (.ckpt)")
+
+    # model input
+    p_input.add_argument('--model_type', type=str, default="both_bilstm",
+                         choices=["both_bilstm", "seq_bilstm", "signal_bilstm"],
+                         required=False,
+                         help="type of model to use, 'both_bilstm', 'seq_bilstm' or 'signal_bilstm', "
+                              "'both_bilstm' means to use both seq and signal bilstm, default: both_bilstm")
+    p_input.add_argument('--seq_len', type=int, default=17, required=False,
+                         help="len of kmer. default 17")
+    p_input.add_argument('--signal_len', type=int, default=16, required=False,
+                         help="signal num of one base, default 16")
+
+    # model param
+    p_input.add_argument('--layernum1', type=int, default=3,
+                         required=False, help="lstm layer num for combined feature, default 3")
+    p_input.add_argument('--layernum2', type=int, default=1,
+                         required=False, help="lstm layer num for seq feature (and for signal feature too), "
+                                              "default 1")
+    p_input.add_argument('--class_num', type=int, default=2, required=False)
+    p_input.add_argument('--dropout_rate', type=float, default=0, required=False)
+    p_input.add_argument('--n_vocab', type=int, default=16, required=False,
+                         help="base_seq vocab_size (15 base kinds from iupac)")
+    p_input.add_argument('--n_embed', type=int, default=4, required=False,
+                         help="base_seq embedding_size")
+    p_input.add_argument('--is_base', type=str, default="yes", required=False,
+                         help="is using base features in seq model, default yes")
+    p_input.add_argument('--is_signallen', type=str, default="yes", required=False,
+                         help="is using signal length feature of each base in seq model, default yes")
+
+    # BiLSTM model param
+    p_input.add_argument('--hid_rnn', type=int, default=256, required=False,
+                         help="BiLSTM hidden_size for combined feature")
+
+    p_output = parser.add_argument_group("OUTPUT")
+    p_output.add_argument("--output_prefix", "-o", action="store", type=str, required=True,
+                          help="prefix of the exported model files, the TorchScript model is saved in "
+                               "[output_prefix].torchscript.pt, the ONNX model in [output_prefix].onnx")
+    p_output.add_argument("--format", action="store", type=str, default="torchscript",
+                          choices=["torchscript", "onnx", "all"], required=False,
+                          help="format(s) to export, default torchscript. onnx needs the onnx and "
+                               "onnxruntime modules")
+    p_output.add_argument("--batch_size", "-b", default=512, type=int, required=False,
+                          action="store", help="batch size of the example batch to trace the model, "
+                                               "default 512. the exported models take any batch size")
+    p_output.add_argument("--parity_tol", action="store", type=float, default=1e-4, required=False,
+                          help="max absolute difference allowed between the probs of an exported model "
+                               "and the eager model, default 1e-4")
+
+    args = parser.parse_args()
+    display_args(args)
+
+    export_model(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
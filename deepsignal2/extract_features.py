@@ -10,150 +10,91 @@ import sys
 import os
 import argparse
 import time
-import h5py
-import random
+import zlib
 import numpy as np
 import multiprocessing as mp
 # from utils.process_utils import Queue
 from multiprocessing import Queue
-from statsmodels import robust
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from .utils.process_utils import str2bool
 from .utils.process_utils import display_args
 from .utils.process_utils import get_fast5s
-from .utils.process_utils import get_refloc_of_methysite_in_motif
-from .utils.process_utils import get_motif_seqs
+from .utils.process_utils import MotifScanner
+from .utils.process_utils import is_kill_signal
+from .utils.process_utils import wait_for_processes
 
 from .utils.ref_reader import get_contig2len
+from .utils.fast5_reader import iter_fast5_reads
+from .utils.fast5_reader import prefetch_fast5
+from .utils.fast5_reader import get_fast5_read_items_n_costs
+from .utils.fast5_reader import schedule_read_batches
+from .utils.features_h5 import kmers_to_codes
+from .utils.features_h5 import codes_to_kmers
+from .utils.features_h5 import concat_features_arrays
+from .utils.features_h5 import get_sampleinfo_strs
+from .utils.features_h5 import FeaturesH5Writer
+from .utils.intervals import read_position_file
+from .utils.intervals import parse_regions
+from .utils.fast5_index import read_fast5_index
+from .utils.intervals import combine_site_filters
+from .utils.manifest import ManifestWriter
+from .utils.manifest import get_manifest_path
+from .utils.manifest import prepare_resume
+from .utils.compress_utils import TextResultWriter
 
-reads_group = 'Raw/Reads'
 queen_size_border = 2000
-time_wait = 3
 # MAX_LEGAL_SIGNAL_NUM = 800  # 800 only for 17-mer
 
-key_sep = "||"
+# the MAD of the standard normal distribution, as in statsmodels.robust.mad
+mad_normal_const = 0.6744897501960817
 
 
-def _get_label_raw(fast5_fn, correct_group, correct_subgroup):
-    try:
-        fast5_data = h5py.File(fast5_fn, 'r')
-    except IOError:
-        raise IOError('Error opening file. Likely a corrupted file.')
-
-    # Get raw data
-    try:
-        raw_dat = list(fast5_data[reads_group].values())[0]
-        # raw_attrs = raw_dat.attrs
-        # raw_dat = raw_dat['Signal'].value
-        raw_dat = raw_dat['Signal'][()]
-    except Exception:
-        fast5_data.close()
-        raise RuntimeError('Raw data is not stored in Raw/Reads/Read_[read#] so '
-                           'new segments cannot be identified.')
-
-    # Get Events
-    try:
-        event = fast5_data['/Analyses/'+correct_group + '/' + correct_subgroup + '/Events']
-        # print(event)
-    except Exception:
-        fast5_data.close()
-        raise RuntimeError('events not found.')
-
-    try:
-        corr_attrs = dict(list(event.attrs.items()))
-        read_start_rel_to_raw = corr_attrs['read_start_rel_to_raw']
-        # print('read_start_rel_to_raw: ',read_start_rel_to_raw)
-        starts = list(map(lambda x: x + read_start_rel_to_raw, event['start']))
-    except KeyError:
-        fast5_data.close()
-        raise KeyError('no read_start_rel_to_raw in event attributes')
-
-    lengths = event['length'].astype(np.int)
-    base = [x.decode("UTF-8") for x in event['base']]
-    assert len(starts) == len(lengths)
-    assert len(lengths) == len(base)
-    events = list(zip(starts, lengths, base))
-    fast5_data.close()
-    return raw_dat, events
-
-
-def _get_alignment_attrs_of_each_strand(strand_path, h5obj):
-    strand_basecall_group_alignment = h5obj['/'.join([strand_path, 'Alignment'])]
-    alignment_attrs = strand_basecall_group_alignment.attrs
-    # attr_names = list(alignment_attrs.keys())
-
-    if strand_path.endswith('template'):
-        strand = 't'
-    else:
-        strand = 'c'
-    if sys.version_info[0] >= 3:
-        try:
-            alignstrand = str(alignment_attrs['mapped_strand'], 'utf-8')
-            chrom = str(alignment_attrs['mapped_chrom'], 'utf-8')
-        except TypeError:
-            alignstrand = alignment_attrs['mapped_strand']
-            alignstrand = str(alignstrand) if type(alignstrand) is not str else alignstrand
-            chrom = alignment_attrs['mapped_chrom']
-            chrom_val_type = type(chrom)
-            chrom = str(chrom) if chrom_val_type is not str else chrom
-            if chrom_val_type is bytes and chrom.startswith("b'"):
-                chrom = chrom.split("'")[1]
-    else:
-        alignstrand = str(alignment_attrs['mapped_strand'])
-        chrom = alignment_attrs['mapped_chrom']
-        chrom_val_type = type(chrom)
-        chrom = str(chrom) if chrom_val_type is not str else chrom
-        if chrom_val_type is bytes and chrom.startswith("b'"):
-            chrom = chrom.split("'")[1]
-    chrom_start = alignment_attrs['mapped_start']
+def _get_kth_of_counts(counts_cum, k):
+    # the k-th (0-based) smallest value of the values counted by counts (counts_cum is its cumsum)
+    return int(np.searchsorted(counts_cum, k, side='right'))
 
-    return strand, alignstrand, chrom, chrom_start
 
-
-def _get_readid_from_fast5(h5file):
-    first_read = list(h5file[reads_group].keys())[0]
-    if sys.version_info[0] >= 3:
-        try:
-            read_id = str(h5file['/'.join([reads_group, first_read])].attrs['read_id'], 'utf-8')
-        except TypeError:
-            read_id = str(h5file['/'.join([reads_group, first_read])].attrs['read_id'])
-    else:
-        read_id = str(h5file['/'.join([reads_group, first_read])].attrs['read_id'])
-    # print(read_id)
-    return read_id
-
-
-def _get_alignment_info_from_fast5(fast5_path, corrected_group='RawGenomeCorrected_000',
-                                   basecall_subgroup='BaseCalled_template'):
-    try:
-        h5file = h5py.File(fast5_path, mode='r')
-        corrgroup_path = '/'.join(['Analyses', corrected_group])
-
-        if '/'.join([corrgroup_path, basecall_subgroup, 'Alignment']) in h5file:
-            # fileprefix = os.path.basename(fast5_path).split('.fast5')[0]
-            readname = _get_readid_from_fast5(h5file)
-            strand, alignstrand, chrom, chrom_start = _get_alignment_attrs_of_each_strand('/'.join([corrgroup_path,
-                                                                                                    basecall_subgroup]),
-                                                                                          h5file)
-
-            h5file.close()
-            return readname, strand, alignstrand, chrom, chrom_start
-        else:
-            return '', '', '', '', ''
-    except IOError:
-        print("the {} can't be opened".format(fast5_path))
-        return '', '', '', '', ''
-
-
-def _normalize_signals(signals, normalize_method="mad"):
+def _get_median_n_mad(dac_signals):
+    """
+    median and MAD (not scaled to the normal distribution) of integer (DAC) signals, by counting
+    the values (np.bincount, O(n)) instead of sorting the signals twice
+    :param dac_signals: int array
+    :return: median, MAD
+    """
+    sig_num = len(dac_signals)
+    dac_min = int(dac_signals.min())
+    counts_cum = np.cumsum(np.bincount(dac_signals.astype(np.int64) - dac_min))
+    # twice the median (relative to dac_min), to keep the values integers
+    median2 = _get_kth_of_counts(counts_cum, (sig_num - 1) // 2) + _get_kth_of_counts(counts_cum, sig_num // 2)
+    # counts of twice the absolute deviations, from the counts of the values
+    dev2_counts = np.bincount(np.abs(2 * np.arange(len(counts_cum)) - median2),
+                              weights=np.diff(counts_cum, prepend=0))
+    dev2_counts_cum = np.cumsum(dev2_counts)
+    mad4 = _get_kth_of_counts(dev2_counts_cum, (sig_num - 1) // 2) + \
+        _get_kth_of_counts(dev2_counts_cum, sig_num // 2)
+    return median2 / 2. + dac_min, mad4 / 4.
+
+
+def _normalize_signals(dac_signals, normalize_method="mad"):
+    """
+    normalize the raw signals of a read. the scaling and offset (from DAC values to pA) of the read
+    cancel out in the normalization, so the median/MAD (or mean/std) are computed on the int16 DAC
+    values directly, and the signals are not rescaled
+    :param dac_signals: int16 DAC values of a read
+    :param normalize_method: mad or zscore
+    :return: float32 array
+    """
     if normalize_method == 'zscore':
-        sshift, sscale = np.mean(signals), np.float(np.std(signals))
+        sshift, sscale = np.mean(dac_signals), float(np.std(dac_signals))
     elif normalize_method == 'mad':
-        sshift, sscale = np.median(signals), np.float(robust.mad(signals))
+        sshift, sscale = _get_median_n_mad(dac_signals)
+        sscale /= mad_normal_const
     else:
         raise ValueError("")
-    norm_signals = (signals - sshift) / sscale
-    return np.around(norm_signals, decimals=6)
+    norm_signals = (dac_signals - sshift) / sscale
+    return np.around(norm_signals, decimals=6).astype(np.float32)
 
 
 # def _get_central_signals(signals_list, rawsignal_num=360):
@@ -195,185 +136,314 @@ def _normalize_signals(signals, normalize_method="mad"):
 #     return cent_signals
 
 
-def _get_signals_rect(signals_list, signals_len=16):
-    signals_rect = []
-    for signals_tmp in signals_list:
-        signals = list(np.around(signals_tmp, decimals=6))
-        if len(signals) < signals_len:
-            pad0_len = signals_len - len(signals)
-            pad0_left = pad0_len // 2
-            pad0_right = pad0_len - pad0_left
-            signals = [0.] * pad0_left + signals + [0.] * pad0_right
-        elif len(signals) > signals_len:
-            signals = [signals[x] for x in sorted(random.sample(range(len(signals)),
-                                                                signals_len))]
-        signals_rect.append(signals)
-    return signals_rect
-
-
-def _get_scaling_of_a_read(fast5fp):
-    global_key = "UniqueGlobalKey/"
-    try:
-        h5file = h5py.File(fast5fp, mode='r')
-        channel_info = dict(list(h5file[global_key + 'channel_id'].attrs.items()))
-        digi = channel_info['digitisation']
-        parange = channel_info['range']
-        offset = channel_info['offset']
-        scaling = parange / digi
+def _get_signals_rect(norm_signals, base_starts, base_lens, signals_len=16, rng=None):
+    """
+    signals of a batch of bases as a rectangle, bases with less than signals_len signals are
+    centre-padded with 0, bases with more signals are down-sampled randomly (in order).
+    :param norm_signals: normalized signals of the read
+    :param base_starts: start of each base in norm_signals, any shape, e.g. (n_sites, kmer_len)
+    :param base_lens: signal num of each base, the same shape as base_starts
+    :param signals_len:
+    :param rng: np.random.Generator used for down-sampling
+    :return: float32 array of shape base_starts.shape + (signals_len, )
+    """
+    base_starts = np.asarray(base_starts, dtype=np.int64)
+    base_lens = np.asarray(base_lens, dtype=np.int64)
+    out_shape = base_starts.shape + (signals_len, )
+    base_starts, base_lens = base_starts.ravel(), base_lens.ravel()
+    if rng is None:
+        rng = np.random.default_rng()
+
+    signals_rect = np.zeros((len(base_lens), signals_len), dtype=np.float32)
+    col_idxs = np.arange(signals_len)
+
+    is_short = base_lens <= signals_len
+    if np.any(is_short):
+        s_lens = base_lens[is_short]
+        s_offsets = col_idxs - ((signals_len - s_lens) // 2)[:, None]
+        s_mask = (s_offsets >= 0) & (s_offsets < s_lens[:, None])
+        s_idxs = base_starts[is_short][:, None] + np.where(s_mask, s_offsets, 0)
+        signals_rect[is_short] = np.where(s_mask, norm_signals[s_idxs], 0.)
+
+    is_long = ~is_short
+    if np.any(is_long):
+        l_lens = base_lens[is_long]
+        max_len = int(l_lens.max())
+        # signals_len distinct random offsets of each base: the ones with the smallest random keys
+        rand_keys = rng.random((len(l_lens), max_len))
+        rand_keys[np.arange(max_len) >= l_lens[:, None]] = 2.
+        l_offsets = np.sort(np.argpartition(rand_keys, signals_len - 1, axis=1)[:, :signals_len], axis=1)
+        signals_rect[is_long] = norm_signals[base_starts[is_long][:, None] + l_offsets]
+    return signals_rect.reshape(out_shape)
+
+
+def _get_base_signal_stats(norm_signals, event_starts, event_lens):
+    """
+    mean, std and signal num of each base of a read, computed once per read with
+    reduceat over the event boundaries, instead of np.mean/np.std per base per site
+    :param norm_signals: normalized signals of the read
+    :param event_starts: start of each base in norm_signals
+    :param event_lens: signal num of each base
+    :return: base_means, base_stds, base_lens
+    """
+    base_lens = np.asarray(event_lens, dtype=np.int64)
+    total_len = int(base_lens.sum())
+    if total_len == 0:
+        return np.zeros(len(base_lens)), np.zeros(len(base_lens)), base_lens
+    # gather the signals of all bases into a contiguous array, segments start at seg_starts
+    seg_starts = np.cumsum(base_lens) - base_lens
+    base_signals = norm_signals[np.arange(total_len) + np.repeat(event_starts - seg_starts, base_lens)]
+
+    seg_idxs = np.minimum(seg_starts, total_len - 1)
+    divisors = np.maximum(base_lens, 1)
+    # accumulated in float64, the signals are float32
+    base_means = np.add.reduceat(base_signals, seg_idxs, dtype=np.float64) / divisors
+    base_devs = base_signals - np.repeat(base_means, base_lens)
+    base_stds = np.sqrt(np.add.reduceat(base_devs * base_devs, seg_idxs) / divisors)
+    if np.any(base_lens == 0):
+        base_means[base_lens == 0] = 0.
+        base_stds[base_lens == 0] = 0.
+    return base_means, base_stds, base_lens
+
+
+def _get_windows(base_arr, kmer_len):
+    """
+    all kmer windows of a per-base array as a strided view (no copy)
+    :param base_arr: array of shape (read_len, ...)
+    :return: read-only view of shape (read_len - kmer_len + 1, kmer_len, ...)
+    """
+    win_num = base_arr.shape[0] - kmer_len + 1
+    return np.lib.stride_tricks.as_strided(base_arr, shape=(win_num, kmer_len) + base_arr.shape[1:],
+                                           strides=(base_arr.strides[0], ) + base_arr.strides,
+                                           writeable=False)
+
+
+def _get_window_bases(read_len, k_starts, kmer_len):
+    """ bool array of the bases covered by any of the kmer windows starting at k_starts """
+    covers = np.zeros(read_len + 1, dtype=np.int64)
+    np.add.at(covers, k_starts, 1)
+    np.add.at(covers, k_starts + kmer_len, -1)
+    return np.cumsum(covers[:read_len]) > 0
+
+
+def _extract_read_features(read, normalize_method, motif_scanner, chrom2len, kmer_len, signals_len,
+                           methy_label, positions):
+    """
+    features of the targeted sites of a read. the read is turned into per-base arrays once (base codes,
+    means, stds, lens, signals of shape (read_len, signals_len)), the features of the sites are their
+    kmer windows of the per-base arrays, gathered by one fancy-indexing per column
+    :return: dict of column arrays (see utils.features_h5.features_cols), None if no targeted site
+    """
+    norm_signals = _normalize_signals(read.raw_signal, normalize_method)
+    genomeseq = read.bases
+
+    readname, strand, alignstrand = read.readname, read.strand, read.alignstrand
+    chrom, chrom_start = read.chrom, read.chrom_start
 
-        h5file.close()
-        # print(scaling, offset)
-        return scaling, offset
-    except IOError:
-        print("the {} can't be opened".format(fast5fp))
-        return None, None
+    chromlen = chrom2len[chrom]
+    if alignstrand == '+':
+        chrom_start_in_alignstrand = chrom_start
+    else:
+        chrom_start_in_alignstrand = chromlen - (chrom_start + len(genomeseq))
+
+    tsite_locs = motif_scanner.scan(genomeseq)
 
+    if kmer_len % 2 == 0:
+        raise ValueError("kmer_len must be odd")
+    num_bases = (kmer_len - 1) // 2
 
-def _rescale_signals(rawsignals, scaling, offset):
-    return np.array(scaling * (rawsignals + offset), dtype=np.float)
+    tsite_locs = tsite_locs[(tsite_locs >= num_bases) & (tsite_locs < len(genomeseq) - num_bases)]
+    locs_in_ref = tsite_locs + chrom_start_in_alignstrand
+    # cpgid = readname + chrom + alignstrand + str(cpgloc_in_ref) + strand
+    if alignstrand == '-':
+        poses = chromlen - 1 - locs_in_ref
+    else:
+        poses = locs_in_ref
+    if positions is not None:
+        is_wanted = positions.contains(chrom, alignstrand, poses)
+        tsite_locs, locs_in_ref, poses = tsite_locs[is_wanted], locs_in_ref[is_wanted], poses[is_wanted]
+    if len(tsite_locs) == 0:
+        return None
+    k_starts = tsite_locs - num_bases
+
+    # per-base arrays of the read
+    base_codes = kmers_to_codes([genomeseq])[0]
+    base_means, base_stds, base_lens = _get_base_signal_stats(norm_signals, read.event_starts, read.event_lens)
+    # signals of the bases in any kmer window, a base shared by neighbouring sites is down-sampled once,
+    # with a generator seeded by the readname, so that the output is reproducible
+    is_used = _get_window_bases(len(genomeseq), k_starts, kmer_len)
+    rng = np.random.default_rng(zlib.crc32(readname.encode("UTF-8")))
+    # cent_signals = _get_central_signals(k_signals, raw_signals_len)
+    base_signals = np.zeros((len(genomeseq), signals_len), dtype=np.float32)
+    base_signals[is_used] = _get_signals_rect(norm_signals, read.event_starts[is_used], read.event_lens[is_used],
+                                              signals_len, rng)
+
+    site_num = len(k_starts)
+    return {'chrom': [chrom] * site_num,
+            'pos': poses,
+            'strand': [alignstrand] * site_num,
+            'pos_in_strand': locs_in_ref,
+            'readname': [readname] * site_num,
+            'read_strand': [strand] * site_num,
+            'kmer': _get_windows(base_codes, kmer_len)[k_starts],
+            'base_means': _get_windows(base_means, kmer_len)[k_starts],
+            'base_stds': _get_windows(base_stds, kmer_len)[k_starts],
+            'base_signal_lens': _get_windows(base_lens.astype(np.int32), kmer_len)[k_starts],
+            'signals': _get_windows(base_signals, kmer_len)[k_starts],
+            'label': np.full(site_num, methy_label, dtype=np.int8)}
 
 
 def _extract_features(fast5s, corrected_group, basecall_subgroup, normalize_method,
-                      motif_seqs, methyloc, chrom2len, kmer_len, signals_len,
-                      methy_label, positions):
-    features_list = []
+                      motif_scanner, chrom2len, kmer_len, signals_len,
+                      methy_label, positions, fast5_bytes=None):
+    """
+    :param fast5s: a batch of (fast5_path, read_keys), read_keys is None for single-read fast5s
+    :param fast5_bytes: dict of fast5_path -> content of the fast5 file prefetched into memory
+    :return: features of all targeted sites in the reads (dict of column arrays), number of reads failed
+    """
+    read_features = []
     error = 0
-    for fast5_fp in fast5s:
+    # reads with no position of interest in their aligned interval are skipped before loading the signal
+    read_filter = positions.has_site_in if positions is not None else None
+    for fast5_fp, read_keys in fast5s:
         try:
-            raw_signal, events = _get_label_raw(fast5_fp, corrected_group, basecall_subgroup)
-
-            scaling, offset = _get_scaling_of_a_read(fast5_fp)
-            if scaling is None:
-                continue
-            else:
-                raw_signal = _rescale_signals(raw_signal, scaling, offset)
-
-            norm_signals = _normalize_signals(raw_signal, normalize_method)
-            genomeseq, signal_list = "", []
-            for e in events:
-                genomeseq += str(e[2])
-                signal_list.append(norm_signals[e[0]:(e[0] + e[1])])
-
-            readname, strand, alignstrand, chrom, \
-                chrom_start = _get_alignment_info_from_fast5(fast5_fp, corrected_group, basecall_subgroup)
-
-            chromlen = chrom2len[chrom]
-            if alignstrand == '+':
-                chrom_start_in_alignstrand = chrom_start
-            else:
-                chrom_start_in_alignstrand = chromlen - (chrom_start + len(genomeseq))
-
-            # tsite_locs = []
-            # for mseq in motif_seqs:
-            #     tsite_locs += get_refloc_of_methysite_in_motif(genomeseq, mseq, methyloc)
-            tsite_locs = get_refloc_of_methysite_in_motif(genomeseq, set(motif_seqs), methyloc)
-
-            if kmer_len % 2 == 0:
-                raise ValueError("kmer_len must be odd")
-            num_bases = (kmer_len - 1) // 2
-
-            for loc_in_read in tsite_locs:
-                if num_bases <= loc_in_read < len(genomeseq) - num_bases:
-                    loc_in_ref = loc_in_read + chrom_start_in_alignstrand
-
-                    # cpgid = readname + chrom + alignstrand + str(cpgloc_in_ref) + strand
-                    if alignstrand == '-':
-                        pos = chromlen - 1 - loc_in_ref
-                    else:
-                        pos = loc_in_ref
-
-                    if (positions is not None) and (key_sep.join([chrom, str(pos), alignstrand]) not in positions):
-                        continue
-
-                    k_mer = genomeseq[(loc_in_read - num_bases):(loc_in_read + num_bases + 1)]
-                    k_signals = signal_list[(loc_in_read - num_bases):(loc_in_read + num_bases + 1)]
-
-                    signal_lens = [len(x) for x in k_signals]
-                    # if sum(signal_lens) > MAX_LEGAL_SIGNAL_NUM:
-                    #     continue
-
-                    signal_means = [np.mean(x) for x in k_signals]
-                    signal_stds = [np.std(x) for x in k_signals]
-
-                    # cent_signals = _get_central_signals(k_signals, raw_signals_len)
-                    k_signals_rect = _get_signals_rect(k_signals, signals_len)
-
-                    features_list.append((chrom, pos, alignstrand, loc_in_ref, readname, strand,
-                                          k_mer, signal_means, signal_stds, signal_lens,
-                                          k_signals_rect, methy_label))
-        except Exception:
-            error += 1
-            continue
+            file_bytes = None if fast5_bytes is None else fast5_bytes.get(fast5_fp)
+            for read in iter_fast5_reads(fast5_fp, corrected_group, basecall_subgroup, read_keys, read_filter,
+                                         file_bytes):
+                if read is None:
+                    error += 1
+                    continue
+                try:
+                    features_arrays = _extract_read_features(read, normalize_method, motif_scanner,
+                                                             chrom2len, kmer_len, signals_len, methy_label,
+                                                             positions)
+                    if features_arrays is not None:
+                        read_features.append(features_arrays)
+                except Exception:
+                    error += 1
+        except IOError:
+            error += 1 if read_keys is None else len(read_keys)
     # print("extracted success {} of {}".format(len(fast5s) - error, len(fast5s)))
     # print("features_str len {}".format(len(features_str)))
-    return features_list, error
+    return concat_features_arrays(read_features, kmer_len, signals_len), error
 
 
-def _features_to_str(features):
+def _features_to_str(features_arrays):
     """
 
-    :param features: a tuple
-    :return:
+    :param features_arrays: dict of column arrays
+    :return: list of features strs, one for each sample
     """
-    chrom, pos, alignstrand, loc_in_ref, readname, strand, k_mer, signal_means, signal_stds, \
-        signal_lens, k_signals_rect, methy_label = features
-    means_text = ','.join([str(x) for x in np.around(signal_means, decimals=6)])
-    stds_text = ','.join([str(x) for x in np.around(signal_stds, decimals=6)])
-    signal_len_text = ','.join([str(x) for x in signal_lens])
-    k_signals_text = ';'.join([",".join([str(y) for y in x]) for x in k_signals_rect])
+    sampleinfo_strs = get_sampleinfo_strs(features_arrays)
+    kmers = codes_to_kmers(features_arrays['kmer'])
+    means_texts = [','.join([str(x) for x in signal_means])
+                   for signal_means in np.around(features_arrays['base_means'], decimals=6)]
+    stds_texts = [','.join([str(x) for x in signal_stds])
+                  for signal_stds in np.around(features_arrays['base_stds'], decimals=6)]
+    signal_len_texts = [','.join([str(x) for x in signal_lens])
+                        for signal_lens in features_arrays['base_signal_lens'].tolist()]
+    k_signals_texts = [';'.join([",".join([str(y) for y in x]) for x in k_signals_rect])
+                       for k_signals_rect in features_arrays['signals']]
+
+    return ["\t".join([sampleinfo_str, k_mer, means_text, stds_text, signal_len_text, k_signals_text,
+                       str(methy_label)])
+            for sampleinfo_str, k_mer, means_text, stds_text, signal_len_text, k_signals_text, methy_label
+            in zip(sampleinfo_strs, kmers, means_texts, stds_texts, signal_len_texts, k_signals_texts,
+                   features_arrays['label'].tolist())]
+
+
+def _fill_files_queue(fast5s_q, fast5s_batches):
+    for fast5s in fast5s_batches:
+        fast5s_q.put(fast5s)
+    return
 
-    return "\t".join([chrom, str(pos), alignstrand, str(loc_in_ref), readname, strand, k_mer, means_text,
-                      stds_text, signal_len_text, k_signals_text, str(methy_label)])
 
+def _prefetch_fast5(fast5_path, read_keys, corrected_group, basecall_subgroup):
+    try:
+        return prefetch_fast5(fast5_path, read_keys, corrected_group, basecall_subgroup)
+    except Exception:
+        # the errors are left to the reading of the batch
+        return None
 
-def _fill_files_queue(fast5s_q, fast5_files, batch_size):
-    for i in np.arange(0, len(fast5_files), batch_size):
-        fast5s_q.put(fast5_files[i:(i+batch_size)])
-    return
+
+def _iter_fast5s_batches(fast5s_q, corrected_group, basecall_subgroup, prefetch_depth=1, io_threads=4):
+    """
+    take batches from fast5s_q until the kill signal, while the data of the next prefetch_depth
+    batches are loaded by a pool of io_threads threads, see fast5_reader.prefetch_fast5()
+    :return: generator of (fast5s, fast5_bytes), fast5_bytes is a dict of fast5_path -> file content
+             (of single-read fast5s), or None if not prefetched
+    """
+    if prefetch_depth <= 0 or io_threads <= 0:
+        while True:
+            fast5s = fast5s_q.get()
+            if is_kill_signal(fast5s):
+                fast5s_q.put("kill")
+                break
+            yield fast5s, None
+        return
+
+    io_pool = ThreadPoolExecutor(max_workers=io_threads)
+    fetching = deque()
+    is_end = False
+    while True:
+        while not is_end and len(fetching) <= prefetch_depth:
+            fast5s = fast5s_q.get()
+            if is_kill_signal(fast5s):
+                fast5s_q.put("kill")
+                is_end = True
+                break
+            fetching.append((fast5s, [io_pool.submit(_prefetch_fast5, fast5_path, read_keys,
+                                                     corrected_group, basecall_subgroup)
+                                      for fast5_path, read_keys in fast5s]))
+        if len(fetching) == 0:
+            break
+        fast5s, futures = fetching.popleft()
+        fast5_bytes = dict()
+        for (fast5_path, _), future in zip(fast5s, futures):
+            file_bytes = future.result()
+            if file_bytes is not None:
+                fast5_bytes[fast5_path] = file_bytes
+        yield fast5s, fast5_bytes
+    io_pool.shutdown()
 
 
 def get_a_batch_features_str(fast5s_q, featurestr_q, errornum_q,
                              corrected_group, basecall_subgroup, normalize_method,
-                             motif_seqs, methyloc, chrom2len, kmer_len, signals_len, methy_label,
-                             positions):
+                             motif_scanner, chrom2len, kmer_len, signals_len, methy_label,
+                             positions, w_format="tsv", prefetch_depth=1, io_threads=4):
     f5_num = 0
-    while True:
-        if fast5s_q.empty():
-            time.sleep(time_wait)
-        fast5s = fast5s_q.get()
-        if fast5s == "kill":
-            fast5s_q.put("kill")
-            break
+    error_total = 0
+    for fast5s, fast5_bytes in _iter_fast5s_batches(fast5s_q, corrected_group, basecall_subgroup,
+                                                    prefetch_depth, io_threads):
         f5_num += len(fast5s)
-        features_list, error_num = _extract_features(fast5s, corrected_group, basecall_subgroup,
-                                                     normalize_method, motif_seqs, methyloc,
-                                                     chrom2len, kmer_len, signals_len, methy_label,
-                                                     positions)
-        features_str = []
-        for features in features_list:
-            features_str.append(_features_to_str(features))
-
-        errornum_q.put(error_num)
-        featurestr_q.put(features_str)
-        while featurestr_q.qsize() > queen_size_border:
-            time.sleep(time_wait)
+        features_arrays, error_num = _extract_features(fast5s, corrected_group, basecall_subgroup,
+                                                       normalize_method, motif_scanner,
+                                                       chrom2len, kmer_len, signals_len, methy_label,
+                                                       positions, fast5_bytes)
+        if w_format == "h5":
+            features_str = features_arrays
+        else:
+            features_str = _features_to_str(features_arrays)
+
+        error_total += error_num
+        # blocks when the writer falls behind (featurestr_q is bounded)
+        featurestr_q.put((fast5s, features_str))
+    errornum_q.put(error_total)
     print("extrac_features process-{} ending, proceed {} fast5s".format(os.getpid(), f5_num))
 
 
-def _write_featurestr_to_file(write_fp, featurestr_q):
-    with open(write_fp, 'w') as wf:
+def _write_featurestr_to_file(write_fp, featurestr_q, resume_size=None):
+    manifest = ManifestWriter(get_manifest_path(write_fp), resume_size is not None)
+    # compressed by the suffix of write_fp, see utils.compress_utils
+    with TextResultWriter(write_fp, manifest, resume_size) as wf:
         while True:
-            # during test, it's ok without the sleep(time_wait)
-            if featurestr_q.empty():
-                time.sleep(time_wait)
-                continue
-            features_str = featurestr_q.get()
-            if features_str == "kill":
+            features_item = featurestr_q.get()
+            if is_kill_signal(features_item):
                 print('write_process-{} finished'.format(os.getpid()))
                 break
-            for one_features_str in features_str:
-                wf.write(one_features_str + "\n")
-            wf.flush()
+            fast5s, features_str = features_item
+            wf.write(features_str, fast5s)
+    manifest.close()
 
 
 def _write_featurestr_to_dir(write_dir, featurestr_q, w_batch_num):
@@ -387,14 +457,11 @@ def _write_featurestr_to_dir(write_dir, featurestr_q, w_batch_num):
     wf = open("/".join([write_dir, str(file_count) + ".tsv"]), "w")
     batch_count = 0
     while True:
-        # during test, it's ok without the sleep(time_wait)
-        if featurestr_q.empty():
-            time.sleep(time_wait)
-            continue
-        features_str = featurestr_q.get()
-        if features_str == "kill":
+        features_item = featurestr_q.get()
+        if is_kill_signal(features_item):
             print('write_process-{} finished'.format(os.getpid()))
             break
+        features_str = features_item[1]
 
         if batch_count >= w_batch_num:
             wf.flush()
@@ -407,30 +474,102 @@ def _write_featurestr_to_dir(write_dir, featurestr_q, w_batch_num):
         batch_count += 1
 
 
-def _write_featurestr(write_fp, featurestr_q, w_batch_num=10000, is_dir=False):
-    if is_dir:
-        _write_featurestr_to_dir(write_fp, featurestr_q, w_batch_num)
+def _write_featurearrays_to_h5(write_fp, featurestr_q, kmer_len, signals_len, resume_size=None):
+    manifest = ManifestWriter(get_manifest_path(write_fp), resume_size is not None)
+    wf = FeaturesH5Writer(write_fp, kmer_len, signals_len, resume_num=resume_size)
+    while True:
+        features_item = featurestr_q.get()
+        if is_kill_signal(features_item):
+            print('write_process-{} finished, {} samples written'.format(os.getpid(), wf.get_num()))
+            break
+        fast5s, features_arrays = features_item
+        wf.write(features_arrays)
+        wf.flush()
+        manifest.commit(fast5s, wf.get_num())
+    wf.close()
+    manifest.close()
+
+
+def _write_featurearrays_to_h5dir(write_dir, featurestr_q, w_batch_num, kmer_len, signals_len):
+    if os.path.exists(write_dir):
+        if os.path.isfile(write_dir):
+            raise FileExistsError("{} already exists as a file, please use another write_dir".format(write_dir))
     else:
-        _write_featurestr_to_file(write_fp, featurestr_q)
+        os.makedirs(write_dir)
+
+    file_count = 0
+    wf = FeaturesH5Writer("/".join([write_dir, str(file_count) + ".h5"]), kmer_len, signals_len)
+    batch_count = 0
+    while True:
+        features_item = featurestr_q.get()
+        if is_kill_signal(features_item):
+            print('write_process-{} finished'.format(os.getpid()))
+            break
+        features_arrays = features_item[1]
 
+        if batch_count >= w_batch_num:
+            wf.close()
+            file_count += 1
+            wf = FeaturesH5Writer("/".join([write_dir, str(file_count) + ".h5"]), kmer_len, signals_len)
+            batch_count = 0
+        wf.write(features_arrays)
+        batch_count += 1
+    wf.close()
 
-def _read_position_file(position_file):
-    postions = set()
-    with open(position_file, 'r') as rf:
-        for line in rf:
-            words = line.strip().split("\t")
-            postions.add(key_sep.join(words[:3]))
-    return postions
 
+def _write_featurestr(write_fp, featurestr_q, w_batch_num=10000, is_dir=False, w_format="tsv",
+                      kmer_len=17, signals_len=16, resume_size=None):
+    # a manifest of written reads is kept (for --resume) only when writing to a single file
+    if w_format == "h5":
+        if is_dir:
+            _write_featurearrays_to_h5dir(write_fp, featurestr_q, w_batch_num, kmer_len, signals_len)
+        else:
+            _write_featurearrays_to_h5(write_fp, featurestr_q, kmer_len, signals_len, resume_size)
+    elif is_dir:
+        _write_featurestr_to_dir(write_fp, featurestr_q, w_batch_num)
+    else:
+        _write_featurestr_to_file(write_fp, featurestr_q, resume_size)
 
-def _extract_preprocess(fast5_dir, is_recursive, motifs, is_dna, reference_path, f5_batch_num,
-                        position_file):
 
-    fast5_files = get_fast5s(fast5_dir, is_recursive)
-    print("{} fast5 files in total..".format(len(fast5_files)))
+def _read_position_file(position_file):
+    # sorted position arrays per chrom/strand, see utils.intervals.PositionSet
+    return read_position_file(position_file)
+
+
+def _filter_done_reads(read_items, read_costs, done_reads):
+    undone_idxs = [idx for idx in range(len(read_items)) if read_items[idx] not in done_reads]
+    return [read_items[idx] for idx in undone_idxs], [read_costs[idx] for idx in undone_idxs]
+
+
+def _get_read_items(fast5_dir, is_recursive, fast5_index, corrected_group, basecall_subgroup, positions,
+                    nproc=1):
+    if fast5_index is None:
+        fast5_files = get_fast5s(fast5_dir, is_recursive)
+        print("{} fast5 files in total..".format(len(fast5_files)))
+        read_items, read_costs = get_fast5_read_items_n_costs(fast5_files, nproc)
+        print("{} reads in total..".format(len(read_items)))
+        return read_items, read_costs
+    # no walking of fast5_dir and no opening of fast5 files, reads are prefiltered by
+    # the alignments in the index
+    print("read fast5 index {}..".format(fast5_index))
+    read_items, read_costs, unusable_num = read_fast5_index(fast5_index, corrected_group, basecall_subgroup,
+                                                            positions)
+    print("{} reads to be processed from the fast5 index, {} reads without "
+          "{}/{} skipped..".format(len(read_items), unusable_num, corrected_group, basecall_subgroup))
+    return read_items, read_costs
+
+
+def _extract_preprocess(fast5_dir, is_recursive, motifs, mod_loc, is_dna, reference_path, f5_batch_num,
+                        position_file, done_reads=None, regions=None, fast5_index=None,
+                        corrected_group='RawGenomeCorrected_000', basecall_subgroup='BaseCalled_template',
+                        nproc=1, calibrate_func=None):
+    """
+    :param calibrate_func: None, or function(motif_scanner, chrom2len, positions, fast5s_batches) called
+                           on the scheduled batches before they are put into fast5s_q (call_mods --autotune)
+    """
 
     print("parse the motifs string..")
-    motif_seqs = get_motif_seqs(motifs, is_dna)
+    motif_scanner = MotifScanner(motifs, mod_loc, is_dna)
 
     print("read genome reference file..")
     chrom2len = get_contig2len(reference_path)
@@ -439,29 +578,59 @@ def _extract_preprocess(fast5_dir, is_recursive, motifs, is_dna, reference_path,
     positions = None
     if position_file is not None:
         positions = _read_position_file(position_file)
+    region_set = parse_regions(regions)
+    if region_set is not None:
+        unknown_chroms = [chrom for chrom in region_set.get_chroms() if chrom not in chrom2len]
+        if len(unknown_chroms) > 0:
+            print("regions of chroms not in the reference are ignored: {}".format(",".join(unknown_chroms)))
+    # positions and regions are both checked by has_site_in()/contains(), reads outside
+    # them are skipped from the alignment attrs alone, see _extract_features()
+    positions = combine_site_filters([positions, region_set])
+
+    read_items, read_costs = _get_read_items(fast5_dir, is_recursive, fast5_index, corrected_group,
+                                             basecall_subgroup, positions, nproc)
+    if done_reads is not None and len(done_reads) > 0:
+        read_items, read_costs = _filter_done_reads(read_items, read_costs, done_reads)
+        print("{} reads left to be processed (--resume)..".format(len(read_items)))
+
+    # longest-first batches balanced by estimated cost
+    fast5s_batches = schedule_read_batches(read_items, read_costs, f5_batch_num)
+    if calibrate_func is not None and len(fast5s_batches) > 0:
+        calibrate_func(motif_scanner, chrom2len, positions, fast5s_batches)
 
     # fast5s_q = mp.Queue()
     fast5s_q = Queue()
-    _fill_files_queue(fast5s_q, fast5_files, f5_batch_num)
+    _fill_files_queue(fast5s_q, fast5s_batches)
 
-    return motif_seqs, chrom2len, fast5s_q, len(fast5_files), positions
+    return motif_scanner, chrom2len, fast5s_q, len(read_items), positions
 
 
 def extract_features(fast5_dir, is_recursive, reference_path, is_dna,
                      batch_size, write_fp, nproc,
                      corrected_group, basecall_subgroup, normalize_method,
                      motifs, methyloc, kmer_len, signals_len, methy_label,
-                     position_file, w_is_dir, w_batch_num):
+                     position_file, w_is_dir, w_batch_num, w_format="tsv", resume=False, regions=None,
+                     fast5_index=None, prefetch_depth=1, io_threads=4):
     print("[main]extract_features starts..")
     start = time.time()
 
-    motif_seqs, chrom2len, fast5s_q, len_fast5s, positions = _extract_preprocess(fast5_dir, is_recursive,
-                                                                                 motifs, is_dna, reference_path,
-                                                                                 batch_size, position_file)
+    done_reads, resume_size = None, None
+    if resume:
+        if w_is_dir:
+            raise ValueError("--resume is not supported when --w_is_dir is true")
+        done_reads, resume_size = prepare_resume(write_fp)
+
+    motif_scanner, chrom2len, fast5s_q, len_fast5s, positions = _extract_preprocess(fast5_dir, is_recursive,
+                                                                                    motifs, methyloc, is_dna,
+                                                                                    reference_path, batch_size,
+                                                                                    position_file, done_reads,
+                                                                                    regions, fast5_index,
+                                                                                    corrected_group,
+                                                                                    basecall_subgroup, nproc)
 
     # featurestr_q = mp.Queue()
     # errornum_q = mp.Queue()
-    featurestr_q = Queue()
+    featurestr_q = Queue(maxsize=queen_size_border)
     errornum_q = Queue()
 
     featurestr_procs = []
@@ -471,36 +640,32 @@ def extract_features(fast5_dir, is_recursive, reference_path, is_dna,
     for _ in range(nproc):
         p = mp.Process(target=get_a_batch_features_str, args=(fast5s_q, featurestr_q, errornum_q,
                                                               corrected_group, basecall_subgroup,
-                                                              normalize_method, motif_seqs,
-                                                              methyloc, chrom2len, kmer_len, signals_len,
-                                                              methy_label, positions))
+                                                              normalize_method, motif_scanner,
+                                                              chrom2len, kmer_len, signals_len,
+                                                              methy_label, positions, w_format,
+                                                              prefetch_depth, io_threads))
         p.daemon = True
         p.start()
         featurestr_procs.append(p)
 
     # print("write_process started..")
-    p_w = mp.Process(target=_write_featurestr, args=(write_fp, featurestr_q, w_batch_num, w_is_dir))
+    p_w = mp.Process(target=_write_featurestr, args=(write_fp, featurestr_q, w_batch_num, w_is_dir,
+                                                     w_format, kmer_len, signals_len, resume_size))
     p_w.daemon = True
     p_w.start()
 
+    # the writer is watched too: if it dies, the extracting processes would block on featurestr_q
+    wait_for_processes(featurestr_procs, [p_w])
     errornum_sum = 0
-    while True:
-        # print("killing feature_p")
-        running = any(p.is_alive() for p in featurestr_procs)
-        while not errornum_q.empty():
-            errornum_sum += errornum_q.get()
-        if not running:
-            break
-
-    for p in featurestr_procs:
-        p.join()
+    for _ in featurestr_procs:
+        errornum_sum += errornum_q.get()
 
     # print("finishing the write_process..")
     featurestr_q.put("kill")
 
-    p_w.join()
+    wait_for_processes([p_w])
 
-    print("%d of %d fast5 files failed..\n"
+    print("%d of %d fast5 reads failed..\n"
           "[main]extract_features costs %.1f seconds.." % (errornum_sum, len_fast5s,
                                                            time.time() - start))
 
@@ -526,6 +691,10 @@ def main():
     ep_input.add_argument("--basecall_subgroup", action="store", type=str, required=False,
                           default='BaseCalled_template',
                           help='the corrected subgroup of fast5 files. default BaseCalled_template')
+    ep_input.add_argument("--fast5_index", action="store", type=str, required=False, default=None,
+                          help="the fast5 index of fast5_dir built by 'deepsignal2 index', to list and "
+                               "prefilter reads from it instead of walking fast5_dir and opening "
+                               "every fast5 file. default None")
     ep_input.add_argument("--reference_path", action="store",
                           type=str, required=True,
                           help="the reference file to be used, usually is a .fa file")
@@ -557,14 +726,16 @@ def main():
                                     'can be multi motifs splited by comma '
                                     '(no space allowed in the input str), '
                                     'or use IUPAC alphabet, '
-                                    'the mod_loc of all motifs must be '
-                                    'the same')
-    ep_extraction.add_argument("--mod_loc", action="store", type=int, required=False, default=0,
-                               help='0-based location of the targeted base in the motif, default 0')
-    # ep_extraction.add_argument("--region", action="store", type=str,
-    #                            required=False, default=None,
-    #                            help="region of interest, e.g.: chr1:0-10000, default None, "
-    #                                 "for the whole region")
+                                    'motifs can be of different lengths')
+    ep_extraction.add_argument("--mod_loc", action="store", type=str, required=False, default='0',
+                               help='0-based location of the targeted base in the motif, default 0. '
+                                    'can be multi locs splited by comma, one for each motif in --motifs')
+    ep_extraction.add_argument("--region", action="append", type=str,
+                               required=False, default=None,
+                               help="region of interest, e.g.: chr1:0-10000 (0-based, end exclusive) or chr1, "
+                                    "can be multi regions splited by comma, or a BED file. can be used "
+                                    "multiple times. reads/sites outside the regions are skipped. default None, "
+                                    "for the whole region")
     ep_extraction.add_argument("--positions", action="store", type=str,
                                required=False, default=None,
                                help="file with a list of positions interested (must be formatted as tab-separated file"
@@ -575,20 +746,38 @@ def main():
     ep_output = extraction_parser.add_argument_group("OUTPUT")
     ep_output.add_argument("--write_path", "-o", action="store",
                            type=str, required=True,
-                           help='file path to save the features')
+                           help='file path to save the features, the tsv features are compressed '
+                                'if the file name ends with .gz (gzip), .bgz (bgzip) or .zst (zstd)')
     ep_output.add_argument("--w_is_dir", action="store",
                            type=str, required=False, default="no",
                            help='if using a dir to save features into multiple files')
     ep_output.add_argument("--w_batch_num", action="store",
                            type=int, required=False, default=200,
                            help='features batch num to save in a single writed file when --is_dir is true')
+    ep_output.add_argument("--w_format", action="store", type=str, choices=["tsv", "h5"],
+                           required=False, default="tsv",
+                           help='format of the features file, tsv or h5 (binary columnar HDF5, '
+                                'faster to write and to read in call_mods/train). default tsv')
 
     extraction_parser.add_argument("--nproc", "-p", action="store", type=int, default=1,
                                    required=False,
                                    help="number of processes to be used, default 1")
+    extraction_parser.add_argument("--resume", action="store_true", default=False, required=False,
+                                   help="resume an interrupted run: reads recorded in the manifest "
+                                        "(write_path.manifest) are skipped, and features are appended to "
+                                        "write_path. not supported with --w_is_dir")
     extraction_parser.add_argument("--f5_batch_size", action="store", type=int, default=100,
                                    required=False,
-                                   help="number of files to be processed by each process one time, default 100")
+                                   help="average number of reads to be processed by each process one time, "
+                                        "batches are balanced by estimated cost of the reads, default 100")
+    extraction_parser.add_argument("--prefetch_depth", action="store", type=int, default=1,
+                                   required=False,
+                                   help="number of read batches each process prefetches (reads the fast5 "
+                                        "data into memory) while the current batch is being processed, "
+                                        "0 for no prefetching. default 1")
+    extraction_parser.add_argument("--io_threads", action="store", type=int, default=4,
+                                   required=False,
+                                   help="number of I/O threads of each process for prefetching, default 4")
 
     extraction_args = extraction_parser.parse_args()
     display_args(extraction_args)
@@ -605,6 +794,7 @@ def main():
     write_path = extraction_args.write_path
     w_is_dir = str2bool(extraction_args.w_is_dir)
     w_batch_num = extraction_args.w_batch_num
+    w_format = extraction_args.w_format
 
     kmer_len = extraction_args.seq_len
     signals_len = extraction_args.signal_len
@@ -615,11 +805,17 @@ def main():
 
     nproc = extraction_args.nproc
     f5_batch_size = extraction_args.f5_batch_size
+    resume = extraction_args.resume
+    regions = extraction_args.region
+    fast5_index = extraction_args.fast5_index
+    prefetch_depth = extraction_args.prefetch_depth
+    io_threads = extraction_args.io_threads
 
     extract_features(fast5_dir, is_recursive, reference_path, is_dna,
                      f5_batch_size, write_path, nproc, corrected_group, basecall_subgroup,
                      normalize_method, motifs, mod_loc, kmer_len, signals_len, methy_label,
-                     position_file, w_is_dir, w_batch_num)
+                     position_file, w_is_dir, w_batch_num, w_format, resume, regions, fast5_index,
+                     prefetch_depth, io_threads)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,92 @@
+"""
+build a catalog (SQLite) of the reads in a fast5 directory once, so that extract/call_mods
+(--fast5_index) list, prefilter and schedule reads without walking the directory or opening
+every fast5 file.
+"""
+
+from __future__ import absolute_import
+
+import sys
+import argparse
+import time
+import functools
+import multiprocessing as mp
+
+from .utils.process_utils import str2bool
+from .utils.process_utils import display_args
+from .utils.process_utils import get_fast5s
+from .utils.fast5_index import Fast5IndexWriter
+from .utils.fast5_index import index_a_fast5
+from .utils.fast5_index import get_default_index_path
+
+
+def index_fast5s(fast5_dir, is_recursive, corrected_group, basecall_subgroup, index_path, nproc):
+    print("[main]index_fast5s starts..")
+    start = time.time()
+
+    fast5_files = get_fast5s(fast5_dir, is_recursive)
+    print("{} fast5 files in total..".format(len(fast5_files)))
+    if index_path is None:
+        index_path = get_default_index_path(fast5_dir)
+
+    index_func = functools.partial(index_a_fast5, corrected_group=corrected_group,
+                                   basecall_subgroup=basecall_subgroup)
+    pool = None
+    if nproc > 1:
+        pool = mp.Pool(nproc)
+        rows_iter = pool.imap(index_func, fast5_files, chunksize=64)
+    else:
+        rows_iter = map(index_func, fast5_files)
+
+    wi = Fast5IndexWriter(index_path, fast5_dir, corrected_group, basecall_subgroup)
+    read_num, unusable_num = 0, 0
+    for rows in rows_iter:
+        wi.write(rows)
+        read_num += len(rows)
+        unusable_num += sum([1 for row in rows if row[-1] == 0])
+    wi.close()
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    print("{} reads indexed, {} of them have no {}/{} (or can't be read)..\n"
+          "index saved in {}\n"
+          "[main]index_fast5s costs {:.1f} seconds..".format(read_num, unusable_num, corrected_group,
+                                                             basecall_subgroup, index_path,
+                                                             time.time() - start))
+
+
+def main():
+    index_parser = argparse.ArgumentParser("build a catalog of the reads in a fast5 directory, "
+                                           "for extract/call_mods --fast5_index")
+    index_parser.add_argument("--fast5_dir", "-i", action="store", type=str,
+                              required=True,
+                              help="the directory of fast5 files")
+    index_parser.add_argument("--recursively", "-r", action="store", type=str, required=False,
+                              default='yes',
+                              help='is to find fast5 files from fast5_dir recursively. '
+                                   'default true, t, yes, 1')
+    index_parser.add_argument("--corrected_group", action="store", type=str, required=False,
+                              default='RawGenomeCorrected_000',
+                              help='the corrected_group of fast5 files after '
+                                   'tombo re-squiggle. default RawGenomeCorrected_000')
+    index_parser.add_argument("--basecall_subgroup", action="store", type=str, required=False,
+                              default='BaseCalled_template',
+                              help='the corrected subgroup of fast5 files. default BaseCalled_template')
+    index_parser.add_argument("--index_path", "-o", action="store", type=str, required=False,
+                              default=None,
+                              help="file path to save the index, default fast5_dir.index.sqlite "
+                                   "(next to fast5_dir)")
+    index_parser.add_argument("--nproc", "-p", action="store", type=int, default=1,
+                              required=False,
+                              help="number of processes to be used, default 1")
+
+    index_args = index_parser.parse_args()
+    display_args(index_args)
+
+    index_fast5s(index_args.fast5_dir, str2bool(index_args.recursively), index_args.corrected_group,
+                 index_args.basecall_subgroup, index_args.index_path, index_args.nproc)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,227 @@
+"""running a trained ModelBiLSTM for calling. the model is in eval mode (zero initial LSTM states,
+no dropout, so the probabilities are deterministic), and batches are run under
+torch.inference_mode(), without building autograd graphs.
+the model can also be exported (deepsignal2 export) to TorchScript/ONNX, with its hyperparameters,
+and run by the torchscript/onnx engines (call_mods --engine).
+"""
+
+from __future__ import absolute_import
+
+import re
+import json
+import inspect
+import numpy as np
+import torch
+import torch.nn as nn
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+from .models import ModelBiLSTM
+from .utils.process_utils import str2bool
+from .utils.constants_torch import use_cuda
+
+# torch.inference_mode() is in torch>=1.9
+_inference_mode = torch.inference_mode if hasattr(torch, "inference_mode") else torch.no_grad
+
+# hyperparameters of ModelBiLSTM (args of call_mods), saved in the exported models
+model_hyperparams = ("model_type", "seq_len", "signal_len", "layernum1", "layernum2", "class_num",
+                     "dropout_rate", "n_vocab", "n_embed", "is_base", "is_signallen", "hid_rnn")
+# input/output names of the exported models
+feature_names = ("kmer", "base_means", "base_stds", "base_signal_lens", "signals")
+output_names = ("logits", "probs")
+onnx_opset_version = 14
+# --quantize of call_mods, dynamic quantization of nn.LSTM needs torch>=1.10 (the torch pin)
+quantize_dtypes = {"int8": torch.qint8}
+quantize_min_torch_version = (1, 10)
+_export_info_key = "deepsignal2.json"
+
+
+def load_model(model_path, args):
+    """
+    :param args: the model hyperparameters (seq_len, signal_len, layernum1, ..), as args of call_mods
+    :return: ModelBiLSTM with the parameters in model_path, in eval mode
+    """
+    model = ModelBiLSTM(args.seq_len, args.signal_len, args.layernum1, args.layernum2, args.class_num,
+                        args.dropout_rate, args.hid_rnn,
+                        args.n_vocab, args.n_embed, str2bool(args.is_base), str2bool(args.is_signallen),
+                        args.model_type)
+    if use_cuda:
+        model = model.cuda()
+        para_dict = torch.load(model_path)
+    else:
+        para_dict = torch.load(model_path, map_location=torch.device('cpu'))
+
+    model_dict = model.state_dict()
+    model_dict.update(para_dict)
+    model.load_state_dict(model_dict)
+
+    model.eval()
+    return model
+
+
+def _get_torch_version():
+    # (major, minor) of the installed torch, e.g. "1.10.0+cpu" -> (1, 10)
+    return tuple([int(x) for x in re.findall(r"\d+", torch.__version__)[:2]])
+
+
+def check_quantize_supported():
+    """raise a ValueError if the installed torch can not quantize the model (--quantize)"""
+    if _get_torch_version() < quantize_min_torch_version or \
+            not hasattr(torch.quantization, "quantize_dynamic"):
+        raise ValueError("--quantize needs torch>={}, the installed torch is {}".format(
+            ".".join([str(x) for x in quantize_min_torch_version]), torch.__version__))
+
+
+def quantize_model(model, quantize="int8"):
+    """
+    dynamic quantization of the LSTM and Linear layers of model (the weights are stored in int8,
+    the activations are quantized on the fly), for cpu only
+    :return: the quantized copy of model, in eval mode
+    """
+    check_quantize_supported()
+    return torch.quantization.quantize_dynamic(model.cpu(), {nn.LSTM, nn.Linear},
+                                               dtype=quantize_dtypes[quantize]).eval()
+
+
+def _to_tensor(features_array):
+    # shares memory with the (contiguous) array, no copy in cpu mode
+    tensor = torch.from_numpy(np.ascontiguousarray(features_array))
+    return tensor.cuda() if use_cuda else tensor
+
+
+def get_example_batch(batch_size, seq_len, signal_len, seed=0):
+    """a random batch of features, as utils.features_h5.get_features_batch() (without siteinfo, label)"""
+    rng = np.random.RandomState(seed)
+    return (rng.randint(0, 4, (batch_size, seq_len)).astype(np.int8),
+            rng.randn(batch_size, seq_len).astype(np.float32),
+            rng.rand(batch_size, seq_len).astype(np.float32),
+            rng.randint(1, 50, (batch_size, seq_len)).astype(np.int32),
+            rng.randn(batch_size, seq_len, signal_len).astype(np.float32))
+
+
+def get_export_info(args):
+    return dict([(key, getattr(args, key)) for key in model_hyperparams])
+
+
+def export_torchscript(model, args, export_path, batch_size=512):
+    """trace model (cpu, eval mode) into TorchScript, the hyperparameters in args are saved in the file"""
+    example_batch = get_example_batch(batch_size, args.seq_len, args.signal_len)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, tuple([torch.from_numpy(x) for x in example_batch]))
+    torch.jit.save(traced, export_path, _extra_files={_export_info_key: json.dumps(get_export_info(args))})
+
+
+def export_onnx(model, args, export_path, batch_size=512):
+    """export model (cpu, eval mode) to ONNX (with dynamic batch size), the hyperparameters in args
+    are saved in the metadata of the model"""
+    try:
+        import onnx
+    except ImportError:
+        raise ImportError("module onnx is needed to export a model to ONNX, please install it "
+                          "(pip install onnx)")
+    example_batch = get_example_batch(batch_size, args.seq_len, args.signal_len)
+    dynamic_axes = dict([(name, {0: "batch"}) for name in feature_names + output_names])
+    export_kwargs = dict()
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        # the TorchScript-based exporter, the default one of torch<2.9
+        export_kwargs["dynamo"] = False
+    with torch.no_grad():
+        torch.onnx.export(model, tuple([torch.from_numpy(x) for x in example_batch]), export_path,
+                          input_names=list(feature_names), output_names=list(output_names),
+                          dynamic_axes=dynamic_axes, opset_version=onnx_opset_version, **export_kwargs)
+    onnx_model = onnx.load(export_path)
+    onnx_model.metadata_props.add(key=_export_info_key, value=json.dumps(get_export_info(args)))
+    onnx.save(onnx_model, export_path)
+
+
+def _get_onnxruntime():
+    if onnxruntime is None:
+        raise ImportError("module onnxruntime is needed to run an ONNX model, please install it "
+                          "(pip install onnxruntime, or onnxruntime-gpu)")
+    return onnxruntime
+
+
+def load_torchscript(model_path):
+    """
+    :return: the TorchScript model in model_path (from export_torchscript()), its hyperparameters (dict)
+    """
+    extra_files = {_export_info_key: ""}
+    model = torch.jit.load(model_path, map_location=torch.device("cuda" if use_cuda else "cpu"),
+                           _extra_files=extra_files)
+    return model, json.loads(extra_files[_export_info_key])
+
+
+def read_export_info(model_path, engine):
+    """hyperparameters (dict) saved in an exported model of engine torchscript/onnx"""
+    if engine == "torchscript":
+        return load_torchscript(model_path)[1]
+    session = _get_onnxruntime().InferenceSession(model_path, providers=["CPUExecutionProvider"])
+    return json.loads(session.get_modelmeta().custom_metadata_map[_export_info_key])
+
+
+class InferenceEngine(object):
+    """ predict the class probabilities of batches of features by a ModelBiLSTM """
+
+    def __init__(self, model):
+        """
+        :param model: a ModelBiLSTM, e.g. from load_model(), or its TorchScript from load_torchscript()
+        """
+        model.eval()
+        for param in model.parameters():
+            param.requires_grad_(False)
+        self._model = model
+
+    def predict(self, kmers, base_means, base_stds, base_signal_lens, signals):
+        """
+        :param: numpy arrays of a batch, see utils.features_h5.get_features_batch()
+        :return: numpy float32 array of shape (batch_size, class_num), the softmax probabilities
+        """
+        with _inference_mode():
+            _, vlogits = self._model(_to_tensor(kmers), _to_tensor(base_means), _to_tensor(base_stds),
+                                     _to_tensor(base_signal_lens), _to_tensor(signals))
+            if use_cuda:
+                vlogits = vlogits.cpu()
+            return vlogits.numpy()
+
+
+class OnnxInferenceEngine(object):
+    """ predict the class probabilities of batches of features by an ONNX model (onnxruntime) """
+
+    def __init__(self, model_path):
+        ort = _get_onnxruntime()
+        sess_options = ort.SessionOptions()
+        # as many threads as torch in this process
+        sess_options.intra_op_num_threads = torch.get_num_threads()
+        providers = ["CPUExecutionProvider"]
+        if use_cuda and "CUDAExecutionProvider" in ort.get_available_providers():
+            providers.insert(0, "CUDAExecutionProvider")
+        self._session = ort.InferenceSession(model_path, sess_options, providers=providers)
+
+    def predict(self, kmers, base_means, base_stds, base_signal_lens, signals):
+        """
+        :param: numpy arrays of a batch, see utils.features_h5.get_features_batch()
+        :return: numpy float32 array of shape (batch_size, class_num), the softmax probabilities
+        """
+        inputs = dict(zip(feature_names, [np.ascontiguousarray(x) for x in (kmers, base_means, base_stds,
+                                                                           base_signal_lens, signals)]))
+        return self._session.run(["probs"], inputs)[0]
+
+
+def get_inference_engine(engine, model_path, args, quantize=None):
+    """
+    :param engine: eager (model_path is a .ckpt), torchscript or onnx (model_path is from deepsignal2 export)
+    :param quantize: None, or int8 to quantize the eager model, see quantize_model()
+    """
+    if engine == "eager":
+        model = load_model(model_path, args)
+        if quantize is not None:
+            model = quantize_model(model, quantize)
+        return InferenceEngine(model)
+    if engine == "torchscript":
+        return InferenceEngine(load_torchscript(model_path)[0])
+    if engine == "onnx":
+        return OnnxInferenceEngine(model_path)
+    raise ValueError("--engine is not right!")
@@ -163,6 +163,9 @@ class ModelBiLSTM(nn.Module):
 
     def init_hidden(self, batch_size, num_layers, hidden_size):
         # Set initial states
+        if not self.training:
+            # zero initial states (the default of nn.LSTM) in eval mode, so that predictions are deterministic
+            return None
         h0 = autograd.Variable(torch.randn(num_layers * 2, batch_size, hidden_size))
         c0 = autograd.Variable(torch.randn(num_layers * 2, batch_size, hidden_size))
         if use_cuda:
@@ -11,8 +11,7 @@ import time
 import re
 
 from .models import ModelBiLSTM
-from .dataloader import SignalFeaData2
-from .dataloader import clear_linecache
+from .dataloader import get_signalfea_dataset
 from .utils.process_utils import display_args
 from .utils.process_utils import str2bool
 
@@ -30,12 +29,12 @@ def train(args):
         print("GPU is not available!")
 
     print("reading data..")
-    train_dataset = SignalFeaData2(args.train_file)
+    train_dataset = get_signalfea_dataset(args.train_file, tmpdir=args.tmpdir)
     train_loader = torch.utils.data.DataLoader(dataset=train_dataset,
                                                batch_size=args.batch_size,
                                                shuffle=True)
 
-    valid_dataset = SignalFeaData2(args.valid_file)
+    valid_dataset = get_signalfea_dataset(args.valid_file, tmpdir=args.tmpdir)
     valid_loader = torch.utils.data.DataLoader(dataset=valid_dataset,
                                                batch_size=args.batch_size,
                                                shuffle=False)
@@ -170,7 +169,6 @@ def train(args):
                 break
 
     endtime = time.time()
-    clear_linecache()
     print("[train]training cost {} seconds".format(endtime - total_start))
 
 
@@ -229,7 +227,9 @@ def main():
     #                     help='random seed')
 
     # else
-    parser.add_argument('--tmpdir', type=str, default="/tmp", required=False)
+    parser.add_argument('--tmpdir', type=str, default="/tmp", required=False,
+                        help="dir to keep the decompressed copies of compressed (.gz/.bgz/.zst) "
+                             "train/valid files, default /tmp")
 
     args = parser.parse_args()
 
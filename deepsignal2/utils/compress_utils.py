@@ -0,0 +1,215 @@
+"""compressed (gzip/bgzip/zstd) text results: a buffered writer which compresses and writes
+in a dedicated thread, and transparent reading of plain/compressed text files.
+the compression type of a result file is decided by its suffix (.gz: gzip, .bgz: bgzip,
+.zst: zstd), the compression type of an input file is detected by its magic bytes.
+"""
+
+from __future__ import absolute_import
+
+import os
+import io
+import gzip
+import zlib
+import struct
+import shutil
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+compress_suffixes = {'.gz': 'gzip', '.bgz': 'bgzip', '.zst': 'zstd'}
+gzip_level = 6
+zstd_level = 3
+# bytes of uncompressed text in a chunk, each chunk is compressed as a whole
+text_chunk_size = 16 * 1024 * 1024
+
+_gzip_magic = b"\x1f\x8b"
+_zstd_magic = b"\x28\xb5\x2f\xfd"
+
+# bgzip (BGZF) blocks, as in htslib
+_bgzf_block_size = 0xff00
+_bgzf_header = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00"
+_bgzf_eof = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+
+
+def get_compress_type(filepath):
+    """compression type of a file to be written, by its suffix, None for plain text"""
+    compress_type = compress_suffixes.get(os.path.splitext(filepath)[1])
+    if compress_type == 'zstd' and zstandard is None:
+        raise ImportError("module zstandard is needed to write {}, please install it "
+                          "(pip install zstandard)".format(filepath))
+    return compress_type
+
+
+def detect_compress_type(filepath):
+    """compression type of an existing file, by its magic bytes, None for plain text.
+    bgzip files are gzip files, so they are detected as gzip"""
+    with open(filepath, 'rb') as rf:
+        magic = rf.read(4)
+    if magic.startswith(_gzip_magic):
+        return 'gzip'
+    if magic == _zstd_magic:
+        return 'zstd'
+    return None
+
+
+def _compress_gzip(data):
+    # a complete gzip member
+    compressor = zlib.compressobj(gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _compress_bgzip(data):
+    blocks = []
+    for start in range(0, len(data), _bgzf_block_size):
+        block_data = data[start:(start + _bgzf_block_size)]
+        compressor = zlib.compressobj(gzip_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        cdata = compressor.compress(block_data) + compressor.flush()
+        # BSIZE, the total block size minus 1
+        blocks.append(_bgzf_header)
+        blocks.append(struct.pack("<H", len(_bgzf_header) + 2 + len(cdata) + 8 - 1))
+        blocks.append(cdata)
+        blocks.append(struct.pack("<II", zlib.crc32(block_data) & 0xffffffff, len(block_data)))
+    return b"".join(blocks)
+
+
+def _compress_zstd(data):
+    # a complete zstd frame
+    return zstandard.ZstdCompressor(level=zstd_level).compress(data)
+
+
+_compress_funcs = {None: None, 'gzip': _compress_gzip, 'bgzip': _compress_bgzip, 'zstd': _compress_zstd}
+
+
+class TextResultWriter(object):
+    """
+    write lines of a text result file (plain or compressed, by the suffix of the file).
+    lines are buffered into large chunks, a dedicated thread compresses and writes the chunks,
+    so there is no flush per batch. each chunk is written as complete gzip members/bgzip
+    blocks/zstd frames, so that the file can be cut at a chunk boundary and appended (--resume).
+    """
+
+    def __init__(self, result_path, manifest=None, resume_size=None, chunk_size=text_chunk_size):
+        """
+        :param manifest: a ManifestWriter, the batches of reads given to write() are committed to
+                         it after their chunk is written
+        :param resume_size: if not None, append to result_path after its first resume_size bytes
+        """
+        self._compress_type = get_compress_type(result_path)
+        self._compress_func = _compress_funcs[self._compress_type]
+        if resume_size is None:
+            self._wf = open(result_path, 'wb')
+        else:
+            self._wf = open(result_path, 'r+b')
+            self._wf.truncate(resume_size)
+            self._wf.seek(resume_size)
+        self._manifest = manifest
+        self._chunk_size = chunk_size
+        self._lines = []
+        self._lines_size = 0
+        self._fast5s = []
+
+        self._error = None
+        self._chunk_q = queue.Queue(maxsize=2)
+        self._thread = threading.Thread(target=self._write_chunks)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, lines, fast5s=None):
+        """
+        :param lines: list of strs, without line breaks
+        :param fast5s: the batch of reads (fast5_path, read_keys) of the lines, None if not to be
+                       recorded in the manifest
+        """
+        for line in lines:
+            self._lines.append(line)
+            self._lines_size += len(line) + 1
+        if fast5s is not None:
+            self._fast5s += fast5s
+        if self._lines_size >= self._chunk_size:
+            self._put_chunk()
+
+    def _put_chunk(self):
+        if self._error is not None:
+            raise self._error
+        if len(self._lines) == 0 and len(self._fast5s) == 0:
+            return
+        text = "".join([line + "\n" for line in self._lines])
+        self._chunk_q.put((text.encode("UTF-8"), self._fast5s))
+        self._lines = []
+        self._lines_size = 0
+        self._fast5s = []
+
+    def _write_chunks(self):
+        while True:
+            chunk = self._chunk_q.get()
+            if chunk is None:
+                break
+            if self._error is not None:
+                # keep taking chunks, so that write() is not blocked, the error is raised there
+                continue
+            data, fast5s = chunk
+            try:
+                if len(data) > 0:
+                    self._wf.write(data if self._compress_func is None else self._compress_func(data))
+                if self._manifest is not None and len(fast5s) > 0:
+                    self._wf.flush()
+                    self._manifest.commit(fast5s, self._wf.tell())
+            except Exception as e:
+                self._error = e
+
+    def close(self):
+        try:
+            self._put_chunk()
+        finally:
+            self._chunk_q.put(None)
+            self._thread.join()
+            if self._error is None and self._compress_type == 'bgzip':
+                self._wf.write(_bgzf_eof)
+            self._wf.close()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def open_binary(filepath):
+    """open a plain/compressed file for reading bytes, the decompressed bytes if compressed"""
+    compress_type = detect_compress_type(filepath)
+    if compress_type == 'gzip':
+        return gzip.open(filepath, 'rb')
+    if compress_type == 'zstd':
+        if zstandard is None:
+            raise ImportError("module zstandard is needed to read {}, please install it "
+                              "(pip install zstandard)".format(filepath))
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(filepath, 'rb'),
+                                                                          read_across_frames=True,
+                                                                          closefd=True))
+    return open(filepath, 'rb')
+
+
+def open_text(filepath):
+    """open a plain/compressed text file for reading, lines are decompressed transparently"""
+    if detect_compress_type(filepath) is None:
+        return open(filepath, 'r')
+    return io.TextIOWrapper(open_binary(filepath), encoding="UTF-8")
+
+
+def is_compressed(filepath):
+    return detect_compress_type(filepath) is not None
+
+
+def decompress_file(filepath, write_fp):
+    """decompress filepath to write_fp, in a streaming way"""
+    with open_binary(filepath) as rf, open(write_fp, 'wb') as wf:
+        shutil.copyfileobj(rf, wf, 16 * 1024 * 1024)
@@ -0,0 +1,112 @@
+"""a persistent catalog (SQLite) of the reads in a fast5 directory: path, read_id, alignment
+and signal length of each read, and whether the corrected group exists, so that later runs
+list, prefilter and schedule reads without walking the directory or opening the fast5 files.
+"""
+
+from __future__ import absolute_import
+
+import os
+import sqlite3
+
+from .fast5_reader import _open_fast5
+from .fast5_reader import _get_read_keys
+from .fast5_reader import _get_read_id_n_signal_len
+from .fast5_reader import _get_aligned_interval
+
+index_columns = ['path', 'read_key', 'read_id', 'chrom', 'strand', 'mapped_start', 'mapped_end',
+                 'signal_len', 'has_corrected_group']
+
+
+def get_default_index_path(fast5_dir):
+    return os.path.abspath(fast5_dir).rstrip("/") + ".index.sqlite"
+
+
+def index_a_fast5(fast5_path, corrected_group, basecall_subgroup):
+    """
+    :return: rows (as index_columns) of the reads in a fast5 file, a file which can not be
+             opened is one row with has_corrected_group 0
+    """
+    fast5_path = os.path.abspath(fast5_path)
+    rows = []
+    try:
+        with _open_fast5(fast5_path) as h5file:
+            for read_key in _get_read_keys(h5file):
+                try:
+                    read_id, signal_len = _get_read_id_n_signal_len(h5file, read_key)
+                except Exception:
+                    read_id, signal_len = None, 0
+                try:
+                    chrom, alignstrand, start, end = _get_aligned_interval(h5file, corrected_group,
+                                                                           basecall_subgroup, read_key)
+                    rows.append((fast5_path, read_key, read_id, chrom, alignstrand, start, end, signal_len, 1))
+                except Exception:
+                    rows.append((fast5_path, read_key, read_id, None, None, None, None, signal_len, 0))
+    except IOError:
+        rows.append((fast5_path, None, None, None, None, None, None, 0, 0))
+    return rows
+
+
+class Fast5IndexWriter(object):
+    def __init__(self, index_path, fast5_dir, corrected_group, basecall_subgroup):
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        self._conn = sqlite3.connect(index_path)
+        self._conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._conn.execute("CREATE TABLE reads (path TEXT NOT NULL, read_key TEXT, read_id TEXT, "
+                           "chrom TEXT, strand TEXT, mapped_start INTEGER, mapped_end INTEGER, "
+                           "signal_len INTEGER, has_corrected_group INTEGER)")
+        self._conn.executemany("INSERT INTO meta VALUES (?, ?)",
+                               [('fast5_dir', os.path.abspath(fast5_dir)),
+                                ('corrected_group', corrected_group),
+                                ('basecall_subgroup', basecall_subgroup)])
+
+    def write(self, rows):
+        self._conn.executemany("INSERT INTO reads VALUES ({})".format(",".join(["?"] * len(index_columns))),
+                               rows)
+
+    def close(self):
+        self._conn.execute("CREATE INDEX reads_chrom_start ON reads (chrom, mapped_start)")
+        self._conn.commit()
+        self._conn.close()
+
+
+def read_fast5_index_meta(index_path):
+    conn = sqlite3.connect(index_path)
+    try:
+        return dict(conn.execute("SELECT key, value FROM meta").fetchall())
+    finally:
+        conn.close()
+
+
+def read_fast5_index(index_path, corrected_group, basecall_subgroup, site_filter=None):
+    """
+    list the reads in a fast5 index, for extract/call_mods
+    :param index_path:
+    :param corrected_group: must be the same as the one the index was built with
+    :param basecall_subgroup: must be the same as the one the index was built with
+    :param site_filter: PositionSet/RegionSet/SiteFilter or None, reads having no site of interest
+                        in their aligned interval are skipped
+    :return: read_items [(fast5_path, read_key)], read_costs (bytes of raw signal), number of reads
+             skipped as unusable (no corrected group, or the file can not be opened)
+    """
+    if not os.path.isfile(index_path):
+        raise ValueError("--fast5_index {} does not exist!".format(index_path))
+    meta = read_fast5_index_meta(index_path)
+    if meta['corrected_group'] != corrected_group or meta['basecall_subgroup'] != basecall_subgroup:
+        raise ValueError("the fast5 index is built with corrected_group/basecall_subgroup {}/{}, not {}/{}, "
+                         "please build it again".format(meta['corrected_group'], meta['basecall_subgroup'],
+                                                        corrected_group, basecall_subgroup))
+    read_items, read_costs = [], []
+    conn = sqlite3.connect(index_path)
+    try:
+        unusable_num = conn.execute("SELECT COUNT(*) FROM reads WHERE has_corrected_group = 0").fetchone()[0]
+        for fast5_path, read_key, chrom, strand, start, end, signal_len in \
+                conn.execute("SELECT path, read_key, chrom, strand, mapped_start, mapped_end, signal_len "
+                             "FROM reads WHERE has_corrected_group = 1 ORDER BY rowid"):
+            if site_filter is not None and not site_filter.has_site_in(chrom, strand, start, end):
+                continue
+            read_items.append((fast5_path, read_key))
+            read_costs.append(signal_len * 2)
+    finally:
+        conn.close()
+    return read_items, read_costs, unusable_num
@@ -0,0 +1,367 @@
+"""read everything deepsignal2 needs from a (tombo re-squiggled) fast5 file
+in a single h5py session: raw signal, events, channel scaling and alignment.
+both single-read and multi-read (read_<id> groups) fast5 files are supported.
+"""
+
+from __future__ import absolute_import
+
+import os
+import io
+import sys
+import h5py
+import multiprocessing as mp
+import numpy as np
+
+reads_group = 'Raw/Reads'
+global_key = 'UniqueGlobalKey/'
+multi_read_prefix = 'read_'
+
+
+def _attr_to_str(attr_val):
+    if sys.version_info[0] >= 3 and type(attr_val) is bytes:
+        return str(attr_val, 'utf-8')
+    attr_val = str(attr_val) if type(attr_val) is not str else attr_val
+    if attr_val.startswith("b'"):
+        attr_val = attr_val.split("'")[1]
+    return attr_val
+
+
+class Fast5Read:
+    """all the info of a read used by feature extraction, read from one fast5 open"""
+
+    def __init__(self, fast5_path, readname, raw_signal, event_starts, event_lens, bases,
+                 scaling, offset, strand, alignstrand, chrom, chrom_start):
+        self.fast5_path = fast5_path
+        self.readname = readname
+        self.raw_signal = raw_signal  # int16 DAC values
+        self.event_starts = event_starts  # already shifted by read_start_rel_to_raw
+        self.event_lens = event_lens
+        self.bases = bases
+        self.scaling = scaling
+        self.offset = offset
+        self.strand = strand
+        self.alignstrand = alignstrand
+        self.chrom = chrom
+        self.chrom_start = chrom_start
+
+
+def _get_raw_signal(h5file, read_key=None):
+    try:
+        if read_key is None:
+            raw_dat = list(h5file[reads_group].values())[0]
+        else:
+            raw_dat = h5file['/'.join([read_key, 'Raw'])]
+        read_id = _attr_to_str(raw_dat.attrs['read_id'])
+        raw_signal = raw_dat['Signal'][()]
+    except Exception:
+        raise RuntimeError('Raw data is not stored in Raw/Reads/Read_[read#] (or read_[read_id]/Raw) so '
+                           'new segments cannot be identified.')
+    return read_id, raw_signal
+
+
+def _get_read_id_n_signal_len(h5file, read_key=None):
+    """ read_id and raw signal length of a read, from the attrs and the dataset shape only """
+    if read_key is None:
+        raw_dat = list(h5file[reads_group].values())[0]
+    else:
+        raw_dat = h5file['/'.join([read_key, 'Raw'])]
+    return _attr_to_str(raw_dat.attrs['read_id']), raw_dat['Signal'].shape[0]
+
+
+def _get_analyses_path(corrected_group, basecall_subgroup, read_key=None):
+    if read_key is None:
+        return '/'.join(['Analyses', corrected_group, basecall_subgroup])
+    return '/'.join([read_key, 'Analyses', corrected_group, basecall_subgroup])
+
+
+def _get_events(h5file, corrected_group, basecall_subgroup, read_key=None):
+    try:
+        event = h5file['/'.join([_get_analyses_path(corrected_group, basecall_subgroup, read_key), 'Events'])]
+    except Exception:
+        raise RuntimeError('events not found.')
+
+    try:
+        read_start_rel_to_raw = event.attrs['read_start_rel_to_raw']
+    except KeyError:
+        raise KeyError('no read_start_rel_to_raw in event attributes')
+
+    # read the compound dataset once, instead of once per column
+    events = event[()]
+    starts = events['start'].astype(np.int64) + read_start_rel_to_raw
+    lengths = events['length'].astype(np.int64)
+    bases = b''.join(events['base']).decode("UTF-8")
+    assert len(starts) == len(lengths) == len(bases)
+    return starts, lengths, bases
+
+
+def _get_scaling(h5file, read_key=None):
+    if read_key is None:
+        channel_info = h5file[global_key + 'channel_id'].attrs
+    else:
+        channel_info = h5file['/'.join([read_key, 'channel_id'])].attrs
+    digi = channel_info['digitisation']
+    parange = channel_info['range']
+    offset = channel_info['offset']
+    scaling = parange / digi
+    return scaling, offset
+
+
+def _get_alignment_attrs(h5file, corrected_group, basecall_subgroup, read_key=None):
+    strand_path = _get_analyses_path(corrected_group, basecall_subgroup, read_key)
+    alignment_path = '/'.join([strand_path, 'Alignment'])
+    if alignment_path not in h5file:
+        raise RuntimeError('alignment not found.')
+    alignment_attrs = h5file[alignment_path].attrs
+
+    strand = 't' if strand_path.endswith('template') else 'c'
+    alignstrand = _attr_to_str(alignment_attrs['mapped_strand'])
+    chrom = _attr_to_str(alignment_attrs['mapped_chrom'])
+    chrom_start = alignment_attrs['mapped_start']
+    return strand, alignstrand, chrom, chrom_start
+
+
+def _get_aligned_interval(h5file, corrected_group, basecall_subgroup, read_key=None):
+    """
+    chrom, aligned strand, and [start, end) (in the forward strand) of a read, from the alignment attrs
+    and the shape of the events dataset only, without reading the raw signal or the events
+    """
+    strand, alignstrand, chrom, chrom_start = _get_alignment_attrs(h5file, corrected_group,
+                                                                   basecall_subgroup, read_key)
+    event_num = h5file['/'.join([_get_analyses_path(corrected_group, basecall_subgroup, read_key),
+                                 'Events'])].shape[0]
+    return chrom, alignstrand, int(chrom_start), int(chrom_start) + event_num
+
+
+def _is_multi_read(h5file):
+    return 'Raw' not in h5file and any(key.startswith(multi_read_prefix) for key in h5file.keys())
+
+
+def _get_read_keys(h5file):
+    if not _is_multi_read(h5file):
+        return [None]
+    return [key for key in h5file.keys() if key.startswith(multi_read_prefix)]
+
+
+def _read_a_read(h5file, fast5_path, corrected_group, basecall_subgroup, read_key=None):
+    readname, raw_signal = _get_raw_signal(h5file, read_key)
+    starts, lengths, bases = _get_events(h5file, corrected_group, basecall_subgroup, read_key)
+    scaling, offset = _get_scaling(h5file, read_key)
+    strand, alignstrand, chrom, chrom_start = _get_alignment_attrs(h5file, corrected_group,
+                                                                   basecall_subgroup, read_key)
+    return Fast5Read(fast5_path, readname, raw_signal, starts, lengths, bases,
+                     scaling, offset, strand, alignstrand, chrom, chrom_start)
+
+
+def _open_fast5(fast5_path, file_bytes=None):
+    try:
+        if file_bytes is not None:
+            try:
+                return h5py.File(io.BytesIO(file_bytes), 'r')
+            except (TypeError, ValueError):
+                # file-like objects are supported by h5py>=2.9, open the file by path instead
+                pass
+        return h5py.File(fast5_path, 'r')
+    except IOError:
+        raise IOError('Error opening file. Likely a corrupted file.')
+
+
+def read_fast5(fast5_path, corrected_group='RawGenomeCorrected_000',
+               basecall_subgroup='BaseCalled_template'):
+    """
+    open a single-read fast5 file once, and read signal, events, scaling and alignment of the read in it
+    :param fast5_path:
+    :param corrected_group:
+    :param basecall_subgroup:
+    :return: Fast5Read
+    """
+    with _open_fast5(fast5_path) as h5file:
+        return _read_a_read(h5file, fast5_path, corrected_group, basecall_subgroup)
+
+
+def iter_fast5_reads(fast5_path, corrected_group='RawGenomeCorrected_000',
+                     basecall_subgroup='BaseCalled_template', read_keys=None, read_filter=None,
+                     file_bytes=None):
+    """
+    open a (single-read or multi-read) fast5 file once, and yield the reads in it.
+    a read which can not be read (e.g. not re-squiggled) is yielded as None.
+    :param fast5_path:
+    :param corrected_group:
+    :param basecall_subgroup:
+    :param read_keys: read_<id> groups to be read, None for all reads in the file
+    :param read_filter: function(chrom, alignstrand, start, end), reads it returns False for are
+                        skipped (not yielded), judged by the alignment attrs before the signal is loaded
+    :param file_bytes: content of the fast5 file already in memory (see prefetch_fast5()), None to read
+                       from fast5_path
+    :return: generator of Fast5Read/None
+    """
+    with _open_fast5(fast5_path, file_bytes) as h5file:
+        if read_keys is None:
+            read_keys = _get_read_keys(h5file)
+        for read_key in read_keys:
+            try:
+                if read_filter is not None and \
+                        not read_filter(*_get_aligned_interval(h5file, corrected_group, basecall_subgroup,
+                                                               read_key)):
+                    continue
+                yield _read_a_read(h5file, fast5_path, corrected_group, basecall_subgroup, read_key)
+            except Exception:
+                yield None
+
+
+def _get_dataset_ranges(dset):
+    """ (offset, size) of the bytes of a dataset in the file, one per chunk for a chunked dataset """
+    offset = dset.id.get_offset()
+    if offset is not None:
+        return [(offset, dset.id.get_storage_size())]
+    if not hasattr(dset.id, "get_chunk_info"):
+        # h5py<2.10, the chunks are not prefetched
+        return []
+    ranges = []
+    for chunk_idx in range(dset.id.get_num_chunks()):
+        chunk_info = dset.id.get_chunk_info(chunk_idx)
+        ranges.append((chunk_info.byte_offset, chunk_info.size))
+    return ranges
+
+
+def prefetch_fast5(fast5_path, read_keys=None, corrected_group='RawGenomeCorrected_000',
+                   basecall_subgroup='BaseCalled_template'):
+    """
+    load the data of the reads in a fast5 file ahead of reading them, by plain file reads, which release
+    the GIL (h5py does not), so it can overlap with the feature computation in another thread.
+    a single-read fast5 file is read into memory as a whole, for a multi-read fast5 file, only the bytes
+    of the signal/events datasets of read_keys are read, into the page cache.
+    :param fast5_path:
+    :param read_keys: read_<id> groups to be read, None for a single-read fast5
+    :return: content of the single-read fast5 file (for iter_fast5_reads(file_bytes=)), or None
+    """
+    if read_keys is None:
+        with open(fast5_path, 'rb') as rf:
+            return rf.read()
+    ranges = []
+    with _open_fast5(fast5_path) as h5file:
+        for read_key in read_keys:
+            for dset_path in ['/'.join([read_key, 'Raw', 'Signal']),
+                              '/'.join([_get_analyses_path(corrected_group, basecall_subgroup, read_key),
+                                        'Events'])]:
+                if dset_path in h5file:
+                    ranges += _get_dataset_ranges(h5file[dset_path])
+    fd = os.open(fast5_path, os.O_RDONLY)
+    try:
+        for offset, size in sorted(ranges):
+            os.pread(fd, size, offset)
+    finally:
+        os.close(fd)
+    return None
+
+
+def _get_read_signal_len(h5file, read_key):
+    try:
+        return h5file['/'.join([read_key, 'Raw', 'Signal'])].shape[0]
+    except Exception:
+        return 0
+
+
+def _get_read_items_n_costs_of_fast5(fast5_path):
+    """
+    (fast5_path, read_key) items and the estimated costs of the reads in a fast5 file, see
+    get_fast5_read_items_n_costs()
+    """
+    try:
+        with _open_fast5(fast5_path) as h5file:
+            if _is_multi_read(h5file):
+                read_keys = _get_read_keys(h5file)
+                return [(fast5_path, read_key) for read_key in read_keys], \
+                    [_get_read_signal_len(h5file, read_key) * 2 for read_key in read_keys]
+    except IOError:
+        # kept as a single-read item, counted as failed when it is extracted
+        print("the {} can't be opened".format(fast5_path))
+    try:
+        read_cost = os.path.getsize(fast5_path)
+    except OSError:
+        read_cost = 0
+    return [(fast5_path, None)], [read_cost]
+
+
+def get_fast5_read_items_n_costs(fast5_files, nproc=1):
+    """
+    list the reads in fast5 files as (fast5_path, read_key) items, read_key is None for
+    single-read fast5 files. each file is opened to tell its layout, so single-read and multi-read
+    fast5 files can be mixed in a directory. the files are opened by nproc processes (not one
+    by one in the main process), in the order of fast5_files.
+    the estimated cost of each read is the file size for a single-read fast5, and the bytes
+    of the raw signal (read from the dataset shape, not the data) for a read in a multi-read fast5.
+    :param fast5_files:
+    :param nproc: number of processes to list the files
+    :return: read_items, read_costs
+    """
+    pool = None
+    if nproc > 1 and len(fast5_files) > 1:
+        pool = mp.Pool(min(nproc, len(fast5_files)))
+        results_iter = pool.imap(_get_read_items_n_costs_of_fast5, fast5_files, chunksize=64)
+    else:
+        results_iter = map(_get_read_items_n_costs_of_fast5, fast5_files)
+    read_items, read_costs = [], []
+    for f_read_items, f_read_costs in results_iter:
+        read_items += f_read_items
+        read_costs += f_read_costs
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return read_items, read_costs
+
+
+def schedule_read_batches(read_items, read_costs, batch_size):
+    """
+    split reads into batches balanced by estimated cost instead of by read count, longest first:
+    reads are sorted by cost (descending), and a batch is closed once its cost reaches the remaining
+    cost / the remaining number of ceil(len(read_items) / batch_size) batches, so the number of batches
+    is about the same as fixed-size batching, but a batch of ultra-long reads no longer straggles at the tail.
+    :param read_items: (fast5_path, read_key) items
+    :param read_costs: estimated cost of each read, None for fixed-size batches in the original order
+    :param batch_size:
+    :return: list of batches, each is a list of (fast5_path, read_keys) as group_read_items()
+    """
+    if read_costs is None:
+        return [group_read_items(read_items[i:(i + batch_size)])
+                for i in range(0, len(read_items), batch_size)]
+    read_costs = np.asarray(read_costs, dtype=np.float64)
+    if len(read_items) == 0 or read_costs.sum() <= 0:
+        return schedule_read_batches(read_items, None, batch_size)
+    order = np.argsort(-read_costs, kind='stable')
+    batch_num = int(np.ceil(float(len(read_items)) / batch_size))
+    remain_cost = read_costs.sum()
+
+    batches = []
+    batch_idxs, batch_cost = [], 0.0
+    for idx in order:
+        batch_idxs.append(idx)
+        batch_cost += read_costs[idx]
+        # the target is re-estimated from the remaining reads, a read costlier than it makes a batch alone
+        # reads of unknown (0) cost at the tail are batched by count
+        if batch_cost >= remain_cost / max(batch_num - len(batches), 1) and \
+                (batch_cost > 0 or len(batch_idxs) >= batch_size):
+            batches.append(batch_idxs)
+            remain_cost -= batch_cost
+            batch_idxs, batch_cost = [], 0.0
+    if len(batch_idxs) > 0:
+        batches.append(batch_idxs)
+    # keep the reads of a multi-read fast5 together in a batch, so that the file is opened once
+    return [group_read_items([read_items[idx] for idx in sorted(batch_idxs)]) for batch_idxs in batches]
+
+
+def group_read_items(read_items):
+    """
+    group (fast5_path, read_key) items of the same fast5 file to (fast5_path, read_keys),
+    so that a fast5 file is opened only once for a batch
+    :param read_items:
+    :return:
+    """
+    fast5_groups = []
+    for fast5_path, read_key in read_items:
+        if read_key is None:
+            fast5_groups.append((fast5_path, None))
+        elif len(fast5_groups) > 0 and fast5_groups[-1][0] == fast5_path and fast5_groups[-1][1] is not None:
+            fast5_groups[-1][1].append(read_key)
+        else:
+            fast5_groups.append((fast5_path, [read_key]))
+    return fast5_groups
@@ -0,0 +1,183 @@
+"""binary columnar (HDF5) format of the extracted features, an alternative to the tsv format.
+each column is a chunked, resizable dataset in the file, so that features can be appended
+batch by batch, and read back (in slices or by index) without any text parsing.
+"""
+
+from __future__ import absolute_import
+
+import h5py
+import numpy as np
+
+from .process_utils import base2code_dna
+from .process_utils import code2base_dna
+
+features_h5_format = 'deepsignal2_features'
+features_chunk_rows = 1024
+
+# sampleinfo columns, as in the first 6 columns of the tsv format
+sampleinfo_cols = ['chrom', 'pos', 'strand', 'pos_in_strand', 'readname', 'read_strand']
+features_cols = sampleinfo_cols + ['kmer', 'base_means', 'base_stds', 'base_signal_lens', 'signals', 'label']
+# str columns, kept as lists in a dict of column arrays
+_list_cols = ('chrom', 'strand', 'readname', 'read_strand')
+
+_base2code_lut = np.full(256, base2code_dna['N'], dtype=np.int8)
+for _base, _code in base2code_dna.items():
+    _base2code_lut[ord(_base)] = _code
+_code2ascii_lut = np.frombuffer(''.join([code2base_dna[_code] for _code in range(len(code2base_dna))]).encode(),
+                                dtype=np.uint8)
+
+
+def _get_col_dtypes_n_shapes(kmer_len, signal_len):
+    str_dtype = h5py.special_dtype(vlen=str)
+    return {'chrom': (str_dtype, ()),
+            'pos': (np.int64, ()),
+            'strand': ('S1', ()),
+            'pos_in_strand': (np.int64, ()),
+            'readname': (str_dtype, ()),
+            'read_strand': ('S1', ()),
+            'kmer': (np.int8, (kmer_len, )),
+            'base_means': (np.float32, (kmer_len, )),
+            'base_stds': (np.float32, (kmer_len, )),
+            'base_signal_lens': (np.int32, (kmer_len, )),
+            'signals': (np.float32, (kmer_len, signal_len)),
+            'label': (np.int8, ())}
+
+
+def kmers_to_codes(kmers):
+    """
+    :param kmers: list of kmer strs of the same length
+    :return: int8 array of shape (len(kmers), kmer_len)
+    """
+    if len(kmers) == 0:
+        return np.zeros((0, 0), dtype=np.int8)
+    kmer_bytes = np.frombuffer(''.join(kmers).encode("UTF-8"), dtype=np.uint8)
+    return _base2code_lut[kmer_bytes].reshape((len(kmers), -1))
+
+
+def codes_to_kmers(codes):
+    """
+    :param codes: int array of shape (n, kmer_len)
+    :return: list of n kmer strs
+    """
+    return [kmer_bytes.tobytes().decode("UTF-8") for kmer_bytes in _code2ascii_lut[codes]]
+
+
+def get_empty_features_arrays(kmer_len, signal_len):
+    features_arrays = dict()
+    for col, (col_dtype, col_shape) in _get_col_dtypes_n_shapes(kmer_len, signal_len).items():
+        features_arrays[col] = [] if col in _list_cols else np.zeros((0, ) + col_shape, dtype=col_dtype)
+    return features_arrays
+
+
+def concat_features_arrays(features_arrays_list, kmer_len, signal_len):
+    """
+    :param features_arrays_list: list of dicts of column arrays, e.g. of the reads in a batch
+    :return: dict of column arrays
+    """
+    if len(features_arrays_list) == 0:
+        return get_empty_features_arrays(kmer_len, signal_len)
+    if len(features_arrays_list) == 1:
+        return features_arrays_list[0]
+    features_arrays = dict()
+    for col in features_cols:
+        if col in _list_cols:
+            features_arrays[col] = [x for f_arrays in features_arrays_list for x in f_arrays[col]]
+        else:
+            features_arrays[col] = np.concatenate([f_arrays[col] for f_arrays in features_arrays_list])
+    return features_arrays
+
+
+def is_features_h5(features_file):
+    return h5py.is_hdf5(features_file)
+
+
+class FeaturesH5Writer(object):
+    """ Append batches of features (dict of column arrays) to a HDF5 features file """
+
+    def __init__(self, h5_path, kmer_len, signal_len, chunk_rows=features_chunk_rows, resume_num=None):
+        """
+        :param resume_num: if not None, append to the existing h5_path after its first resume_num samples
+        """
+        if resume_num is not None:
+            self._h5file = h5py.File(h5_path, 'r+')
+            for col in features_cols:
+                self._h5file[col].resize(resume_num, axis=0)
+            self._num = resume_num
+            return
+        self._h5file = h5py.File(h5_path, 'w')
+        self._h5file.attrs['format'] = features_h5_format
+        self._h5file.attrs['kmer_len'] = kmer_len
+        self._h5file.attrs['signal_len'] = signal_len
+        self._num = 0
+        for col, (col_dtype, col_shape) in _get_col_dtypes_n_shapes(kmer_len, signal_len).items():
+            self._h5file.create_dataset(col, shape=(0, ) + col_shape, maxshape=(None, ) + col_shape,
+                                        dtype=col_dtype, chunks=(chunk_rows, ) + col_shape)
+
+    def write(self, features_arrays):
+        batch_num = len(features_arrays['label'])
+        if batch_num == 0:
+            return
+        for col in features_cols:
+            dset = self._h5file[col]
+            dset.resize(self._num + batch_num, axis=0)
+            col_array = features_arrays[col]
+            if col in ('strand', 'read_strand'):
+                col_array = np.array(col_array, dtype='S1')
+            dset[self._num:(self._num + batch_num)] = col_array
+        self._num += batch_num
+
+    def get_num(self):
+        return self._num
+
+    def flush(self):
+        self._h5file.flush()
+
+    def close(self):
+        self._h5file.close()
+
+
+def read_features_h5(h5file, start, end):
+    """
+    :param h5file: an opened h5py.File
+    :return: dict of column arrays of samples [start, end)
+    """
+    features_arrays = dict()
+    for col in features_cols:
+        col_array = h5file[col][start:end]
+        if col in ('chrom', 'readname'):
+            col_array = [x.decode("UTF-8") if isinstance(x, bytes) else x for x in col_array]
+        elif col in ('strand', 'read_strand'):
+            col_array = [x.decode("UTF-8") for x in col_array]
+        features_arrays[col] = col_array
+    return features_arrays
+
+
+def get_siteinfo_array(features_arrays):
+    """sampleinfo columns (the first 6 columns of the tsv format) as a structured array, a record per sample"""
+    cols = [np.asarray(features_arrays[col]) for col in sampleinfo_cols]
+    siteinfo = np.empty(len(cols[0]), dtype=[(col, col_array.dtype) for col, col_array in zip(sampleinfo_cols, cols)])
+    for col, col_array in zip(sampleinfo_cols, cols):
+        siteinfo[col] = col_array
+    return siteinfo
+
+
+def get_features_batch(features_arrays):
+    """
+    a batch of features for calling, as contiguous typed arrays
+    :param features_arrays: dict of column arrays
+    :return: siteinfo (structured array, see get_siteinfo_array()), kmer (int8), base_means (float32),
+             base_stds (float32), base_signal_lens (int32), signals (float32), label (int8)
+    """
+    return (get_siteinfo_array(features_arrays),
+            np.ascontiguousarray(features_arrays['kmer'], dtype=np.int8),
+            np.ascontiguousarray(features_arrays['base_means'], dtype=np.float32),
+            np.ascontiguousarray(features_arrays['base_stds'], dtype=np.float32),
+            np.ascontiguousarray(features_arrays['base_signal_lens'], dtype=np.int32),
+            np.ascontiguousarray(features_arrays['signals'], dtype=np.float32),
+            np.ascontiguousarray(features_arrays['label'], dtype=np.int8))
+
+
+def get_sampleinfo_strs(features_arrays):
+    """sampleinfo of each sample as in the tsv format (the first 6 columns, joined by tab)"""
+    return ["\t".join([str(x) for x in sampleinfo])
+            for sampleinfo in zip(*[features_arrays[col] for col in sampleinfo_cols])]
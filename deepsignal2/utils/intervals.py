@@ -0,0 +1,187 @@
+"""positions/regions of interest held as sorted numpy arrays per chromosome (and strand), so that
+both a read's aligned interval and the sites in a read can be checked by binary search.
+"""
+
+from __future__ import absolute_import
+
+import os
+import numpy as np
+
+
+class PositionSet(object):
+    """ positions (0-based, in the forward strand) of interest, per (chrom, strand) """
+
+    def __init__(self, chrom_strand2poses):
+        """
+        :param chrom_strand2poses: dict of (chrom, strand) -> iterable of positions
+        """
+        self._poses = dict()
+        for chrom_strand, poses in chrom_strand2poses.items():
+            self._poses[chrom_strand] = np.unique(np.asarray(poses, dtype=np.int64))
+
+    def __len__(self):
+        return sum([len(poses) for poses in self._poses.values()])
+
+    def has_site_in(self, chrom, strand, start, end):
+        """ whether there is any position in [start, end) of chrom/strand """
+        poses = self._poses.get((chrom, strand))
+        if poses is None:
+            return False
+        return np.searchsorted(poses, start, side='left') < np.searchsorted(poses, end, side='left')
+
+    def contains(self, chrom, strand, poses):
+        """
+        :param poses: array of positions
+        :return: bool array, whether each of poses is in the set
+        """
+        poses = np.asarray(poses, dtype=np.int64)
+        set_poses = self._poses.get((chrom, strand))
+        if set_poses is None or len(set_poses) == 0:
+            return np.zeros(poses.shape, dtype=bool)
+        idxs = np.minimum(np.searchsorted(set_poses, poses), len(set_poses) - 1)
+        return set_poses[idxs] == poses
+
+
+def read_position_file(position_file):
+    """
+    :param position_file: tab-separated chromosome, position (in fwd strand), strand
+    :return: PositionSet
+    """
+    chrom_strand2poses = dict()
+    with open(position_file, 'r') as rf:
+        for line in rf:
+            if line.startswith("#"):
+                continue
+            words = line.strip().split("\t")
+            if len(words) < 3:
+                continue
+            try:
+                pos = int(words[1])
+            except ValueError:
+                # e.g. a header line
+                continue
+            chrom_strand2poses.setdefault((words[0], words[2]), []).append(pos)
+    return PositionSet(chrom_strand2poses)
+
+
+class RegionSet(object):
+    """ regions (0-based, [start, end), in the forward strand) of interest, of both strands """
+
+    def __init__(self, chrom2intervals):
+        """
+        :param chrom2intervals: dict of chrom -> list of (start, end), end is None for the whole chrom
+        """
+        self._starts = dict()
+        self._ends = dict()
+        for chrom, intervals in chrom2intervals.items():
+            intervals = sorted([(start, np.iinfo(np.int64).max if end is None else end)
+                                for start, end in intervals])
+            # merge overlapping intervals, so that starts and ends are both sorted
+            merged = []
+            for start, end in intervals:
+                if len(merged) > 0 and start <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], end)
+                else:
+                    merged.append([start, end])
+            self._starts[chrom] = np.array([x[0] for x in merged], dtype=np.int64)
+            self._ends[chrom] = np.array([x[1] for x in merged], dtype=np.int64)
+
+    def get_chroms(self):
+        return list(self._starts.keys())
+
+    def has_site_in(self, chrom, strand, start, end):
+        """ whether [start, end) of chrom overlaps any region """
+        starts = self._starts.get(chrom)
+        if starts is None:
+            return False
+        # the last region starting before end
+        idx = np.searchsorted(starts, end, side='left') - 1
+        return idx >= 0 and self._ends[chrom][idx] > start
+
+    def contains(self, chrom, strand, poses):
+        """
+        :param poses: array of positions
+        :return: bool array, whether each of poses is in any region
+        """
+        poses = np.asarray(poses, dtype=np.int64)
+        starts = self._starts.get(chrom)
+        if starts is None:
+            return np.zeros(poses.shape, dtype=bool)
+        idxs = np.searchsorted(starts, poses, side='right') - 1
+        return (idxs >= 0) & (poses < self._ends[chrom][np.maximum(idxs, 0)])
+
+
+def _parse_region_str(region_str):
+    """ chr1:0-10000 (0-based, end exclusive), or chr1 for the whole chromosome """
+    if ":" not in region_str:
+        return region_str, (0, None)
+    chrom, interval = region_str.rsplit(":", 1)
+    try:
+        start, end = interval.replace(",", "").split("-")
+        start, end = int(start), int(end)
+    except ValueError:
+        raise ValueError("wrong format of region: {}, should be like chr1:0-10000".format(region_str))
+    if start >= end:
+        raise ValueError("wrong region: {}, start must be less than end".format(region_str))
+    return chrom, (start, end)
+
+
+def _read_bed_regions(bed_file):
+    regions = []
+    with open(bed_file, 'r') as rf:
+        for line in rf:
+            if line.startswith("#") or line.startswith("track") or line.startswith("browser"):
+                continue
+            words = line.strip().split("\t")
+            if len(words) < 3:
+                continue
+            regions.append((words[0], (int(words[1]), int(words[2]))))
+    return regions
+
+
+def parse_regions(region_args):
+    """
+    :param region_args: list of --region values, each is a BED file, or regions like chr1:0-10000
+                        (or chr1) splited by comma
+    :return: RegionSet, or None if region_args is empty
+    """
+    if region_args is None or len(region_args) == 0:
+        return None
+    chrom2intervals = dict()
+    for region_arg in region_args:
+        if os.path.isfile(region_arg):
+            regions = _read_bed_regions(region_arg)
+        else:
+            regions = [_parse_region_str(x) for x in region_arg.split(",") if x != ""]
+        for chrom, interval in regions:
+            chrom2intervals.setdefault(chrom, []).append(interval)
+    return RegionSet(chrom2intervals)
+
+
+class SiteFilter(object):
+    """ intersection of PositionSets/RegionSets, with the same has_site_in()/contains() interface """
+
+    def __init__(self, site_filters):
+        self._site_filters = site_filters
+
+    def has_site_in(self, chrom, strand, start, end):
+        return all([x.has_site_in(chrom, strand, start, end) for x in self._site_filters])
+
+    def contains(self, chrom, strand, poses):
+        is_wanted = np.ones(np.shape(poses), dtype=bool)
+        for site_filter in self._site_filters:
+            is_wanted &= site_filter.contains(chrom, strand, poses)
+        return is_wanted
+
+
+def combine_site_filters(site_filters):
+    """
+    :param site_filters: PositionSets/RegionSets/None
+    :return: None if no filter, the filter itself if only one, or their SiteFilter
+    """
+    site_filters = [x for x in site_filters if x is not None]
+    if len(site_filters) == 0:
+        return None
+    if len(site_filters) == 1:
+        return site_filters[0]
+    return SiteFilter(site_filters)
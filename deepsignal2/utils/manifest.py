@@ -0,0 +1,95 @@
+"""append-only manifest of the fast5 reads whose results are already written, for resuming
+extract/call_mods. for each finished batch, the writer appends one line per read
+(fast5_path, read_key), then a commit line with the size of the result file after
+the batch (bytes of a text file, or samples of a h5 file):
+    fast5_path\tread_key
+    ...
+    #\tresult_size
+reads after the last commit line (a torn write) are not taken as done.
+"""
+
+from __future__ import absolute_import
+
+import os
+
+commit_mark = "#"
+
+
+def get_manifest_path(result_path):
+    return result_path.rstrip("/") + ".manifest"
+
+
+def expand_fast5s(fast5s):
+    """
+    :param fast5s: a batch of (fast5_path, read_keys) as group_read_items()
+    :return: list of (fast5_path, read_key)
+    """
+    read_items = []
+    for fast5_path, read_keys in fast5s:
+        if read_keys is None:
+            read_items.append((fast5_path, None))
+        else:
+            read_items += [(fast5_path, read_key) for read_key in read_keys]
+    return read_items
+
+
+class ManifestWriter(object):
+    def __init__(self, manifest_path, is_append=False):
+        self._wf = open(manifest_path, 'a' if is_append else 'w')
+
+    def commit(self, fast5s, result_size):
+        """
+        record a batch of reads as done, call it after the results of the batch are flushed
+        :param fast5s: a batch of (fast5_path, read_keys)
+        :param result_size: size of the result file after the batch
+        """
+        lines = ["\t".join([fast5_path, "" if read_key is None else read_key]) + "\n"
+                 for fast5_path, read_key in expand_fast5s(fast5s)]
+        lines.append("\t".join([commit_mark, str(result_size)]) + "\n")
+        self._wf.write("".join(lines))
+        self._wf.flush()
+
+    def close(self):
+        self._wf.close()
+
+
+def read_manifest(manifest_path):
+    """
+    :param manifest_path:
+    :return: set of done (fast5_path, read_key), result size at the last commit,
+             bytes of the manifest up to the last commit
+    """
+    done_reads = set()
+    result_size, manifest_size = 0, 0
+    pending_reads = []
+    offset = 0
+    with open(manifest_path, 'rb') as rf:
+        for line in rf:
+            offset += len(line)
+            if not line.endswith(b"\n"):
+                break
+            words = line.decode("UTF-8").rstrip("\n").split("\t")
+            if words[0] == commit_mark:
+                done_reads.update(pending_reads)
+                pending_reads = []
+                result_size, manifest_size = int(words[1]), offset
+            else:
+                pending_reads.append((words[0], words[1] if words[1] != "" else None))
+    return done_reads, result_size, manifest_size
+
+
+def prepare_resume(result_path):
+    """
+    read the manifest of result_path, and cut the manifest to its last commit
+    :param result_path:
+    :return: set of done (fast5_path, read_key), result size to be resumed from (None if there
+             is nothing to resume from)
+    """
+    manifest_path = get_manifest_path(result_path)
+    if not os.path.exists(manifest_path) or not os.path.exists(result_path):
+        print("no manifest/result of {} to resume from, start from scratch".format(result_path))
+        return set(), None
+    done_reads, result_size, manifest_size = read_manifest(manifest_path)
+    with open(manifest_path, 'r+b') as wf:
+        wf.truncate(manifest_size)
+    return done_reads, result_size
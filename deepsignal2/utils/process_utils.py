@@ -3,6 +3,7 @@ import fnmatch
 import os
 import random
 import multiprocessing
+import multiprocessing.connection
 import multiprocessing.queues
 import numpy as np
 import gc
@@ -37,8 +38,6 @@ iupac_alphabets_rna = {'A': ['A'], 'C': ['C'], 'G': ['G'], 'U': ['U'],
 
 # max_queue_size = 2000
 
-nproc_to_call_mods_in_cpu_mode = 2
-
 
 def str2bool(v):
     # susendberg's function
@@ -87,18 +86,11 @@ def get_refloc_of_methysite_in_motif(seqstr, motifset, methyloc_in_motif=0):
     """
 
     :param seqstr:
-    :param motifset:
+    :param motifset: motifs can be of different lengths
     :param methyloc_in_motif: 0-based
     :return:
     """
-    motifset = set(motifset)
-    strlen = len(seqstr)
-    motiflen = len(list(motifset)[0])
-    sites = []
-    for i in range(0, strlen - motiflen + 1):
-        if seqstr[i:i + motiflen] in motifset:
-            sites.append(i+methyloc_in_motif)
-    return sites
+    return MotifScanner(list(motifset), methyloc_in_motif).scan(seqstr).tolist()
 
 
 def _convert_motif_seq(ori_seq, is_dna=True):
@@ -134,6 +126,74 @@ def get_motif_seqs(motifs, is_dna=True):
     return motif_seqs
 
 
+def _parse_mod_locs(mod_locs, motif_num):
+    if isinstance(mod_locs, str):
+        mod_locs = [int(x) for x in mod_locs.strip().split(',')]
+    elif isinstance(mod_locs, int):
+        mod_locs = [mod_locs]
+    mod_locs = list(mod_locs)
+    if len(mod_locs) == 1:
+        mod_locs = mod_locs * motif_num
+    if len(mod_locs) != motif_num:
+        raise ValueError("the number of mod_locs must be 1 or the same as the number of motifs")
+    return mod_locs
+
+
+class MotifScanner(object):
+    """ Find the targeted sites of a set of (IUPAC) motifs in a seq.
+    Each motif is checked for all positions of the seq at once by numpy byte
+    comparisons (one lookup table per motif base), instead of slicing the seq at
+    each position. Motifs can be of different lengths, each with its own mod_loc.
+    """
+
+    def __init__(self, motifs, mod_locs=0, is_dna=True):
+        """
+        :param motifs: motifs str splited by comma, or a list of motifs
+        :param mod_locs: 0-based location of the targeted base in each motif, an int for all motifs,
+                         or comma-splited str/list with one loc per motif
+        :param is_dna:
+        """
+        if isinstance(motifs, str):
+            motifs = motifs.strip().split(',')
+        motifs = [motif.strip().upper() for motif in motifs]
+        mod_locs = _parse_mod_locs(mod_locs, len(motifs))
+        alphabets = iupac_alphabets if is_dna else iupac_alphabets_rna
+
+        self._motifs = []
+        for motif, mod_loc in zip(motifs, mod_locs):
+            if not 0 <= mod_loc < len(motif):
+                raise ValueError("mod_loc {} is out of motif {}".format(mod_loc, motif))
+            base_luts = np.zeros((len(motif), 256), dtype=bool)
+            for idx, mbase in enumerate(motif):
+                for rbase in alphabets[mbase]:
+                    base_luts[idx, ord(rbase)] = True
+            self._motifs.append((motif, mod_loc, base_luts))
+
+    def get_motifs(self):
+        return [motif for motif, _, _ in self._motifs]
+
+    def scan(self, seqstr):
+        """
+        :param seqstr:
+        :return: sorted 0-based locs of the targeted sites in seqstr
+        """
+        seqbytes = np.frombuffer(seqstr.encode("UTF-8"), dtype=np.uint8)
+        sites = []
+        for motif, mod_loc, base_luts in self._motifs:
+            start_num = len(seqbytes) - len(motif) + 1
+            if start_num <= 0:
+                continue
+            is_site = base_luts[0][seqbytes[:start_num]]
+            for idx in range(1, len(motif)):
+                is_site &= base_luts[idx][seqbytes[idx:(idx + start_num)]]
+            sites.append(np.flatnonzero(is_site) + mod_loc)
+        if len(sites) == 0:
+            return np.array([], dtype=np.int64)
+        elif len(sites) == 1:
+            return sites[0]
+        return np.unique(np.concatenate(sites))
+
+
 def get_fast5s(fast5_dir, is_recursive=True):
     fast5_dir = os.path.abspath(fast5_dir)
     fast5s = []
@@ -526,3 +586,37 @@ class Queue(multiprocessing.queues.Queue):
     def empty(self) -> bool:
         """ Reliable implementation of multiprocessing.Queue.empty() """
         return self.qsize() == 0
+
+
+def is_kill_signal(item):
+    """ whether a queue item is the "kill" sentinel (items can also be lists/dicts/arrays) """
+    return isinstance(item, str) and item == "kill"
+
+
+def terminate_processes(procs):
+    for p in procs:
+        if p.is_alive():
+            p.terminate()
+    for p in procs:
+        p.join()
+
+
+def wait_for_processes(procs, watched_procs=()):
+    """ Block until all procs end, by waiting on the process sentinels (no polling).
+    If any process in procs or watched_procs exits abnormally (non-zero exitcode, e.g. an
+    uncaught exception or being killed), all the others are terminated and a RuntimeError
+    is raised, instead of leaving the pipeline blocked on queues nobody reads any more.
+    """
+    waiting = set(procs)
+    alive = dict([(p.sentinel, p) for p in waiting])
+    for p in watched_procs:
+        alive[p.sentinel] = p
+    while len(waiting) > 0:
+        for sentinel in multiprocessing.connection.wait(list(alive.keys())):
+            p = alive.pop(sentinel)
+            p.join()
+            waiting.discard(p)
+            if p.exitcode != 0:
+                terminate_processes(list(alive.values()))
+                raise RuntimeError("process-{} ({}) exited with exitcode {}, "
+                                   "all processes are terminated".format(p.pid, p.name, p.exitcode))
@@ -1,54 +1,208 @@
 from __future__ import absolute_import
 
+import os
+import mmap
+import hashlib
+import tempfile
+
 from deepsignal2.utils.process_utils import complement_seq
 from deepsignal2.utils.process_utils import get_refloc_of_methysite_in_motif
+from deepsignal2.utils.process_utils import MotifScanner
+
+cpg_scanner = MotifScanner('CG', 0)
+
+
+def _get_fai_path(ref_path):
+    return ref_path + ".fai"
+
+
+def _get_cached_fai_path(ref_path):
+    # .fai of a reference in a not writable dir, cached in the temp dir, keyed by the path, size
+    # and mtime of the reference (so a cached index is never stale)
+    ref_stat = os.stat(ref_path)
+    ref_key = "{}:{}:{}".format(ref_path, ref_stat.st_size, ref_stat.st_mtime)
+    return os.path.join(tempfile.gettempdir(), "{}.{}.fai".format(
+        os.path.basename(ref_path), hashlib.md5(ref_key.encode("UTF-8")).hexdigest()[:8]))
+
+
+def _index_fasta(ref_path):
+    """
+    :return: list of [contigname, length, offset, linebases, linewidth], see build_fasta_index()
+    """
+    contigs = []
+    with open(ref_path, 'rb') as rf:
+        offset = 0
+        contig = None  # [name, length, offset, linebases, linewidth]
+        last_line_short = False
+        for line in rf:
+            linewidth = len(line)
+            if line.startswith(b'>'):
+                if contig is not None:
+                    contigs.append(contig)
+                contig = [line[1:].strip().split()[0].decode('UTF-8'), 0, offset + linewidth, 0, 0]
+                last_line_short = False
+            elif contig is not None:
+                linebases = len(line.rstrip(b'\r\n'))
+                if linebases == 0:
+                    if contig[3] == 0:
+                        # empty lines before the sequence
+                        contig[2] += linewidth
+                    else:
+                        last_line_short = True
+                elif contig[3] == 0:
+                    contig[3], contig[4] = linebases, linewidth
+                elif last_line_short or linebases > contig[3] or \
+                        (linebases == contig[3] and linewidth != contig[4]):
+                    raise ValueError("different line length in sequence '{}' of {}, "
+                                     "cannot be indexed".format(contig[0], ref_path))
+                elif linebases < contig[3]:
+                    last_line_short = True
+                contig[1] += linebases
+            offset += linewidth
+        if contig is not None:
+            contigs.append(contig)
+    return contigs
+
+
+def _write_fasta_index(contigs, fai_path):
+    with open(fai_path, 'w') as wf:
+        for contig in contigs:
+            wf.write("\t".join([str(x) for x in contig]) + "\n")
+
+
+def build_fasta_index(ref_path, fai_path=None):
+    """
+    build a samtools-style .fai index of a fasta file in one streaming pass.
+    each line of the index: contigname, length, offset (of the first base), bases per line, bytes per line
+    :param ref_path:
+    :param fai_path: default ref_path + ".fai"
+    :return: fai_path
+    """
+    if fai_path is None:
+        fai_path = _get_fai_path(ref_path)
+    _write_fasta_index(_index_fasta(ref_path), fai_path)
+    return fai_path
+
+
+def _contigs_to_index(contigs):
+    contignames = [contig[0] for contig in contigs]
+    contig2info = dict([(contig[0], tuple([int(x) for x in contig[1:5]])) for contig in contigs])
+    return contignames, contig2info
+
+
+def read_fasta_index(fai_path):
+    """
+    :param fai_path:
+    :return: list of contignames, dict of contigname 2 (length, offset, linebases, linewidth)
+    """
+    with open(fai_path, 'r') as rf:
+        return _contigs_to_index([line.strip().split("\t") for line in rf])
+
+
+def _load_fasta_index(ref_path):
+    fai_path = _get_fai_path(ref_path)
+    if os.path.exists(fai_path) and os.path.getmtime(fai_path) >= os.path.getmtime(ref_path):
+        return read_fasta_index(fai_path)
+    if not os.access(os.path.dirname(fai_path), os.W_OK):
+        # not writable dir of the reference, the index is cached in the temp dir
+        fai_path = _get_cached_fai_path(ref_path)
+        if os.path.exists(fai_path):
+            return read_fasta_index(fai_path)
+    print("building fasta index {}..".format(fai_path))
+    contigs = _index_fasta(ref_path)
+    fai_tmp = fai_path + "." + str(os.getpid()) + ".tmp"
+    try:
+        _write_fasta_index(contigs, fai_tmp)
+        os.replace(fai_tmp, fai_path)
+    except (IOError, OSError):
+        # use the index in memory only
+        print("cannot save fasta index to '{}'".format(fai_path))
+        if os.path.exists(fai_tmp):
+            os.remove(fai_tmp)
+    return _contigs_to_index(contigs)
+
+
+class FastaIndexedReader:
+    """random access of a fasta file by its .fai index (built if not exists) and mmap"""
+
+    def __init__(self, ref_path):
+        self._ref_path = os.path.abspath(ref_path)
+        self._contignames, self._contig2info = _load_fasta_index(self._ref_path)
+        self._file = None
+        self._mmap = None
+
+    def _get_mmap(self):
+        if self._mmap is None:
+            self._file = open(self._ref_path, 'rb')
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def _get_offset(self, contigname, pos):
+        length, offset, linebases, linewidth = self._contig2info[contigname]
+        return offset + (pos // linebases) * linewidth + pos % linebases
+
+    def getcontignames(self):
+        return self._contignames
+
+    def getcontiglen(self, contigname):
+        return self._contig2info[contigname][0]
+
+    def getcontig2len(self):
+        return dict([(contigname, self._contig2info[contigname][0]) for contigname in self._contignames])
+
+    def fetch(self, contigname, start=0, end=None):
+        """
+        :param contigname:
+        :param start: 0-based
+        :param end: exclusive, default the end of the contig
+        :return: the subsequence [start, end) of the contig, in upper case
+        """
+        length = self._contig2info[contigname][0]
+        start = max(0, start)
+        end = length if end is None else min(end, length)
+        if start >= end:
+            return ''
+        seqbytes = self._get_mmap()[self._get_offset(contigname, start):self._get_offset(contigname, end)]
+        return seqbytes.translate(None, b'\r\n').decode('UTF-8').upper()
+
+    def getcontigseq(self, contigname):
+        return self.fetch(contigname)
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+            self._mmap = None
+            self._file = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_file'] = None
+        state['_mmap'] = None
+        return state
 
 
 def get_contig2len(ref_path):
-    refseq = DNAReference(ref_path)
-    chrom2len = {}
-    for contigname in refseq.getcontignames():
-        chrom2len[contigname] = len(refseq.getcontigs()[contigname])
-    del refseq
-    return chrom2len
+    return FastaIndexedReader(ref_path).getcontig2len()
 
 
 def get_contigs_of_ref(reffile):
+    refreader = FastaIndexedReader(reffile)
     contig2seq = {}
-    with open(reffile, 'r') as rf:
-        contigname = ''
-        contigseq = ''
-        for line in rf:
-            if line.startswith('>'):
-                if contigname != '' and contigseq != '':
-                    contig2seq[contigname] = contigseq
-                contigname = line.strip()[1:].split(' ')[0]
-                contigseq = ''
-            else:
-                contigseq += line.strip()
-        contig2seq[contigname] = contigseq
+    for contigname in refreader.getcontignames():
+        contig2seq[contigname] = refreader.getcontigseq(contigname)
+    refreader.close()
     return contig2seq
 
 
 class DNAReference:
     def __init__(self, reffile):
-        self._contignames = []
+        refreader = FastaIndexedReader(reffile)
+        self._contignames = list(refreader.getcontignames())
         self._contigs = {}  # contigname 2 contigseq
-        with open(reffile, 'r') as rf:
-            contigname = ''
-            contigseq = ''
-            for line in rf:
-                if line.startswith('>'):
-                    if contigname != '' and contigseq != '':
-                        self._contigs[contigname] = contigseq
-                        self._contignames.append(contigname)
-                    contigname = line.strip()[1:].split(' ')[0]
-                    contigseq = ''
-                else:
-                    # turn to upper case
-                    contigseq += line.strip().upper()
-            self._contigs[contigname] = contigseq
-            self._contignames.append(contigname)
+        for contigname in self._contignames:
+            self._contigs[contigname] = refreader.getcontigseq(contigname)
+        refreader.close()
 
     def getcontigs(self):
         return self._contigs
@@ -77,10 +231,10 @@ class DNAContig:
         return self._name
 
     def get_seq_CpG_sites(self):
-        return get_refloc_of_methysite_in_motif(self._seq, {'CG'}, 0)
+        return cpg_scanner.scan(self._seq).tolist()
 
     def get_comseq_CpG_sites(self):
-        return get_refloc_of_methysite_in_motif(self._complementseq, {'CG'}, 0)
+        return cpg_scanner.scan(self._complementseq).tolist()
 
     def get_subseq_start_sites_of_seq(self, subseq, offsetloc=0):
         return get_refloc_of_methysite_in_motif(self._seq, {subseq}, offsetloc)
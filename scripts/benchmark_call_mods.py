@@ -0,0 +1,118 @@
+#! /usr/bin/env python
+"""
+benchmark calling on cpu: samples/second of the old way of _call_mods (autograd on, random
+initial LSTM states, per-batch accuracy_score) vs. the engines of deepsignal2.inference
+(eager, and torchscript/onnx if the exported models are given), whether repeated predictions
+of the same batch are identical, and the max diff of the probs of each engine to eager.
+on a gpu machine, run it with CUDA_VISIBLE_DEVICES="" to benchmark the cpu
+"""
+
+import argparse
+import time
+import numpy as np
+import torch
+from sklearn import metrics
+
+from deepsignal2.models import ModelBiLSTM
+from deepsignal2.inference import load_model
+from deepsignal2.inference import InferenceEngine
+from deepsignal2.inference import get_inference_engine
+from deepsignal2.inference import get_example_batch
+from deepsignal2.utils.process_utils import str2bool
+
+
+class _OldModelBiLSTM(ModelBiLSTM):
+    def init_hidden(self, batch_size, num_layers, hidden_size):
+        # what ModelBiLSTM did before, in eval mode too
+        return torch.randn(num_layers * 2, batch_size, hidden_size), \
+            torch.randn(num_layers * 2, batch_size, hidden_size)
+
+
+class _OldEngine(object):
+    def __init__(self, model):
+        self._model = model
+
+    def predict(self, kmers, base_means, base_stds, base_signal_lens, signals):
+        _, vlogits = self._model(torch.FloatTensor(kmers), torch.FloatTensor(base_means),
+                                 torch.FloatTensor(base_stds), torch.FloatTensor(base_signal_lens),
+                                 torch.FloatTensor(signals))
+        _, vpredicted = torch.max(vlogits.data, 1)
+        metrics.accuracy_score(y_true=np.zeros(len(kmers), dtype=np.int64), y_pred=vpredicted.numpy())
+        return vlogits.data.numpy()
+
+
+def _run(engine, batch, batch_num):
+    start = time.time()
+    for _ in range(batch_num):
+        engine.predict(*batch)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark calling (cpu) of deepsignal2')
+    parser.add_argument("--model_path", "-m", type=str, required=False, default=None,
+                        help="file path of the trained model (.ckpt), default None, use a model of "
+                             "random parameters")
+    parser.add_argument("--torchscript_path", type=str, required=False, default=None,
+                        help="the TorchScript model exported from --model_path (deepsignal2 export), "
+                             "to benchmark --engine torchscript")
+    parser.add_argument("--onnx_path", type=str, required=False, default=None,
+                        help="the ONNX model exported from --model_path (deepsignal2 export), "
+                             "to benchmark --engine onnx")
+    parser.add_argument('--model_type', type=str, default="both_bilstm",
+                        choices=["both_bilstm", "seq_bilstm", "signal_bilstm"], required=False)
+    parser.add_argument('--seq_len', type=int, default=17, required=False)
+    parser.add_argument('--signal_len', type=int, default=16, required=False)
+    parser.add_argument('--layernum1', type=int, default=3, required=False)
+    parser.add_argument('--layernum2', type=int, default=1, required=False)
+    parser.add_argument('--class_num', type=int, default=2, required=False)
+    parser.add_argument('--dropout_rate', type=float, default=0, required=False)
+    parser.add_argument('--n_vocab', type=int, default=16, required=False)
+    parser.add_argument('--n_embed', type=int, default=4, required=False)
+    parser.add_argument('--is_base', type=str, default="yes", required=False)
+    parser.add_argument('--is_signallen', type=str, default="yes", required=False)
+    parser.add_argument('--hid_rnn', type=int, default=256, required=False)
+    parser.add_argument("--batch_size", "-b", default=512, type=int, required=False,
+                        help="batch size, default 512")
+    parser.add_argument("--batch_num", default=20, type=int, required=False,
+                        help="number of batches to be called by each way, default 20")
+    parser.add_argument("--threads", default=1, type=int, required=False,
+                        help="torch threads, default 1")
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    old_model = _OldModelBiLSTM(args.seq_len, args.signal_len, args.layernum1, args.layernum2, args.class_num,
+                                args.dropout_rate, args.hid_rnn,
+                                args.n_vocab, args.n_embed, str2bool(args.is_base), str2bool(args.is_signallen),
+                                args.model_type)
+    if args.model_path is not None:
+        model = load_model(args.model_path, args)
+        old_model.load_state_dict(model.state_dict())
+    else:
+        model = ModelBiLSTM(args.seq_len, args.signal_len, args.layernum1, args.layernum2, args.class_num,
+                            args.dropout_rate, args.hid_rnn,
+                            args.n_vocab, args.n_embed, str2bool(args.is_base), str2bool(args.is_signallen),
+                            args.model_type)
+        model.load_state_dict(old_model.state_dict())
+    old_model.eval()
+
+    batch = get_example_batch(args.batch_size, args.seq_len, args.signal_len)
+    engines = [("old", _OldEngine(old_model)), ("eager", InferenceEngine(model))]
+    if args.torchscript_path is not None:
+        engines.append(("torchscript", get_inference_engine("torchscript", args.torchscript_path, args)))
+    if args.onnx_path is not None:
+        engines.append(("onnx", get_inference_engine("onnx", args.onnx_path, args)))
+    probs_eager = engines[1][1].predict(*batch)
+    for name, engine in engines:
+        # warm up
+        engine.predict(*batch)
+        cost = _run(engine, batch, args.batch_num)
+        probs1, probs2 = engine.predict(*batch), engine.predict(*batch)
+        print("{}: {:.2f} seconds, {:.1f} samples/s, max diff of two predictions: {:.3g}, "
+              "max diff to eager: {:.3g}".format(name, cost, args.batch_size * args.batch_num / cost,
+                                                 np.max(np.abs(probs1 - probs2)),
+                                                 np.max(np.abs(probs1 - probs_eager))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#! /usr/bin/env python
+"""
+benchmark reading fast5 files: opens per read and wall time of the old three-open way
+(signal+events, scaling, alignment read separately) vs. deepsignal2.utils.fast5_reader.read_fast5
+"""
+
+import argparse
+import time
+import h5py
+
+from deepsignal2.utils.process_utils import get_fast5s
+from deepsignal2.utils import fast5_reader
+
+_h5py_file = h5py.File
+open_count = 0
+
+
+def _counted_h5py_file(*args, **kwargs):
+    global open_count
+    open_count += 1
+    return _h5py_file(*args, **kwargs)
+
+
+def _read_fast5_three_opens(fast5_fp, corrected_group, basecall_subgroup):
+    # what extract_features did before: one h5py.File per kind of info
+    with h5py.File(fast5_fp, 'r') as h5file:
+        fast5_reader._get_raw_signal(h5file)
+        fast5_reader._get_events(h5file, corrected_group, basecall_subgroup)
+    with h5py.File(fast5_fp, 'r') as h5file:
+        fast5_reader._get_scaling(h5file)
+    with h5py.File(fast5_fp, 'r') as h5file:
+        fast5_reader._get_alignment_attrs(h5file, corrected_group, basecall_subgroup)
+
+
+def _run(read_func, fast5s, corrected_group, basecall_subgroup):
+    global open_count
+    open_count = 0
+    nread = 0
+    start = time.time()
+    for fast5_fp in fast5s:
+        try:
+            read_func(fast5_fp, corrected_group, basecall_subgroup)
+            nread += 1
+        except Exception:
+            continue
+    return nread, open_count, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark fast5 reading of deepsignal2')
+    parser.add_argument('--fast5_dir', '-i', type=str, required=True,
+                        help='the directory of fast5 files')
+    parser.add_argument("--corrected_group", type=str, required=False, default='RawGenomeCorrected_000',
+                        help='the corrected_group of fast5 files. default RawGenomeCorrected_000')
+    parser.add_argument("--basecall_subgroup", type=str, required=False, default='BaseCalled_template',
+                        help='the corrected subgroup of fast5 files. default BaseCalled_template')
+    parser.add_argument('--max_num', type=int, required=False, default=1000,
+                        help='max number of fast5 files to be read, default 1000')
+    args = parser.parse_args()
+
+    fast5s = get_fast5s(args.fast5_dir, True)[:args.max_num]
+    h5py.File = _counted_h5py_file
+    try:
+        for name, read_func in [("three opens", _read_fast5_three_opens),
+                                ("read_fast5", fast5_reader.read_fast5)]:
+            nread, nopen, cost = _run(read_func, fast5s, args.corrected_group, args.basecall_subgroup)
+            print("{}: {} reads, {:.2f} opens/read, {:.2f} seconds, {:.2f} ms/read".format(
+                name, nread, float(nopen) / max(nread, 1), cost, cost * 1000 / max(nread, 1)))
+    finally:
+        h5py.File = _h5py_file
+
+
+if __name__ == '__main__':
+    main()
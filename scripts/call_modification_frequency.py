@@ -7,6 +7,7 @@ import argparse
 import os
 import sys
 
+from deepsignal2.utils.compress_utils import open_text
 from txt_formater import ModRecord
 from txt_formater import SiteStats
 from txt_formater import split_key
@@ -18,7 +19,7 @@ def calculate_mods_frequency(mods_files, prob_cf):
 
     count, used = 0, 0
     for mods_file in mods_files:
-        with open(mods_file, 'r') as rf:
+        with open_text(mods_file) as rf:
             for line in rf:
                 words = line.strip().split("\t")
                 mod_record = ModRecord(words)
@@ -2,32 +2,7 @@
 import argparse
 import os
 
-
-class DNAReference:
-    def __init__(self, reffile):
-        self._contignames = []
-        self._contigs = {}  # contigname 2 contigseq
-        with open(reffile, 'r') as rf:
-            contigname = ''
-            contigseq = ''
-            for line in rf:
-                if line.startswith('>'):
-                    if contigname != '' and contigseq != '':
-                        self._contigs[contigname] = contigseq
-                        self._contignames.append(contigname)
-                    contigname = line.strip()[1:].split(' ')[0]
-                    contigseq = ''
-                else:
-                    # turn to upper case
-                    contigseq += line.strip().upper()
-            self._contigs[contigname] = contigseq
-            self._contignames.append(contigname)
-
-    def getcontigs(self):
-        return self._contigs
-
-    def getcontignames(self):
-        return self._contignames
+from deepsignal2.utils.ref_reader import FastaIndexedReader
 
 
 def get_refloc_of_methysite_in_motif(seqstr, motif='CG', methyloc_in_motif=0):
@@ -153,20 +128,18 @@ def main():
     mod_loc = 0
 
     print('start to get genome reference info..')
-    refseq = DNAReference(ref_fp)
-    contigname2contigseq = refseq.getcontigs()
-    del refseq
+    refreader = FastaIndexedReader(ref_fp)
 
     print('start to get motif poses in genome reference..')
     contig_cg_poses = set()
     if contign == '':
-        for cgname in contigname2contigseq.keys():
-            fcseq = contigname2contigseq[cgname]
+        for cgname in refreader.getcontignames():
+            fcseq = refreader.getcontigseq(cgname)
             fposes = get_refloc_of_methysite_in_motif(fcseq, motif, mod_loc)
             for fpos in fposes:
                 contig_cg_poses.add((cgname, fpos))
     else:
-        fcseq = contigname2contigseq[contign]
+        fcseq = refreader.getcontigseq(contign)
         fposes = get_refloc_of_methysite_in_motif(fcseq, motif, mod_loc)
         for fpos in fposes:
             contig_cg_poses.add((contign, fpos))
@@ -12,6 +12,7 @@ import random
 import numpy
 from collections import namedtuple
 from sklearn.metrics import roc_auc_score
+from deepsignal2.utils.compress_utils import open_text
 
 from txt_formater import ModRecord
 
@@ -24,7 +25,7 @@ CallRecord = namedtuple('CallRecord', ['key', 'predicted_label', 'is_true_methyl
 
 def sample_sites(filename, is_methylated):
     all_crs = list()
-    rf = open(filename)
+    rf = open_text(filename)
     for line in rf:
         mt_record = ModRecord(line.rstrip().split())
         all_crs.append(CallRecord(mt_record._site_key, mt_record._called_label,
@@ -0,0 +1,96 @@
+#! /usr/bin/env python
+"""
+evaluate call_mods --quantize on a labelled features file (tsv or h5, from extract with
+--methy_label): accuracy, AUC and cpu throughput of the float model and of the quantized model,
+and the deltas. on a gpu machine, run it with CUDA_VISIBLE_DEVICES=""
+"""
+
+import argparse
+import time
+import numpy as np
+import torch
+from sklearn import metrics
+
+from deepsignal2.inference import load_model
+from deepsignal2.inference import quantize_model
+from deepsignal2.inference import InferenceEngine
+from deepsignal2.call_modifications import iter_features_batches
+
+
+def _evaluate(engine, features_batches):
+    labels, probs = [], []
+    cost = 0
+    for features_batch in features_batches:
+        _, kmers, base_means, base_stds, base_signal_lens, k_signals, b_labels = features_batch
+        start = time.time()
+        b_probs = engine.predict(kmers, base_means, base_stds, base_signal_lens, k_signals)
+        cost += time.time() - start
+        labels.append(b_labels)
+        probs.append(b_probs[:, 1] / (b_probs[:, 0] + b_probs[:, 1]))
+    labels = np.concatenate(labels)
+    probs = np.concatenate(probs)
+    accuracy = metrics.accuracy_score(labels, probs > 0.5)
+    try:
+        auc = metrics.roc_auc_score(labels, probs)
+    except ValueError:
+        # only one class in labels
+        auc = float("nan")
+    return accuracy, auc, len(labels) / cost, probs
+
+
+def main():
+    parser = argparse.ArgumentParser(description='evaluate the quantized model (call_mods --quantize) '
+                                                 'against the float model on a labelled features file')
+    parser.add_argument("--features_file", "-i", type=str, required=True,
+                        help="labelled features file (tsv, compressed tsv or h5) from extract_features.py")
+    parser.add_argument("--model_path", "-m", type=str, required=True,
+                        help="file path of the trained model (.ckpt)")
+    parser.add_argument("--quantize", type=str, default="int8", choices=["int8"], required=False,
+                        help="quantization to evaluate, default int8")
+    parser.add_argument('--model_type', type=str, default="both_bilstm",
+                        choices=["both_bilstm", "seq_bilstm", "signal_bilstm"], required=False)
+    parser.add_argument('--seq_len', type=int, default=17, required=False)
+    parser.add_argument('--signal_len', type=int, default=16, required=False)
+    parser.add_argument('--layernum1', type=int, default=3, required=False)
+    parser.add_argument('--layernum2', type=int, default=1, required=False)
+    parser.add_argument('--class_num', type=int, default=2, required=False)
+    parser.add_argument('--dropout_rate', type=float, default=0, required=False)
+    parser.add_argument('--n_vocab', type=int, default=16, required=False)
+    parser.add_argument('--n_embed', type=int, default=4, required=False)
+    parser.add_argument('--is_base', type=str, default="yes", required=False)
+    parser.add_argument('--is_signallen', type=str, default="yes", required=False)
+    parser.add_argument('--hid_rnn', type=int, default=256, required=False)
+    parser.add_argument("--batch_size", "-b", default=512, type=int, required=False,
+                        help="batch size, default 512")
+    parser.add_argument("--max_num", type=int, default=100000, required=False,
+                        help="max number of samples to be evaluated, default 100000")
+    parser.add_argument("--threads", default=1, type=int, required=False,
+                        help="torch threads, default 1")
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    features_batches = []
+    sample_num = 0
+    for features_batch in iter_features_batches(args.features_file, args.batch_size):
+        features_batches.append(features_batch)
+        sample_num += len(features_batch[0])
+        if sample_num >= args.max_num:
+            break
+
+    model = load_model(args.model_path, args).cpu()
+    results = []
+    for name, engine in [("float", InferenceEngine(model)),
+                         (args.quantize, InferenceEngine(quantize_model(model, args.quantize)))]:
+        accuracy, auc, speed, probs = _evaluate(engine, features_batches)
+        results.append((accuracy, auc, speed, probs))
+        print("{}: {} samples, accuracy {:.4f}, AUC {:.4f}, {:.1f} samples/s".format(name, len(probs),
+                                                                                  accuracy, auc, speed))
+    (acc_f, auc_f, speed_f, probs_f), (acc_q, auc_q, speed_q, probs_q) = results
+    print("delta ({} - float): accuracy {:+.4f}, AUC {:+.4f}, speedup {:.2f}x, max diff of prob_1 {:.3g}, "
+          "{} calls changed".format(args.quantize, acc_q - acc_f, auc_q - auc_f, speed_q / speed_f,
+                                    np.max(np.abs(probs_q - probs_f)),
+                                    np.sum((probs_q > 0.5) != (probs_f > 0.5))))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,8 @@
 import argparse
 import os
 
+from deepsignal2.utils.compress_utils import open_text
+
 
 def str2bool(v):
     # susendberg's function
@@ -10,7 +12,7 @@ def str2bool(v):
 
 def filter_one_signal_feature_file(sf_fp, wfp, label):
     wf = open(wfp, 'w')
-    with open(sf_fp, 'r') as rf:
+    with open_text(sf_fp) as rf:
         for line in rf:
             words = line.strip().split("\t")
             if words[-1] == label:
@@ -20,7 +22,7 @@ def filter_one_signal_feature_file(sf_fp, wfp, label):
 
 def filter_one_signal_feature_file_append(sf_fp, wfp, label):
     wf = open(wfp, 'a')
-    with open(sf_fp, 'r') as rf:
+    with open_text(sf_fp) as rf:
         for line in rf:
             words = line.strip().split("\t")
             if words[-1] == label:
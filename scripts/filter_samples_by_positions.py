@@ -2,6 +2,8 @@
 import argparse
 import os
 
+from deepsignal2.utils.compress_utils import open_text
+
 
 def str2bool(v):
     # susendberg's function
@@ -21,7 +23,7 @@ def read_position_file(positionfp, col_chrom=0, col_pos=1, header=False):
 
 def filter_one_signal_feature_file(sf_fp, positions, wfp, label, chrom_col=1, pos_col=2):
     wf = open(wfp, 'w')
-    with open(sf_fp, 'r') as rf:
+    with open_text(sf_fp) as rf:
         for line in rf:
             words = line.strip().split("\t")
             chromsome, loc = words[chrom_col-1], int(words[pos_col-1])
@@ -33,7 +35,7 @@ def filter_one_signal_feature_file(sf_fp, positions, wfp, label, chrom_col=1, po
 
 def filter_one_signal_feature_file_append(sf_fp, positions, wfp, label, chrom_col=1, pos_col=2):
     wf = open(wfp, 'a')
-    with open(sf_fp, 'r') as rf:
+    with open_text(sf_fp) as rf:
         for line in rf:
             words = line.strip().split("\t")
             chromsome, loc = words[chrom_col-1], int(words[pos_col-1])
@@ -5,6 +5,8 @@ select rows of file randomly, with a header
 import random
 import argparse
 
+from deepsignal2.utils.compress_utils import open_text
+
 
 def str2bool(v):
     # susendberg's function
@@ -24,7 +26,7 @@ def random_select_file_rows(ori_file, w_file, maxrownum=10000, header=True):
     # nrows = len(whole_rows) - 1
 
     nrows = 0
-    with open(ori_file) as rf:
+    with open_text(ori_file) as rf:
         for line in rf:
             nrows += 1
     if header:
@@ -41,7 +43,7 @@ def random_select_file_rows(ori_file, w_file, maxrownum=10000, header=True):
     random_lines[-1] = nrows
 
     wf = open(w_file, 'w')
-    with open(ori_file) as rf:
+    with open_text(ori_file) as rf:
         if header:
             wf.write(next(rf))
         for i in range(1, len(random_lines)):
@@ -7,6 +7,8 @@ import os
 import gc
 import numpy as np
 
+from deepsignal2.utils.compress_utils import open_text
+
 
 def str2bool(v):
     # susendberg's function
@@ -15,7 +17,7 @@ def str2bool(v):
 
 def count_line_num(sl_filepath, fheader=True):
     count = 0
-    with open(sl_filepath, 'r') as rf:
+    with open_text(sl_filepath) as rf:
         if fheader:
             next(rf)
         for line in rf:
@@ -25,7 +27,7 @@ def count_line_num(sl_filepath, fheader=True):
 
 
 def read_one_shuffle_info(filepath, shuffle_lines_num, total_lines_num, checked_lines_num, isheader):
-    with open(filepath, 'r') as rf:
+    with open_text(filepath) as rf:
         if isheader:
             next(rf)
         count = 0
@@ -66,7 +68,7 @@ def caoncat_two_files(file1, file2, shuffle_lines_num, lines_num, concated_fp, i
     open(concated_fp, 'w').close()
 
     if isheader:
-        rf1 = open(file1, 'r')
+        rf1 = open_text(file1)
         wf = open(concated_fp, 'a')
         wf.write(next(rf1))
         wf.close()
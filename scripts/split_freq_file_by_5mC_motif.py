@@ -1,6 +1,8 @@
 import os
 import argparse
 
+from deepsignal2.utils.ref_reader import FastaIndexedReader
+
 
 basepairs = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A', 'N': 'N',
              'W': 'W', 'S': 'S', 'M': 'K', 'K': 'M', 'R': 'Y',
@@ -25,33 +27,6 @@ def complement_seq(dnaseq):
     return comseq
 
 
-class DNAReference:
-    def __init__(self, reffile):
-        self._contignames = []
-        self._contigs = {}  # contigname 2 contigseq
-        with open(reffile, 'r') as rf:
-            contigname = ''
-            contigseq = ''
-            for line in rf:
-                if line.startswith('>'):
-                    if contigname != '' and contigseq != '':
-                        self._contigs[contigname] = contigseq
-                        self._contignames.append(contigname)
-                    contigname = line.strip()[1:].split(' ')[0]
-                    contigseq = ''
-                else:
-                    # turn to upper case
-                    contigseq += line.strip().upper()
-            self._contigs[contigname] = contigseq
-            self._contignames.append(contigname)
-
-    def getcontigs(self):
-        return self._contigs
-
-    def getcontignames(self):
-        return self._contignames
-
-
 def _convert_motif_seq(ori_seq, is_dna=True):
     outbases = []
     for bbase in ori_seq:
@@ -89,11 +64,11 @@ def get_c_motif2seq():
     return motif2seq
 
 
-def get_motifseq(chrom, pos, strand, contigs):
+def get_motifseq(chrom, pos, strand, refreader):
     if strand == "+":
-        seq = contigs[chrom][pos:(pos+3)]
+        seq = refreader.fetch(chrom, pos, pos+3)
     else:
-        seq = complement_seq(contigs[chrom][(pos-2):(pos+1)])
+        seq = complement_seq(refreader.fetch(chrom, pos-2, pos+1))
     return seq
 
 
@@ -126,7 +101,7 @@ def _split_freq_file(freqfile, ref):
     if fext.endswith(".bed"):
         if ref is None:
             raise ValueError("--ref must be provided if freqfile is .bed!")
-        contigs = DNAReference(ref).getcontigs()
+        refreader = FastaIndexedReader(ref)
         # chrom, str(pos), str(pos + 1), ".", str(sitestats._coverage),
         # sitestats._strand, str(pos), str(pos + 1), "0,0,0", str(sitestats._coverage),
         # str(int(round(rmet * 100, 0)))
@@ -135,7 +110,7 @@ def _split_freq_file(freqfile, ref):
                 count += 1
                 words = line.strip().split("\t")
                 chrom, pos, strand = words[0], int(words[1]), words[5]
-                seq = get_motifseq(chrom, pos, strand, contigs)
+                seq = get_motifseq(chrom, pos, strand, refreader)
                 try:
                     wfobjs[motif2idx[seq2motif[seq]]].write(line)
                 except KeyError:
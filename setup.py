@@ -48,11 +48,10 @@ setup(
     license='GNU General Public License v3 (GPLv3)',
     author='Peng Ni',
     # tests_require=['pytest'],
-    install_requires=['numpy>=1.15.3',
-                      'h5py>=2.8.0',
-                      'statsmodels>=0.9.0',
+    install_requires=['numpy>=1.17.0',
+                      'h5py>=2.10.0',
                       'scikit-learn>=0.20.1',
-                      'torch>=1.2.0,<=1.7.0',
+                      'torch>=1.10.0',
                       ],
     # cmdclass={'test': PyTest},
     author_email='543943952@qq.com',
@@ -0,0 +1,39 @@
+import os
+
+import h5py
+import numpy as np
+import pytest
+
+from deepsignal2.utils.fast5_reader import get_fast5_read_items_n_costs
+
+
+def _write_single_read_fast5(fast5_path, signal_len):
+    with h5py.File(fast5_path, "w") as h5file:
+        h5file.create_dataset("Raw/Reads/Read_1/Signal", data=np.zeros(signal_len, dtype=np.int16))
+
+
+def _write_multi_read_fast5(fast5_path, read_ids, signal_lens):
+    with h5py.File(fast5_path, "w") as h5file:
+        for read_id, signal_len in zip(read_ids, signal_lens):
+            h5file.create_dataset("read_{}/Raw/Signal".format(read_id),
+                                  data=np.zeros(signal_len, dtype=np.int16))
+
+
+@pytest.mark.parametrize("nproc", [1, 2])
+def test_list_mixed_single_multi_read_fast5s(tmp_path, nproc):
+    single1 = str(tmp_path / "single1.fast5")
+    multi = str(tmp_path / "multi.fast5")
+    single2 = str(tmp_path / "single2.fast5")
+    broken = str(tmp_path / "broken.fast5")
+    _write_single_read_fast5(single1, 100)
+    _write_multi_read_fast5(multi, ["a", "b"], [300, 50])
+    _write_single_read_fast5(single2, 200)
+    with open(broken, "w") as wf:
+        wf.write("not a fast5 file")
+
+    read_items, read_costs = get_fast5_read_items_n_costs([single1, multi, single2, broken], nproc)
+
+    assert read_items == [(single1, None), (multi, "read_a"), (multi, "read_b"), (single2, None),
+                          (broken, None)]
+    assert read_costs == [os.path.getsize(single1), 600, 100, os.path.getsize(single2),
+                          os.path.getsize(broken)]